@@ -5,22 +5,40 @@ from scipy import misc
 import sys
 sys.path.insert(0,'..')
 
-from modules.ImageCreatorRGB import ImageCreatorRGB
+from modules.ImageCreatorRGB import ImageCreatorRGB, MAX_READS_IN_IMAGE, IMAGE_WIDTH
+from modules.ReadCache import ReadCache, ReadCacheWriter
+from modules.ReadStore import ReadStore
+from modules.ReadDownsampler import ReadDownsampler
+from modules.StreamingImageCreatorRGB import StreamingImageCreatorRGB
 from modules.BamHandler import BamHandler
 from modules.FastaHandler import FastaHandler
 from modules.BedHandler import BedHandler
+from modules.TextColor import TextColor
 
 
 class Bed2ImageAPI:
     """
     Works as a main class and handles user interaction with different modules.
     """
-    def __init__(self, bam_file_path, reference_file_path, bed_file_path, output_dir):
+    def __init__(self, bam_file_path, reference_file_path, bed_file_path, output_dir, bam_threads=1,
+                 read_downsampler=None, read_cache_dir=None, read_cache_margin=0):
         # --- initialize handlers ---
-        self.bam_handler = BamHandler(bam_file_path)
+        self.bam_handler = BamHandler(bam_file_path, threads=bam_threads)
         self.fasta_handler = FastaHandler(reference_file_path)
         self.bed_handler = BedHandler(bed_file_path)
         self.output_dir = output_dir
+        self.read_downsampler = read_downsampler
+        self.read_cache = None
+        self.read_cache_writer = None
+        self.read_cache_margin = read_cache_margin
+        if read_cache_dir is not None:
+            if read_cache_dir[-1] != "/":
+                read_cache_dir += "/"
+            if not os.path.exists(read_cache_dir):
+                os.mkdir(read_cache_dir)
+            self.read_cache = ReadCache(read_cache_dir)
+            shard_name = "reads_" + time.strftime("%m%d%Y_%H%M%S") + "_" + str(os.getpid())
+            self.read_cache_writer = ReadCacheWriter(read_cache_dir, shard_name)
 
     @staticmethod
     def save_image_rgb(image_array, chr_name, start_position, alts, genotype, output_dir):
@@ -28,7 +46,7 @@ class Bed2ImageAPI:
         misc.imsave(output_file_name + ".png", image_array, format="PNG")
 
     @staticmethod
-    def create_image_rgb(bam_handler, fasta_handler, bed_record, output_dir):
+    def create_image_rgb(bam_handler, fasta_handler, bed_record, output_dir, read_downsampler=None):
         """
         Iterate through all the reads that fall in a region, find candidates, label candidates and output a bed file.
         :param start_position: Start position of the region
@@ -41,21 +59,121 @@ class Bed2ImageAPI:
         genotype = int(genotype)
 
         reads = bam_handler.get_reads(chromosome_name=chromosome_name, start=start_position, stop=end_position+1)
-        image_creator = ImageCreatorRGB(fasta_handler, chromosome_name, start_position, end_position)
+        image_creator = ImageCreatorRGB(fasta_handler, chromosome_name, start_position, end_position,
+                                        read_downsampler=read_downsampler)
 
         image_creator.process_reads(reads)
 
         image_array = image_creator.generate_image(start_position, alts)
         Bed2ImageAPI.save_image_rgb(image_array, chromosome_name, start_position, alts, genotype, output_dir)
 
+    @staticmethod
+    def create_images_rgb(bam_handler, fasta_handler, bed_records, output_dir, read_downsampler=None,
+                          read_cache=None, read_cache_writer=None, read_cache_margin=0):
+        """
+        Create images of a group of nearby bed records of the same chromosome sorted by position. The reads of the
+        group are fetched and decoded once and the image of every record is generated from them.
+        :param bam_handler: Handles bam file
+        :param fasta_handler: Handles fasta file
+        :param bed_records: Bed records of the group
+        :param output_dir: Directory to save the images
+        :param read_downsampler: ReadDownsampler that picks the reads of each record, only the reads picked for any
+        record of the group are decoded
+        :param read_cache: ReadCache, the group is rendered from its decoded reads if they cover the image window and
+        were picked with the same downsampling settings
+        :param read_cache_writer: ReadCacheWriter the decoded reads of the group are added to if they are not cached
+        :param read_cache_margin: Extra positions decoded on each side of the image window of a cached group
+        :return:
+        """
+        records = [tuple(bed_record.rstrip().split('\t')) for bed_record in bed_records]
+        chromosome_name = records[0][0]
+        group_start = min(int(record[1]) for record in records)
+        group_end = max(int(record[2]) for record in records)
+        # reads picked with other downsampling settings are a different entry, a mismatch is a cache miss
+        sampling_key = read_downsampler.get_settings_key() if read_downsampler is not None else "all"
+        cache_key = chromosome_name + ":" + str(group_start) + "-" + str(group_end) + "/" + sampling_key
+
+        # [record index] = indices of the reads picked for the record
+        picked_read_indices = None
+        if read_cache is not None and \
+                read_cache.has_window(cache_key, group_start - IMAGE_WIDTH, group_end + IMAGE_WIDTH + 1):
+            read_store, picked_read_indices = read_cache.get(cache_key)
+            image_creator = ImageCreatorRGB(fasta_handler, chromosome_name, group_start, group_end,
+                                            read_store=read_store)
+        else:
+            reads = bam_handler.get_reads(chromosome_name=chromosome_name, start=group_start, stop=group_end+1)
+            if read_downsampler is not None:
+                reads = list(reads)
+                # [record index] = reads picked for the record
+                picked_reads = list()
+                for record in records:
+                    start_position, end_position = int(record[1]), int(record[2])
+                    aligned_reads = (read for read in reads
+                                     if read.reference_start < end_position + 1 and read.reference_end > start_position)
+                    picked_reads.append(read_downsampler.downsample_reads(aligned_reads, chromosome_name,
+                                                                          start_position))
+                picked_read_ids = set(id(read) for record_reads in picked_reads for read in record_reads)
+                reads = [read for read in reads if id(read) in picked_read_ids]
+                read_index_of_read = dict((id(read), read_index) for read_index, read in enumerate(reads))
+                picked_read_indices = [[read_index_of_read[id(read)] for read in record_reads]
+                                       for record_reads in picked_reads]
+
+            read_store = None
+            if read_cache_writer is not None:
+                margin = IMAGE_WIDTH + read_cache_margin
+                read_store = ReadStore(group_start - margin, group_end + margin + 1)
+            image_creator = ImageCreatorRGB(fasta_handler, chromosome_name, group_start, group_end,
+                                            read_store=read_store)
+            image_creator.decode_reads(reads)
+            if read_cache_writer is not None:
+                read_cache_writer.add(cache_key, image_creator.read_store, picked_read_indices)
+        image_creator.set_window_reference(image_creator.window_start, image_creator.window_end)
+
+        for i, record in enumerate(records):
+            chromosome_name, start_position, end_position, ref, alts, genotype = record
+            start_position = int(start_position)
+            end_position = int(end_position)
+            genotype = int(genotype)
+
+            read_indices = picked_read_indices[i] if picked_read_indices is not None else None
+            image_creator.select_reads(start_position, end_position, read_indices)
+            image_array = image_creator.generate_image(start_position, alts)
+            Bed2ImageAPI.save_image_rgb(image_array, chromosome_name, start_position, alts, genotype, output_dir)
+
     def test(self):
         """
         Test the API
         :return:
         """
-        for record in self.bed_handler.all_bed_records:
+        for bed_records in BedHandler.get_nearby_record_groups(self.bed_handler.get_bed_records()):
+            print(''.join(bed_records), end='')
+            self.create_images_rgb(self.bam_handler, self.fasta_handler, bed_records, self.output_dir,
+                                   self.read_downsampler, self.read_cache, self.read_cache_writer,
+                                   self.read_cache_margin)
+        if self.read_cache_writer is not None:
+            self.read_cache_writer.close()
+
+    def test_streaming(self):
+        """
+        Test the API with a window that slides over the bed records, the bed file should be sorted
+        :return:
+        """
+        image_creator = StreamingImageCreatorRGB(self.bam_handler, self.fasta_handler)
+        for record in self.bed_handler.get_bed_records():
             print(record)
-            self.create_image_rgb(self.bam_handler, self.fasta_handler, record, self.output_dir)
+            chromosome_name, start_position, end_position, ref, alts, genotype = tuple(record.rstrip().split('\t'))
+            start_position = int(start_position)
+            image_array = image_creator.generate_image(chromosome_name, start_position, int(end_position), alts)
+            self.save_image_rgb(image_array, chromosome_name, start_position, alts, int(genotype), self.output_dir)
+        image_creator.close()
+
+        for chromosome_name, start, stop, read_count, compressed_bytes, uncompressed_bytes, first_read_latency, \
+                elapsed in self.bam_handler.pop_region_statistics():
+            sys.stderr.write(TextColor.CYAN + "REGION " + chromosome_name + ":" + str(start) + "-" + str(stop)
+                             + " READS: " + str(read_count) + " COMPRESSED BYTES: " + str(compressed_bytes)
+                             + " UNCOMPRESSED BYTES: " + str(uncompressed_bytes)
+                             + " FIRST READ: " + str(round((first_read_latency or 0) * 1000, 2)) + " ms"
+                             + " TIME: " + str(round(elapsed, 2)) + " Secs\n" + TextColor.END)
 
 
 def handle_output_directory(output_dir):
@@ -110,19 +228,74 @@ if __name__ == '__main__':
         type=bool,
         help="If true the images will be saved in output directory"
     )
+    parser.add_argument(
+        "--streaming",
+        type='bool',
+        default=False,
+        help="If true the images are generated with a sliding window, the bed file should be sorted"
+    )
     parser.add_argument(
         "--output_dir",
         type=str,
         default="output/",
         help="Path to output directory."
     )
+    parser.add_argument(
+        "--bam_threads",
+        type=int,
+        default=1,
+        help="Number of BGZF decompression threads of the bam file."
+    )
+    parser.add_argument(
+        "--downsample",
+        type='bool',
+        default=False,
+        help="If true the reads of a record are a seeded random subset instead of the first reads."
+    )
+    parser.add_argument(
+        "--strand_balanced",
+        type='bool',
+        default=False,
+        help="If true half of the downsampled reads come from each strand."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the read downsampling."
+    )
+
+    parser.add_argument(
+        "--read_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the decoded read cache. Cached groups are rendered without the bam, the others are decoded "
+             "and added to the cache. Entries are kept per downsampling setting, a cache is only valid for "
+             "the bam and read filters it was built with."
+    )
+    parser.add_argument(
+        "--read_cache_margin",
+        type=int,
+        default=0,
+        help="Extra positions decoded on each side of the image window of a cached group, so the image width can "
+             "grow without rebuilding the cache."
+    )
 
     FLAGS, unparsed = parser.parse_known_args()
     if FLAGS.save_img is True:
         FLAGS.output_dir = handle_output_directory(FLAGS.output_dir)
 
-    view = Bed2ImageAPI(FLAGS.bam, FLAGS.ref, FLAGS.bed, FLAGS.output_dir)
-    view.test()
+    read_downsampler = ReadDownsampler(MAX_READS_IN_IMAGE, FLAGS.seed, FLAGS.strand_balanced) \
+        if FLAGS.downsample is True else None
+    view = Bed2ImageAPI(FLAGS.bam, FLAGS.ref, FLAGS.bed, FLAGS.output_dir, FLAGS.bam_threads, read_downsampler,
+                        FLAGS.read_cache_dir, FLAGS.read_cache_margin)
+    if FLAGS.streaming is True:
+        view.test_streaming()
+    else:
+        view.test()
+    passed_read_count, filtered_read_counts = view.bam_handler.get_read_filter_statistics()
+    sys.stderr.write(TextColor.CYAN + "READS PASSED: " + str(passed_read_count) + " FILTERED: "
+                     + str(filtered_read_counts) + "\n" + TextColor.END)
 
 """
 python3 bed2RGBimgAPI.py --bam ~/Kishwar/Whole_chr3_data/illumina/vcf_whole_chr/chr3.bam \
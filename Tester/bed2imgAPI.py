@@ -45,7 +45,7 @@ class Bed2ImageAPI:
         Test the API
         :return:
         """
-        for record in self.bed_handler.all_bed_records:
+        for record in self.bed_handler.get_bed_records():
             print(record)
             self.create_image(self.bam_handler, self.fasta_handler, record)
 
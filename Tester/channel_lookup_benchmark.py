@@ -0,0 +1,97 @@
+import argparse
+import time
+import random
+import sys
+sys.path.insert(0, '..')
+
+import numpy as np
+from modules.ImageChannels import ImageChannels
+
+"""
+Compare the speed of per base channel construction with the precomputed lookup tables.
+"""
+
+
+def generate_segments(segment_count, segment_length):
+    """
+    Generate random read segments
+    :param segment_count: Number of segments
+    :param segment_length: Bases in each segment
+    :return: List of segments, each segment is (bases, base qualities, map quality, is_rev, is_match, is_supporting)
+    """
+    segments = list()
+    for i in range(segment_count):
+        bases = ''.join(random.choice('ACGTN*') for j in range(segment_length))
+        base_qualities = [random.randint(0, 60) for j in range(segment_length)]
+        is_match = [random.random() < 0.9 for j in range(segment_length)]
+        segments.append((bases, base_qualities, random.randint(0, 70), random.random() < 0.5, is_match,
+                         random.random() < 0.5))
+    return segments
+
+
+def encode_per_call(segments):
+    """
+    Encode segments by calling ImageChannels.get_channels for each base
+    :param segments: Read segments
+    :return: List of channel arrays
+    """
+    encoded = list()
+    for bases, base_qualities, map_quality, is_rev, is_match, is_supporting in segments:
+        channels = [ImageChannels.get_channels((bases[i], base_qualities[i], map_quality, is_rev, is_match[i],
+                                                is_supporting)) for i in range(len(bases))]
+        encoded.append(np.array(channels))
+    return encoded
+
+
+def encode_with_lookup(segments):
+    """
+    Encode segments using the lookup tables
+    :param segments: Read segments
+    :return: List of channel arrays
+    """
+    encoded = list()
+    for bases, base_qualities, map_quality, is_rev, is_match, is_supporting in segments:
+        encoded.append(ImageChannels.get_segment_channels(np.frombuffer(bases.encode(), dtype=np.uint8),
+                                                          np.array(base_qualities, dtype=np.int64),
+                                                          map_quality, is_rev, np.array(is_match, dtype=np.bool_),
+                                                          is_supporting))
+    return encoded
+
+
+if __name__ == '__main__':
+    '''
+    Processes arguments and runs the benchmark.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--segments",
+        type=int,
+        default=1000,
+        help="Number of read segments to encode."
+    )
+    parser.add_argument(
+        "--length",
+        type=int,
+        default=150,
+        help="Number of bases in each segment."
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    random.seed(0)
+    all_segments = generate_segments(FLAGS.segments, FLAGS.length)
+
+    start_time = time.time()
+    per_call_channels = encode_per_call(all_segments)
+    per_call_time = time.time() - start_time
+
+    start_time = time.time()
+    lookup_channels = encode_with_lookup(all_segments)
+    lookup_time = time.time() - start_time
+
+    for per_call, lookup in zip(per_call_channels, lookup_channels):
+        assert np.array_equal(per_call, lookup)
+
+    total_bases = FLAGS.segments * FLAGS.length
+    print("Bases encoded:\t", total_bases)
+    print("Per call:\t %.4f secs\t %.0f bases/sec" % (per_call_time, total_bases / per_call_time))
+    print("Lookup table:\t %.4f secs\t %.0f bases/sec" % (lookup_time, total_bases / lookup_time))
+    print("Speedup:\t %.1fx" % (per_call_time / lookup_time))
@@ -1,69 +1,196 @@
 import argparse
-import random
-
-from modules.BedHandler import BedHandler
+import sys
+import numpy as np
 
 """
 Subsample the bed file for homozygous cases for training faster
 """
 
+HOM = 0
+HET = 1
+HOM_ALT = 2
+GENOTYPES = [HOM, HET, HOM_ALT]
+READ_CHUNK_SIZE = 1 << 24
+WRITE_BUFFER_SIZE = 1 << 20
+# the genotype is the sixth field of a record
+GENOTYPE_FIELD = 5
+
 
 class BedSubsampler:
     """
-    Downsamples a bed file
+    Downsamples a bed file while streaming through it.
+    - The bed file is read in chunks of whole records and the genotypes of a chunk are parsed at once.
+    - A bed file is read twice, first to count the genotypes and then to select every record with the probability of
+    its genotype. Selected records keep their order and memory doesn't grow with the file.
+    - Standard input can only be read once, records of each genotype are selected by keeping the ones with the
+    smallest random keys. Selected records are written in the order they are read.
     """
-    def __init__(self, bed_file_path):
+    def __init__(self, bed_file_path, seed=None, target_ratios=None):
         """
         Initialize a bed subsampler
-        :param bed_file_path:
+        :param bed_file_path: Path to a bed file, '-' to read from standard input
+        :param seed: Seed of the random selection
+        :param target_ratios: Ratios of hom, het and hom-alt records in the output. If None every het and hom-alt
+        record is selected and hom records are downsampled to twice the size of the larger of the other two classes.
+        """
+        self.bed_file_path = bed_file_path
+        self.random_state = np.random.RandomState(seed)
+        self.target_ratios = target_ratios
+        self.genotype_counts = [0, 0, 0]
+
+    def open_bed_file(self):
+        """
+        Open the bed file or the standard input in binary mode
+        :return: File object
         """
-        # --- initialize handlers ---
-        self.bed_handler = BedHandler(bed_file_path)
+        if self.bed_file_path == '-':
+            return sys.stdin.buffer
+        return open(self.bed_file_path, 'rb')
 
     @staticmethod
-    def select_or_not(bed_record, downsample_rate):
+    def parse_chunk(chunk):
         """
-        Determines if a bed record should be selected given a downsampling rate
-        :param bed_record: A bed record
-        :param downsample_rate: A downsampling probability
-        :return: Boolean
+        Find the records of a chunk and their genotypes. Genotypes are single digits.
+        :param chunk: Bytes of whole records
+        :return: Start and end offsets of the records in the chunk, genotypes of the records
         """
-        chromosome_name, start_position, end_position, ref, alts, genotype = tuple(bed_record.rstrip().split('\t')[0:6])
-        genotype = int(genotype)
-        # if not homozygous, always pick
-        if genotype != 0:
-            return True
+        array = np.frombuffer(chunk, dtype=np.uint8)
+        record_ends = np.nonzero(array == ord('\n'))[0] + 1
+        if len(record_ends) == 0 or record_ends[-1] != len(array):
+            record_ends = np.append(record_ends, len(array))
+        record_starts = np.concatenate(([0], record_ends[:-1]))
 
-        # else do a sampling based on probability
-        random_chance = random.uniform(0, 1)
-        if random_chance <= downsample_rate:
-            return True
-        return False
+        # empty lines are skipped
+        not_empty = array[record_starts] != ord('\n')
+        record_starts = record_starts[not_empty]
+        record_ends = record_ends[not_empty]
+
+        tabs = np.nonzero(array == ord('\t'))[0]
+        genotype_tabs = tabs[np.searchsorted(tabs, record_starts) + GENOTYPE_FIELD - 1]
+        genotypes = array[genotype_tabs + 1].astype(np.int64) - ord('0')
+
+        return record_starts, record_ends, genotypes
+
+    def read_chunks(self):
+        """
+        Read the bed file in chunks of whole records
+        :return: Generator of (chunk, record starts, record ends, genotypes)
+        """
+        with self.open_bed_file() as bed_file:
+            remainder = b''
+            while True:
+                data = bed_file.read(READ_CHUNK_SIZE)
+                chunk = remainder + data
+                if data:
+                    # the last record of the chunk continues in the next read
+                    last_record_end = chunk.rfind(b'\n') + 1
+                    remainder = chunk[last_record_end:]
+                    chunk = chunk[:last_record_end]
+                if chunk:
+                    yield (chunk,) + self.parse_chunk(chunk)
+                if not data:
+                    return
 
-    def downsample_bed_file(self):
+    def count_genotypes(self):
         """
-        Downsample the bed file
+        Count the records of each genotype in one pass over the bed file
         :return:
         """
-        # calculate the downsample rate based on distribution of three classes
-        downsample_rate = max(self.bed_handler.total_het, self.bed_handler.total_hom_alt) / self.bed_handler.total_hom
-        downsample_rate = 2 * downsample_rate
+        genotype_counts = np.zeros(len(GENOTYPES), dtype=np.int64)
+        for chunk, record_starts, record_ends, genotypes in self.read_chunks():
+            genotype_counts += np.bincount(genotypes, minlength=len(GENOTYPES))
+        self.genotype_counts = genotype_counts.tolist()
 
-        for i, record in enumerate(self.bed_handler.all_bed_records):
-            if BedSubsampler.select_or_not(record, downsample_rate) is True:
-                print(record, end='')
+    def get_selection_probabilities(self):
+        """
+        Calculate the probability of selecting a record of each genotype from the genotype counts
+        :return: List of probabilities indexed by genotype
+        """
+        total_hom, total_het, total_hom_alt = self.genotype_counts
+        if self.target_ratios is None:
+            # if not homozygous, always pick
+            downsample_rate = 2 * max(total_het, total_hom_alt) / total_hom if total_hom else 1.0
+            return [min(1.0, downsample_rate), 1.0, 1.0]
+
+        # the genotype with the fewest records for its ratio is kept completely and sets the size of the others
+        present_genotypes = [genotype for genotype in GENOTYPES
+                             if self.target_ratios[genotype] > 0 and self.genotype_counts[genotype] > 0]
+        if not present_genotypes:
+            return [0.0, 0.0, 0.0]
+        scale = min(self.genotype_counts[genotype] / self.target_ratios[genotype] for genotype in present_genotypes)
+        return [scale * self.target_ratios[genotype] / self.genotype_counts[genotype]
+                if genotype in present_genotypes else 0.0 for genotype in GENOTYPES]
+
+    def downsample_bed_file(self, output_file):
+        """
+        Downsample the bed file in two passes
+        :param output_file: Binary file object to write the selected records
+        :return:
+        """
+        self.count_genotypes()
+        selection_probabilities = np.array(self.get_selection_probabilities())
+
+        for chunk, record_starts, record_ends, genotypes in self.read_chunks():
+            selected = self.random_state.random_sample(len(genotypes)) < selection_probabilities[genotypes]
+            output_file.write(b''.join([chunk[start:end] for start, end in
+                                        zip(record_starts[selected].tolist(), record_ends[selected].tolist())]))
+
+    def reservoir_downsample_bed_file(self, output_file, sample_size):
+        """
+        Downsample the bed file in one pass, the number of records of each genotype is fixed by the sample size and the
+        target ratios. Every record gets a random key and the records with the smallest keys of each genotype are kept.
+        :param output_file: Binary file object to write the selected records
+        :param sample_size: Number of records in the output
+        :return:
+        """
+        target_ratios = self.target_ratios if self.target_ratios is not None else [1.0, 1.0, 1.0]
+        reservoir_sizes = [int(sample_size * ratio / sum(target_ratios)) for ratio in target_ratios]
+        # [genotype] = keys, record numbers and records of the reservoir
+        reservoir_keys = [np.zeros(0) for genotype in GENOTYPES]
+        reservoir_record_numbers = [np.zeros(0, dtype=np.int64) for genotype in GENOTYPES]
+        reservoir_records = [list() for genotype in GENOTYPES]
+
+        genotype_counts = np.zeros(len(GENOTYPES), dtype=np.int64)
+        record_count = 0
+        for chunk, record_starts, record_ends, genotypes in self.read_chunks():
+            genotype_counts += np.bincount(genotypes, minlength=len(GENOTYPES))
+            keys = self.random_state.random_sample(len(genotypes))
+            for genotype in GENOTYPES:
+                reservoir_size = reservoir_sizes[genotype]
+                threshold = reservoir_keys[genotype].max() if len(reservoir_keys[genotype]) == reservoir_size else 1.0
+                candidates = np.nonzero((genotypes == genotype) & (keys < threshold))[0]
+                if reservoir_size == 0 or len(candidates) == 0:
+                    continue
+
+                merged_keys = np.concatenate((reservoir_keys[genotype], keys[candidates]))
+                merged_record_numbers = np.concatenate((reservoir_record_numbers[genotype], candidates + record_count))
+                merged_records = reservoir_records[genotype] + \
+                    [chunk[record_starts[i]:record_ends[i]] for i in candidates.tolist()]
+                kept = np.argpartition(merged_keys, reservoir_size - 1)[:reservoir_size] \
+                    if len(merged_keys) > reservoir_size else np.arange(len(merged_keys))
+                reservoir_keys[genotype] = merged_keys[kept]
+                reservoir_record_numbers[genotype] = merged_record_numbers[kept]
+                reservoir_records[genotype] = [merged_records[i] for i in kept.tolist()]
+            record_count += len(genotypes)
+        self.genotype_counts = genotype_counts.tolist()
+
+        record_numbers = np.concatenate(reservoir_record_numbers)
+        records = reservoir_records[HOM] + reservoir_records[HET] + reservoir_records[HOM_ALT]
+        output_file.write(b''.join([records[i] for i in np.argsort(record_numbers).tolist()]))
 
     def print_bed_stats(self):
         """
         Print the distribution of the bed file
         :return:
         """
+        self.count_genotypes()
+        total_hom, total_het, total_hom_alt = self.genotype_counts
         print("Total records: ")
-        print(self.bed_handler.total_hom, self.bed_handler.total_het, self.bed_handler.total_hom_alt)
-        total_cases = self.bed_handler.total_hom + self.bed_handler.total_het + self.bed_handler.total_hom_alt
-        print("Percent homozygous records:\t", int(self.bed_handler.total_hom * 100 / total_cases))
-        print("Percent Heterozygous records:\t", int(self.bed_handler.total_het * 100 / total_cases))
-        print("Percent Hom-alt records:\t", int(self.bed_handler.total_hom_alt * 100 / total_cases))
+        print(total_hom, total_het, total_hom_alt)
+        total_cases = total_hom + total_het + total_hom_alt
+        print("Percent homozygous records:\t", int(total_hom * 100 / total_cases))
+        print("Percent Heterozygous records:\t", int(total_het * 100 / total_cases))
+        print("Percent Hom-alt records:\t", int(total_hom_alt * 100 / total_cases))
 
 
 if __name__ == '__main__':
@@ -76,18 +203,57 @@ if __name__ == '__main__':
         "--bed",
         type=str,
         required=True,
-        help="bed file path."
+        help="bed file path, '-' to read from standard input."
     )
     parser.add_argument(
         "--stats",
         type=bool,
         help="If true, will print bed file stats."
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed of the random selection."
+    )
+    parser.add_argument(
+        "--ratios",
+        type=str,
+        default=None,
+        help="Ratios of hom, het and hom-alt records in the output. Ex: 2,1,1"
+    )
+    parser.add_argument(
+        "--sample_size",
+        type=int,
+        default=None,
+        help="If set the bed is read once and this many records are selected, required to read standard input."
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default='-',
+        help="Output bed file path, '-' to write to standard output."
+    )
     FLAGS, unparsed = parser.parse_known_args()
-    down_sampler = BedSubsampler(FLAGS.bed)
+    ratios = [float(ratio) for ratio in FLAGS.ratios.split(',')] if FLAGS.ratios is not None else None
+    if ratios is not None and len(ratios) != len(GENOTYPES):
+        sys.stderr.write("INVALID RATIOS: " + FLAGS.ratios + "\n")
+        exit(1)
+    if FLAGS.bed == '-' and FLAGS.sample_size is None and FLAGS.stats is not True:
+        sys.stderr.write("SAMPLE SIZE IS REQUIRED TO READ STANDARD INPUT\n")
+        exit(1)
+
+    down_sampler = BedSubsampler(FLAGS.bed, FLAGS.seed, ratios)
 
     if FLAGS.stats is True:
         down_sampler.print_bed_stats()
     else:
-        down_sampler.downsample_bed_file()
-
+        if FLAGS.output == '-':
+            output_file = open(sys.stdout.fileno(), 'wb', buffering=WRITE_BUFFER_SIZE, closefd=False)
+        else:
+            output_file = open(FLAGS.output, 'wb', buffering=WRITE_BUFFER_SIZE)
+        with output_file:
+            if FLAGS.sample_size is not None:
+                down_sampler.reservoir_downsample_bed_file(output_file, FLAGS.sample_size)
+            else:
+                down_sampler.downsample_bed_file(output_file)
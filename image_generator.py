@@ -0,0 +1,280 @@
+import argparse
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+from modules.Bed2Image_API import Bed2ImageAPI
+from modules.BamHandler import DEFAULT_THREADS
+from modules.BedHandler import BedHandler
+from modules.BedIntervalIndex import BedIntervalIndex
+from modules.FastaHandler import PYSAM_REFERENCE, REFERENCE_MODES
+from modules.ImageCreator import MAX_READS_IN_IMAGE
+from modules.ReadDownsampler import ReadDownsampler
+from modules.TensorStore import TensorStoreWriter
+from modules.TextColor import TextColor
+
+"""
+Generate the images of a bed file before training so training starts against a fully materialized dataset.
+"""
+
+DEFAULT_SHARD_SIZE = 1000
+
+# Bed2ImageAPI object and image directory of a worker process, set up once by init_worker
+worker_api_object = None
+worker_output_dir = None
+
+
+def init_worker(bam_file_path, reference_file_path, reference_mode, bam_threads, output_dir, read_downsampler=None):
+    """
+    Open the bam and fasta handlers of a worker process, tasks only carry the records of their shard
+    :param bam_file_path: Path to the bam file
+    :param reference_file_path: Path to the reference file
+    :param reference_mode: How the fasta handlers read the reference
+    :param bam_threads: Number of BGZF decompression threads of the bam handler
+    :param output_dir: Directory of the tensor store
+    :param read_downsampler: ReadDownsampler that picks the reads of every record, all the reads are used if None
+    :return:
+    """
+    global worker_api_object, worker_output_dir
+    worker_api_object = Bed2ImageAPI(bam_file_path, reference_file_path, reference_mode, bam_threads, read_downsampler)
+    worker_output_dir = output_dir
+
+
+def get_marker_file(output_dir, shard_name):
+    """
+    Return the path of the file that marks a shard as complete
+    :param output_dir: Directory of the tensor store
+    :param shard_name: Name of the shard
+    :return: Path of the marker file
+    """
+    return os.path.abspath(output_dir + shard_name) + ".done"
+
+
+def process_shard(shard):
+    """
+    Generate the images of a shard in a worker process, write the summary of the shard and mark it as complete.
+    Every group of nearby records is its own pileup, the reads shared by neighbouring groups are decoded by each group.
+    :param shard: Shard name and bed records of the shard
+    :return: Shard name, number of images, time spent in seconds
+    """
+    shard_name, shard_records = shard
+    start_time = time.time()
+    api_object = worker_api_object
+    output_dir = worker_output_dir
+
+    summary_string = ''
+    tensor_store_writer = None
+    for bed_records in BedHandler.get_nearby_record_groups(shard_records):
+        file_names = list()
+        for bed_record in bed_records:
+            contig, pos_s, pos_e, ref, alt, genotype = bed_record.rstrip().split('\t')[:6]
+            file_names.append(contig + "_" + pos_s + "_" + alt + "_" + genotype)
+
+        images = api_object.create_images(api_object.bam_handler, api_object.fasta_handler, bed_records,
+                                          None, file_names, api_object.read_downsampler)
+
+        for bed_record, file_name, (img, label, img_shape) in zip(bed_records, file_names, images):
+            if tensor_store_writer is None:
+                tensor_store_writer = TensorStoreWriter(output_dir, shard_name, img_shape)
+            tensor_store_writer.add(file_name, img, label)
+
+            qual, gen_filter, in_confident = bed_record.rstrip().split('\t')[6:9]
+            summary_string += tensor_store_writer.data_file_path + ":" + file_name + "," + str(label) + ',' \
+                + ','.join(map(str, img_shape)) + "," + str(qual) + "," + str(gen_filter) + "," \
+                + str(in_confident) + '\n'
+    tensor_store_writer.close()
+
+    # the summary and then the marker are written with a rename so a crash never leaves a partial shard marked
+    summary_file = os.path.abspath(output_dir + shard_name) + ".csv"
+    with open(summary_file + ".tmp", 'w') as summary_writer:
+        summary_writer.write(summary_string)
+    os.replace(summary_file + ".tmp", summary_file)
+
+    marker_file = get_marker_file(output_dir, shard_name)
+    with open(marker_file + ".tmp", 'w') as marker_writer:
+        marker_writer.write(str(len(shard_records)) + '\n')
+    os.replace(marker_file + ".tmp", marker_file)
+
+    return shard_name, len(shard_records), time.time() - start_time
+
+
+class ImageGenerator:
+    """
+    Splits a bed file into shards of nearby records and generates the images of the shards with a process pool.
+    - Records are split by contig and then into balanced regions of consecutive records.
+    - Images of a shard are saved in a tensor store shard of the same name.
+    - A shard is complete when its marker file exists, complete shards are skipped so a crashed run can be resumed.
+    - Bam and fasta handlers are opened once in every worker process, a task only sends the records of its shard.
+    """
+    def __init__(self, bam_file_path, reference_file_path, bed_file_path, output_dir, shard_size,
+                 reference_mode=PYSAM_REFERENCE, bam_threads=DEFAULT_THREADS, read_downsampler=None):
+        """
+        Initialize an image generator
+        :param bam_file_path: Path to the bam file
+        :param reference_file_path: Path to the reference file
+        :param bed_file_path: Path to the bed file
+        :param output_dir: Directory of the tensor store, the image directory of the DataSetLoader
+        :param shard_size: Maximum number of records in a shard
+        :param reference_mode: How the fasta handlers read the reference
+        :param bam_threads: Number of BGZF decompression threads of every bam handler
+        :param read_downsampler: ReadDownsampler that picks the reads of every record, all the reads are used if None
+        """
+        self.bam_file_path = bam_file_path
+        self.reference_file_path = reference_file_path
+        self.bed_file_path = bed_file_path
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.reference_mode = reference_mode
+        self.bam_threads = bam_threads
+        self.read_downsampler = read_downsampler
+
+    @staticmethod
+    def get_shards(bed_handler, shard_size):
+        """
+        Split bed records by contig and position into shards of balanced size.
+        :param bed_handler: BedHandler object of the bed file
+        :param shard_size: Maximum number of records in a shard
+        :return: List of (shard name, bed records of the shard)
+        """
+        interval_index = BedIntervalIndex(bed_handler)
+        bed_records = bed_handler.get_bed_records()
+
+        shards = list()
+        for contig in interval_index.get_contigs():
+            record_indices = interval_index.get_sorted_record_indices(contig)
+            shard_count = (len(record_indices) + shard_size - 1) // shard_size
+            for i in range(shard_count):
+                shard_records = [bed_records.get_record(record_index) for record_index in
+                                 record_indices[len(record_indices) * i // shard_count:
+                                                len(record_indices) * (i + 1) // shard_count]]
+                shards.append((contig + "_" + str(i + 1) + "_of_" + str(shard_count), shard_records))
+
+        return shards
+
+    def generate_images(self, max_threads):
+        """
+        Generate the images of all the shards that are not complete yet.
+        :param max_threads: Number of processes
+        :return:
+        """
+        shards = self.get_shards(BedHandler(self.bed_file_path, use_cache=True), self.shard_size)
+        remaining_shards = [shard for shard in shards if not os.path.isfile(get_marker_file(self.output_dir, shard[0]))]
+        sys.stderr.write(TextColor.PURPLE + "TOTAL SHARDS: " + str(len(shards)) + " COMPLETE: "
+                         + str(len(shards) - len(remaining_shards)) + "\n" + TextColor.END)
+
+        start_time = time.time()
+        total_images = 0
+        with Pool(processes=max_threads, initializer=init_worker,
+                  initargs=(self.bam_file_path, self.reference_file_path, self.reference_mode, self.bam_threads,
+                            self.output_dir, self.read_downsampler)) as pool:
+            for shard_name, image_count, elapsed in pool.imap_unordered(process_shard, remaining_shards):
+                total_images += image_count
+                sys.stderr.write(TextColor.BLUE + "SHARD " + shard_name + " IMAGES: " + str(image_count)
+                                 + " TIME: " + str(int(elapsed)) + " Secs IMAGES/SEC: "
+                                 + str(round(image_count / max(elapsed, 1e-6), 2)) + "\n" + TextColor.END)
+
+        elapsed = time.time() - start_time
+        sys.stderr.write(TextColor.GREEN + "FINISHED " + str(len(remaining_shards)) + " SHARDS, " + str(total_images)
+                         + " IMAGES IN " + str(int(elapsed)) + " Secs IMAGES/SEC: "
+                         + str(round(total_images / max(elapsed, 1e-6), 2)) + "\n" + TextColor.END)
+
+
+def handle_directory(directory_path):
+    """
+    Create a directory if doesn't exist
+    :param directory_path: path to the directory
+    :return: desired directory name
+    """
+    # if directory has no trailing '/' then add it
+    if directory_path[-1] != '/':
+        directory_path += '/'
+    # if directory doesn't exist then create it
+    if not os.path.exists(directory_path):
+        os.makedirs(directory_path)
+
+    return directory_path
+
+
+if __name__ == '__main__':
+    '''
+    Processes arguments and generates the images of a bed file.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.register("type", "bool", lambda v: v.lower() == "true")
+    parser.add_argument(
+        "--bam",
+        type=str,
+        required=True,
+        help="BAM file containing reads of interest."
+    )
+    parser.add_argument(
+        "--ref",
+        type=str,
+        required=True,
+        help="Reference corresponding to the BAM file."
+    )
+    parser.add_argument(
+        "--bed",
+        type=str,
+        required=True,
+        help="bed file path."
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Image directory, the same directory the training will load the images from."
+    )
+    parser.add_argument(
+        "--max_threads",
+        type=int,
+        default=5,
+        help="Number of processes generating images."
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help="Maximum number of bed records in a shard."
+    )
+    parser.add_argument(
+        "--reference_mode",
+        type=str,
+        default=PYSAM_REFERENCE,
+        choices=REFERENCE_MODES,
+        help="How the reference is read, mmap converts every contig once to a memory mapped file, "
+             "packed keeps every contig in memory at 2 bits per base."
+    )
+    parser.add_argument(
+        "--bam_threads",
+        type=int,
+        default=DEFAULT_THREADS,
+        help="Number of BGZF decompression threads of the bam file in every process."
+    )
+    parser.add_argument(
+        "--downsample",
+        type='bool',
+        default=False,
+        help="If true the reads of a record are a seeded random subset instead of the first reads."
+    )
+    parser.add_argument(
+        "--strand_balanced",
+        type='bool',
+        default=False,
+        help="If true half of the downsampled reads come from each strand."
+    )
+    parser.add_argument(
+        "--downsample_seed",
+        type=int,
+        default=0,
+        help="Seed of the read downsampling."
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.output_dir = handle_directory(FLAGS.output_dir)
+
+    read_downsampler = ReadDownsampler(MAX_READS_IN_IMAGE, FLAGS.downsample_seed, FLAGS.strand_balanced) \
+        if FLAGS.downsample is True else None
+    image_generator = ImageGenerator(FLAGS.bam, FLAGS.ref, FLAGS.bed, FLAGS.output_dir, FLAGS.shard_size,
+                                     FLAGS.reference_mode, FLAGS.bam_threads, read_downsampler)
+    image_generator.generate_images(FLAGS.max_threads)
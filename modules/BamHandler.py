@@ -1,36 +1,203 @@
+import struct
+import time
 import pysam
 
 """
 This class handles bam files using pysam API.
 """
 
+# reads with a mapping quality lower than this are filtered
+DEFAULT_MIN_MAPPING_QUALITY = 6
+# unmapped, secondary, QC fail, duplicate and supplementary reads are filtered
+DEFAULT_EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x400 | 0x800
+DEFAULT_MIN_ALIGNED_LENGTH = 0
+# number of BGZF decompression threads
+DEFAULT_THREADS = 1
+# offset of the BSIZE field in the header of a BGZF block and size of the ISIZE field that ends the block
+BGZF_BLOCK_SIZE_OFFSET = 16
+BGZF_INPUT_SIZE_LENGTH = 4
+
+# pileup settings, the defaults of pysam. The samtools stepper leaves out the reads that are paired but not in a proper
+# pair.
+DEFAULT_PILEUP_MAX_DEPTH = 8000
+DEFAULT_PILEUP_STEPPER = 'samtools'
+DEFAULT_PILEUP_MIN_BASE_QUALITY = 13
+DEFAULT_PILEUP_MIN_MAPPING_QUALITY = 0
+# unmapped, secondary, QC fail and duplicate reads are left out of pileups by the all and samtools steppers
+PILEUP_EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+# pysam corrects the base qualities of overlapping mates only if both mates are fetched, Bed2ImageAPI.create_images
+# renders the records whose mates are split by the group from their own pileup
+DEFAULT_PILEUP_IGNORE_OVERLAPS = True
+
+# reasons a read is filtered
+FLAG_FILTER = 'flag'
+MAPPING_QUALITY_FILTER = 'mapping_quality'
+ALIGNED_LENGTH_FILTER = 'aligned_length'
+
 
 class BamHandler:
     """
     Handles bam files using pysam API
+    - Reads returned by get_reads are filtered by flag, mapping quality and aligned length before any per base work.
+    The filtered reads are counted by the first reason they fail.
+    - get_region_reads streams a whole region with one iterator and records the compressed and decompressed bytes
+    read and the latency of the region. Pileups record no statistics.
+    - Pileups use the max depth, stepper, overlap correction and base and mapping quality filters of the handler. A
+    pileup of a site or a region returns every column of the reads that overlap it unless it's truncated to a window.
     """
-    def __init__(self, bam_file_path):
+    # number of AlignmentFile objects opened by this process
+    open_count = 0
+
+    def __init__(self, bam_file_path, min_mapping_quality=DEFAULT_MIN_MAPPING_QUALITY,
+                 exclude_flags=DEFAULT_EXCLUDE_FLAGS, min_aligned_length=DEFAULT_MIN_ALIGNED_LENGTH,
+                 threads=DEFAULT_THREADS, pileup_max_depth=DEFAULT_PILEUP_MAX_DEPTH,
+                 pileup_stepper=DEFAULT_PILEUP_STEPPER, pileup_min_base_quality=DEFAULT_PILEUP_MIN_BASE_QUALITY,
+                 pileup_min_mapping_quality=DEFAULT_PILEUP_MIN_MAPPING_QUALITY,
+                 pileup_ignore_overlaps=DEFAULT_PILEUP_IGNORE_OVERLAPS):
         """
         create AlignmentFile object given file path to a bam file
         :param bam_file_path: full path to a bam file
+        :param min_mapping_quality: Reads with a lower mapping quality are filtered
+        :param exclude_flags: Reads with any of these flags are filtered
+        :param min_aligned_length: Reads with fewer aligned bases, soft clips excluded, are filtered
+        :param threads: Number of BGZF decompression threads
+        :param pileup_max_depth: Maximum number of reads in a pileup column
+        :param pileup_stepper: pysam stepper of pileups [all, nofilter, samtools]
+        :param pileup_min_base_quality: Bases with a lower quality are left out of pileup columns
+        :param pileup_min_mapping_quality: Reads with a lower mapping quality are left out of pileups
+        :param pileup_ignore_overlaps: If true the base qualities of overlapping mates are corrected by pysam
         """
         self.bam_file_path = bam_file_path
+        self.min_mapping_quality = min_mapping_quality
+        self.exclude_flags = exclude_flags
+        self.min_aligned_length = min_aligned_length
+        self.pileup_max_depth = pileup_max_depth
+        self.pileup_stepper = pileup_stepper
+        self.pileup_min_base_quality = pileup_min_base_quality
+        self.pileup_min_mapping_quality = pileup_min_mapping_quality
+        self.pileup_ignore_overlaps = pileup_ignore_overlaps
+
+        # [reason] = number of reads filtered for that reason
+        self.filtered_read_counts = {FLAG_FILTER: 0, MAPPING_QUALITY_FILTER: 0, ALIGNED_LENGTH_FILTER: 0}
+        self.passed_read_count = 0
+        # (chromosome, start, stop, reads, compressed bytes, uncompressed bytes, seconds to the first read, seconds) of
+        # streamed regions
+        self.region_statistics = list()
         try:
-            self.bamFile = pysam.AlignmentFile(self.bam_file_path, "rb")
+            self.bamFile = pysam.AlignmentFile(self.bam_file_path, "rb", threads=threads)
         except:
             raise IOError("BAM FILE READ ERROR")
+        BamHandler.open_count += 1
+
+    def get_pileup(self, contig, start, stop, truncate=False):
+        """
+        Return a AlignmentFile.pileup object with the pileup settings of the handler
+        :param contig: Contig [ex. chr3]
+        :param start: Region start
+        :param stop: Region end
+        :param truncate: If true only the columns in the region are returned
+        :return: pysam.AlignmentFile.pileup object
+        """
+        return self.bamFile.pileup(contig, start, stop, truncate=truncate, max_depth=self.pileup_max_depth,
+                                   stepper=self.pileup_stepper, min_base_quality=self.pileup_min_base_quality,
+                                   min_mapping_quality=self.pileup_min_mapping_quality,
+                                   ignore_overlaps=self.pileup_ignore_overlaps)
 
-    def get_pileupcolumns_aligned_to_a_site(self, contig, pos):
+    def get_pileupcolumns_aligned_to_a_site(self, contig, pos, window_width=None, site_length=1, alignment_keys=None):
         """
         Return a AlignmentFile.pileup object given a site
         :param contig: Contig [ex. chr3]
         :param pos: Position [ex 100001]
-        :return: pysam.AlignmentFile.pileup object
+        :param window_width: If set, the columns are truncated to window_width positions from the first column with an
+        aligned read, the columns of the site are always returned
+        :param site_length: Number of positions of the site
+        :param alignment_keys: If set, only the reads with these alignment keys count as aligned reads of a column
+        :return: pysam.AlignmentFile.pileup object or generator of its columns
         """
         # get pileup columns
-        pileup_columns = self.bamFile.pileup(contig, pos, pos+1)
-        # return pileup columns
-        return pileup_columns
+        pileup_columns = self.get_pileup(contig, pos, pos+1)
+        if window_width is None:
+            return pileup_columns
+        return self.get_site_window_columns(pileup_columns, pos + site_length, window_width, alignment_keys)
+
+    @staticmethod
+    def get_site_window_columns(pileup_columns, site_end, window_width, alignment_keys=None):
+        """
+        Return the pileup columns of a site from the first column with an aligned read up to window_width positions
+        from it or up to the end of the site. The rest of the pileup is not read.
+        :param pileup_columns: pysam.AlignmentFile.pileup object of a site
+        :param site_end: End of the site
+        :param window_width: Number of positions of the window
+        :param alignment_keys: If set, only the reads with these alignment keys count as aligned reads of a column
+        :return: Generator of pileup columns
+        """
+        window_end = None
+        for pileup_column in pileup_columns:
+            if window_end is None:
+                if alignment_keys is None:
+                    is_aligned = pileup_column.get_num_aligned() > 0
+                else:
+                    is_aligned = any(BamHandler.get_alignment_key(pileup_read.alignment) in alignment_keys
+                                     for pileup_read in pileup_column.pileups)
+                if is_aligned:
+                    window_end = max(site_end, pileup_column.reference_pos + window_width)
+            elif pileup_column.reference_pos >= window_end:
+                break
+            yield pileup_column
+
+    def get_pileupcolumns_aligned_to_a_region(self, contig, start, stop, truncate=False, window_end=None):
+        """
+        Return a AlignmentFile.pileup object given a region
+        :param contig: Contig [ex. chr3]
+        :param start: Region start
+        :param stop: Region end
+        :param truncate: If true only the columns in the region are returned
+        :param window_end: If set, the columns at or after this position are not returned and not read
+        :return: pysam.AlignmentFile.pileup object or generator of its columns
+        """
+        pileup_columns = self.get_pileup(contig, start, stop, truncate)
+        if window_end is None:
+            return pileup_columns
+        return self.get_window_columns(pileup_columns, window_end)
+
+    @staticmethod
+    def get_window_columns(pileup_columns, window_end):
+        """
+        Return the pileup columns before a position, the rest of the pileup is not read
+        :param pileup_columns: pysam.AlignmentFile.pileup object
+        :param window_end: End of the window
+        :return: Generator of pileup columns
+        """
+        for pileup_column in pileup_columns:
+            if pileup_column.reference_pos >= window_end:
+                break
+            yield pileup_column
+
+    @staticmethod
+    def get_alignment_key(alignment):
+        """
+        Return the key of an alignment, the same record gets the same key from a fetch and from a pileup
+        :param alignment: pysam AlignedSegment object
+        :return: (read name, flag, alignment start)
+        """
+        return alignment.query_name, alignment.flag, alignment.reference_start
+
+    def get_pileup_reads(self, contig, start, stop):
+        """
+        Return the reads a pileup of a region is built from, the reads are filtered the way the pileup stepper of the
+        handler filters them. The read filters of get_reads are not applied.
+        :param contig: Contig [ex. chr3]
+        :param start: Region start
+        :param stop: Region end
+        :return: Generator of reads
+        """
+        for read in self.bamFile.fetch(contig, start, stop):
+            if self.pileup_stepper != 'nofilter':
+                if read.flag & PILEUP_EXCLUDE_FLAGS or read.mapping_quality < self.pileup_min_mapping_quality:
+                    continue
+                if self.pileup_stepper == 'samtools' and read.is_paired and not read.is_proper_pair:
+                    continue
+            yield read
 
     def get_reads(self, chromosome_name, start, stop):
         """
@@ -40,5 +207,103 @@ class BamHandler:
         :param stop: Site end in the chromosome
         :return: Reads that align to that site
         """
-        return self.bamFile.fetch(chromosome_name, start, stop)
+        reads = self.bamFile.fetch(chromosome_name, start, stop)
+        if self.min_mapping_quality <= 0 and self.exclude_flags == 0 and self.min_aligned_length <= 0:
+            return self.count_reads(reads)
+        return self.filter_reads(reads)
+
+    def count_reads(self, reads):
+        """
+        Count the reads as passed without checking them, used when every filter is off
+        :param reads: Iterator of reads
+        :return: Generator of the reads
+        """
+        for read in reads:
+            self.passed_read_count += 1
+            yield read
+
+    def get_region_reads(self, chromosome_name, start, stop):
+        """
+        Stream the reads of a whole region with one sequential iterator. The statistics of the region are recorded when
+        the iteration ends or the iterator is closed, the bytes are counted from the BGZF block of the first read.
+        Pileups don't go through this method and get no statistics.
+        :param chromosome_name: Chromosome name. Ex: chr3
+        :param start: Region start in the chromosome
+        :param stop: Region end in the chromosome, None to stream to the end of the chromosome
+        :return: Generator of the reads that pass the filters
+        """
+        start_time = time.time()
+        first_read_latency = None
+        read_count = 0
+        # virtual offset of the first read
+        start_offset = None
+        try:
+            for read in self.get_reads(chromosome_name, start, stop):
+                if start_offset is None:
+                    first_read_latency = time.time() - start_time
+                    start_offset = self.bamFile.tell()
+                read_count += 1
+                yield read
+        finally:
+            compressed_bytes = 0
+            uncompressed_bytes = 0
+            if start_offset is not None:
+                end_offset = self.bamFile.tell()
+                compressed_bytes = (end_offset >> 16) - (start_offset >> 16)
+                uncompressed_bytes = self.get_uncompressed_bytes(start_offset, end_offset)
+            self.region_statistics.append((chromosome_name, start, stop, read_count, compressed_bytes,
+                                           uncompressed_bytes, first_read_latency, time.time() - start_time))
+
+    def get_uncompressed_bytes(self, start_offset, end_offset):
+        """
+        Count the uncompressed bytes between two virtual offsets of the bam file. The uncompressed size of every BGZF
+        block in between is read from the end of the block, no block is decompressed again.
+        :param start_offset: Virtual offset where the count starts
+        :param end_offset: Virtual offset where the count ends
+        :return: Number of uncompressed bytes
+        """
+        uncompressed_bytes = (end_offset & 0xFFFF) - (start_offset & 0xFFFF)
+        block_offset = start_offset >> 16
+        with open(self.bam_file_path, 'rb') as bam_file:
+            while block_offset < end_offset >> 16:
+                bam_file.seek(block_offset + BGZF_BLOCK_SIZE_OFFSET)
+                block_size = struct.unpack('<H', bam_file.read(2))[0] + 1
+                bam_file.seek(block_offset + block_size - BGZF_INPUT_SIZE_LENGTH)
+                uncompressed_bytes += struct.unpack('<I', bam_file.read(BGZF_INPUT_SIZE_LENGTH))[0]
+                block_offset += block_size
+        return uncompressed_bytes
+
+    def pop_region_statistics(self):
+        """
+        Return the statistics of the regions streamed since the last call and clear them
+        :return: List of (chromosome, start, stop, reads, compressed bytes, uncompressed bytes, seconds to the first
+        read, seconds)
+        """
+        region_statistics = self.region_statistics
+        self.region_statistics = list()
+        return region_statistics
+
+    def filter_reads(self, reads):
+        """
+        Filter reads by flag, mapping quality and aligned length and count the filtered reads
+        :param reads: Iterator of reads
+        :return: Generator of the reads that pass the filters
+        """
+        for read in reads:
+            if read.flag & self.exclude_flags:
+                self.filtered_read_counts[FLAG_FILTER] += 1
+            elif read.mapping_quality < self.min_mapping_quality:
+                self.filtered_read_counts[MAPPING_QUALITY_FILTER] += 1
+            elif read.query_alignment_length < self.min_aligned_length:
+                self.filtered_read_counts[ALIGNED_LENGTH_FILTER] += 1
+            else:
+                self.passed_read_count += 1
+                yield read
+
+    def get_read_filter_statistics(self):
+        """
+        Get the number of reads that passed the filters and the number of reads filtered for each reason
+        :return: Passed read count, dictionary of filtered read counts by reason
+        """
+        return self.passed_read_count, dict(self.filtered_read_counts)
 
@@ -1,24 +1,28 @@
-from modules.ImageCreator import ImageCreator
-from modules.BamHandler import BamHandler
-from modules.FastaHandler import FastaHandler
+from modules.ImageCreator import ImageCreator, IMAGE_WIDTH, MAP_QUALITY_FILTER
+from modules.BamHandler import BamHandler, DEFAULT_THREADS
+from modules.FastaHandler import FastaHandler, PYSAM_REFERENCE
 import os
 
 class Bed2ImageAPI:
     """
     Works as a main class and handles user interaction with different modules.
     """
-    def __init__(self, bam_file_path, reference_file_path):
+    def __init__(self, bam_file_path, reference_file_path, reference_mode=PYSAM_REFERENCE, bam_threads=DEFAULT_THREADS,
+                 read_downsampler=None):
         # --- initialize handlers ---
-        self.bam_handler = BamHandler(bam_file_path)
-        self.fasta_handler = FastaHandler(reference_file_path)
+        self.bam_handler = BamHandler(bam_file_path, threads=bam_threads)
+        self.fasta_handler = FastaHandler(reference_file_path, reference_mode)
+        # picks the reads of deep sites, given to create_image and create_images by the callers
+        self.read_downsampler = read_downsampler
 
     @staticmethod
-    def create_image(bam_handler, fasta_handler, bed_record, output_dir, file_name):
+    def create_image(bam_handler, fasta_handler, bed_record, output_dir, file_name, read_downsampler=None):
         """
         Create an image from a bed record
         :param bam_handler: Handles bam file
         :param fasta_handler: Handles fasta file
         :param bed_record: Bed record
+        :param read_downsampler: ReadDownsampler that picks the reads of the record, all the reads are used if None
         :return: Imagearray, label
         """
         chromosome_name, start_position, end_position, ref, alts, genotype, qual, g_filter, in_conf = \
@@ -26,10 +30,122 @@ class Bed2ImageAPI:
         start_position = int(start_position)
         genotype = int(genotype)
 
-        pileups = bam_handler.get_pileupcolumns_aligned_to_a_site(chromosome_name, start_position)
-        image_creator = ImageCreator(fasta_handler, pileups, chromosome_name, start_position, genotype, alts)
+        image_creator = Bed2ImageAPI.get_site_image_creator(bam_handler, fasta_handler, chromosome_name,
+                                                            start_position, ref, alts, genotype, read_downsampler)
 
         image_array, image_shape = image_creator.create_image(start_position, ref, alts)
         image_creator.save_image_as_png(image_array, output_dir, file_name)
 
-        return image_array, genotype, image_shape
\ No newline at end of file
+        return image_array, genotype, image_shape
+
+    @staticmethod
+    def pick_site_reads(read_downsampler, reads, chromosome_name, position):
+        """
+        Pick the reads of a site among the reads of a pileup, only the reads that overlap the site and pass the mapping
+        quality filter of the image can be picked
+        :param read_downsampler: ReadDownsampler that picks the reads
+        :param reads: Reads of the pileup in fetch order
+        :param chromosome_name: Chromosome name
+        :param position: Position of the site
+        :return: Set of the alignment keys of the picked reads, None if no read can be picked
+        """
+        site_reads = (read for read in reads if read.reference_start <= position < read.reference_end and
+                      read.mapping_quality >= MAP_QUALITY_FILTER)
+        picked_reads = read_downsampler.downsample_reads(site_reads, chromosome_name, position)
+        if not picked_reads:
+            return None
+        return set(BamHandler.get_alignment_key(read) for read in picked_reads)
+
+    @staticmethod
+    def get_site_image_creator(bam_handler, fasta_handler, chromosome_name, start_position, ref, alts, genotype,
+                               read_downsampler=None):
+        """
+        Create an ImageCreator from the pileup of a site
+        :param bam_handler: Handles bam file
+        :param fasta_handler: Handles fasta file
+        :param chromosome_name: Chromosome name
+        :param start_position: Start position of the site
+        :param ref: Ref allele
+        :param alts: Alternate alleles
+        :param genotype: Genotype
+        :param read_downsampler: ReadDownsampler that picks the reads of the site, all the reads are used if None
+        :return: ImageCreator object
+        """
+        alignment_keys = None
+        if read_downsampler is not None:
+            reads = bam_handler.get_pileup_reads(chromosome_name, start_position, start_position + 1)
+            alignment_keys = Bed2ImageAPI.pick_site_reads(read_downsampler, reads, chromosome_name, start_position)
+
+        # only the columns the image can show are read, the reads that are not picked are not decoded
+        pileups = bam_handler.get_pileupcolumns_aligned_to_a_site(chromosome_name, start_position, IMAGE_WIDTH,
+                                                                  len(ref), alignment_keys)
+        return ImageCreator(fasta_handler, pileups, chromosome_name, start_position, genotype, alts, alignment_keys)
+
+    @staticmethod
+    def create_images(bam_handler, fasta_handler, bed_records, output_dir, file_names, read_downsampler=None):
+        """
+        Create images from a group of nearby bed records of the same chromosome sorted by position. The pileup of the
+        group is fetched and processed once and the image of every record is created from it. The image of a record
+        starts at or before the record, so the columns after the last record by the image width or more and after the
+        ref alleles are not read. A record with a read whose overlapping mate is in the group pileup but doesn't overlap
+        the record is created from its own pileup, the overlap correction of the group pileup would change the base
+        qualities of that read.
+        With a downsampler the reads of every record are picked from one fetch of the group, only the reads picked for
+        any record are decoded and the image of a record only has its own picked reads. A record without reads to pick
+        is created from its own pileup.
+        :param bam_handler: Handles bam file
+        :param fasta_handler: Handles fasta file
+        :param bed_records: Bed records of the group
+        :param output_dir: Directory to save the images, images are not saved if None
+        :param file_names: File name of the image of each bed record
+        :param read_downsampler: ReadDownsampler that picks the reads of each record, all the reads are used if None
+        :return: List of (Imagearray, label, image shape) of each bed record
+        """
+        records = [tuple(bed_record.rstrip().split('\t')) for bed_record in bed_records]
+        chromosome_name = records[0][0]
+        group_start = min(int(record[1]) for record in records)
+        group_end = max(int(record[1]) for record in records) + 1
+        window_end = max(max(int(record[1]) + len(record[3]) for record in records), group_end - 1 + IMAGE_WIDTH)
+
+        # [record index] = alignment keys of the reads picked for the record
+        record_alignment_keys = [None] * len(records)
+        alignment_keys = None
+        read_spans_of_name = None
+        if read_downsampler is not None:
+            reads = list(bam_handler.get_pileup_reads(chromosome_name, group_start, group_end))
+            record_alignment_keys = [Bed2ImageAPI.pick_site_reads(read_downsampler, reads, chromosome_name,
+                                                                  int(record[1])) for record in records]
+            alignment_keys = set().union(*[keys for keys in record_alignment_keys if keys is not None])
+            read_spans_of_name = {}
+            for read in reads:
+                read_spans_of_name.setdefault(read.query_name, []).append((read.reference_start, read.reference_end))
+
+        pileups = bam_handler.get_pileupcolumns_aligned_to_a_region(chromosome_name, group_start, group_end,
+                                                                    window_end=window_end)
+        image_creator = None
+        images = list()
+        for record, file_name, record_keys in zip(records, file_names, record_alignment_keys):
+            chromosome_name, start_position, end_position, ref, alts, genotype, qual, g_filter, in_conf = record
+            start_position = int(start_position)
+            genotype = int(genotype)
+
+            if image_creator is None:
+                image_creator = ImageCreator(fasta_handler, pileups, chromosome_name, start_position, genotype, alts,
+                                             alignment_keys)
+            image_creator.set_candidate(start_position, genotype, alts, record_keys)
+
+            record_image_creator = image_creator
+            if (read_downsampler is not None and record_keys is None) or \
+                    len(image_creator.candidate_read_indices) == 0 or \
+                    (bam_handler.pileup_ignore_overlaps and
+                     image_creator.has_mate_outside_candidate(read_spans_of_name)):
+                record_image_creator = Bed2ImageAPI.get_site_image_creator(bam_handler, fasta_handler, chromosome_name,
+                                                                           start_position, ref, alts, genotype,
+                                                                           read_downsampler)
+
+            image_array, image_shape = record_image_creator.create_image(start_position, ref, alts)
+            if output_dir is not None:
+                record_image_creator.save_image_as_png(image_array, output_dir, file_name)
+            images.append((image_array, genotype, image_shape))
+
+        return images
@@ -1,99 +1,199 @@
 import os
 import sys
+import numpy as np
+from modules.TextColor import TextColor
+from modules.BedLineIndex import BedLineIndex
 
 SNP = 0
 IN = 1
+DEFAULT_GROUP_SPAN = 1000
+CACHE_FILE_EXTENSION = ".columns.npz"
 
 
 class BedHandler:
     """
-    Bed file interface that converts the bed file to a dictionary.
+    Bed file interface that converts the bed file to columns.
+    - Contig, start, end, genotype and allele type of the records are kept in numpy arrays in file order.
+    - Ref and alt alleles are interned, the arrays keep the index of the allele string.
+    - Columns can be cached in a binary file next to the bed file that is loaded instead of parsing the bed again.
+    - Lines of the bed file are only indexed when a caller asks for them, a cache hit doesn't read the bed file.
     """
-    def __init__(self, bed_file_path):
+    def __init__(self, bed_file_path, use_cache=False):
         """
         Initialize BedHandler object
         :param bed_file_path: Path to a bed file.
+        :param use_cache: If true the columns are loaded from the cache file if it's up to date, else the cache file is
+        written after the bed file is parsed
         """
         if not os.path.isfile(bed_file_path):
             sys.stderr.write("INVALID BED FILE PATH")
             exit(1)
         self.file_path = bed_file_path
-        self.all_bed_records = list()
-
-        # dictionaries to convert the bed file to dictionaries
-        self.bed_dictionary = {}
-        self.alt_dictionary = {}
+        self.cache_file_path = bed_file_path + CACHE_FILE_EXTENSION
+        # line index of the bed file, built on first access
+        self.bed_records = None
+
+        # columns of the records
+        self.contig_names = list()
+        self.allele_strings = list()
+        self.contig_ids = None
+        self.start_positions = None
+        self.end_positions = None
+        self.genotypes = None
+        self.allele_types = None
+        self.ref_allele_ids = None
+        self.alt_allele_ids = None
 
         # genotype counts
         self.total_hom = 0
         self.total_het = 0
         self.total_hom_alt = 0
 
-        # convert the bed file to a dictionary
-        self.convert_bed_to_dictionary()
+        if use_cache is False or self.load_cache() is False:
+            self.convert_bed_to_columns()
+            if use_cache is True:
+                self.save_cache()
+        self.update_genotype_counts()
 
-    def initialize_dictionary(self, chr, start_pos, end_pos):
+    def get_bed_records(self):
         """
-        Initialize the dictionaries.
-        :param chr: Chromosome name
-        :param start_pos: Start position
-        :param end_pos: End position
-        :return:
+        Return the lines of the bed file, index the bed file if not indexed yet
+        :return: BedLineIndex of the bed file
         """
-        if chr not in self.bed_dictionary.keys():
-            self.bed_dictionary[chr] = {}
-
-        for pos in range(start_pos, end_pos):
-            if pos not in self.bed_dictionary[chr].keys():
-                self.bed_dictionary[chr][pos] = {}
-                self.bed_dictionary[chr][pos][SNP] = list()
-                self.bed_dictionary[chr][pos][IN] = list()
-            if pos not in self.alt_dictionary.keys():
-                self.alt_dictionary[pos] = list()
-
-    def _update_genotype_count(self, genotype):
-        if genotype == 0:
-            self.total_hom += 1
-        elif genotype == 1:
-            self.total_het += 1
-        elif genotype == 2:
-            self.total_hom_alt += 1
-
-    def add_record_to_dictionary(self, record):
-        """
-        Add a record to the dictionary.
-        :param record: A bed file record
+        if self.bed_records is None:
+            self.bed_records = BedLineIndex(self.file_path)
+        return self.bed_records
+
+    def convert_bed_to_columns(self):
+        """
+        Convert the bed records to columns in one pass.
         :return:
         """
-        chr, pos_start, pos_end, ref, alt, genotype = record[:6]
-
-        self._update_genotype_count(int(genotype))
-
-        pos_start = int(pos_start)
-        pos_end = int(pos_end) + 1
-        genotype = int(genotype)
-
-        self.initialize_dictionary(chr, pos_start, pos_end)
-        for pos in range(pos_start, pos_end):
-            # if the alt is already in the dictionary don't add it again.
-            if alt in self.alt_dictionary[pos]:
-                continue
-            if len(ref) == len(alt):
-                self.bed_dictionary[chr][pos][SNP].append((ref, alt, genotype))
-            else:
-                self.bed_dictionary[chr][pos][IN].append((ref, alt, genotype))
-
-            self.alt_dictionary[pos].append(alt)
+        bed_records = self.get_bed_records()
+        record_count = len(bed_records)
+        self.contig_ids = np.zeros(record_count, dtype=np.int32)
+        self.start_positions = np.zeros(record_count, dtype=np.int64)
+        self.end_positions = np.zeros(record_count, dtype=np.int64)
+        self.genotypes = np.zeros(record_count, dtype=np.int8)
+        self.allele_types = np.zeros(record_count, dtype=np.int8)
+        self.ref_allele_ids = np.zeros(record_count, dtype=np.int32)
+        self.alt_allele_ids = np.zeros(record_count, dtype=np.int32)
+
+        contig_id_of_name = {}
+        allele_id_of_string = {}
+        for i, record in enumerate(bed_records):
+            chr, pos_start, pos_end, ref, alt, genotype = record.rstrip().split('\t')[:6]
+
+            if chr not in contig_id_of_name:
+                contig_id_of_name[chr] = len(self.contig_names)
+                self.contig_names.append(chr)
+            if ref not in allele_id_of_string:
+                allele_id_of_string[ref] = len(self.allele_strings)
+                self.allele_strings.append(ref)
+            if alt not in allele_id_of_string:
+                allele_id_of_string[alt] = len(self.allele_strings)
+                self.allele_strings.append(alt)
+
+            self.contig_ids[i] = contig_id_of_name[chr]
+            self.start_positions[i] = int(pos_start)
+            self.end_positions[i] = int(pos_end)
+            self.genotypes[i] = int(genotype)
+            self.allele_types[i] = SNP if len(ref) == len(alt) else IN
+            self.ref_allele_ids[i] = allele_id_of_string[ref]
+            self.alt_allele_ids[i] = allele_id_of_string[alt]
+
+    def get_bed_file_stamp(self):
+        """
+        Return the size and modification time of the bed file to check if a cache file is up to date
+        :return: Array of size and modification time in nanoseconds
+        """
+        bed_file_stat = os.stat(self.file_path)
+        return np.array([bed_file_stat.st_size, bed_file_stat.st_mtime_ns], dtype=np.int64)
 
-    def convert_bed_to_dictionary(self):
+    def load_cache(self):
         """
-        Convert a bed file to a dictionary.
+        Load the columns from the cache file.
+        :return: False if the cache file doesn't exist or is out of date
+        """
+        if not os.path.isfile(self.cache_file_path):
+            return False
+        with np.load(self.cache_file_path) as cache:
+            if not np.array_equal(cache['bed_file_stamp'], self.get_bed_file_stamp()):
+                return False
+            self.contig_names = cache['contig_names'].tolist()
+            self.allele_strings = cache['allele_strings'].tolist()
+            self.contig_ids = cache['contig_ids']
+            self.start_positions = cache['start_positions']
+            self.end_positions = cache['end_positions']
+            self.genotypes = cache['genotypes']
+            self.allele_types = cache['allele_types']
+            self.ref_allele_ids = cache['ref_allele_ids']
+            self.alt_allele_ids = cache['alt_allele_ids']
+        return True
+
+    def save_cache(self):
+        """
+        Save the columns to the cache file, the file is written with a temporary name and renamed.
+        :return:
+        """
+        try:
+            with open(self.cache_file_path + ".tmp", 'wb') as cache_file:
+                np.savez(cache_file,
+                         bed_file_stamp=self.get_bed_file_stamp(),
+                         contig_names=np.array(self.contig_names, dtype=np.str_),
+                         allele_strings=np.array(self.allele_strings, dtype=np.str_),
+                         contig_ids=self.contig_ids,
+                         start_positions=self.start_positions,
+                         end_positions=self.end_positions,
+                         genotypes=self.genotypes,
+                         allele_types=self.allele_types,
+                         ref_allele_ids=self.ref_allele_ids,
+                         alt_allele_ids=self.alt_allele_ids)
+            os.replace(self.cache_file_path + ".tmp", self.cache_file_path)
+        except OSError:
+            sys.stderr.write(TextColor.YELLOW + "WARN: COULD NOT WRITE BED CACHE FILE: " + self.cache_file_path
+                             + "\n" + TextColor.END)
+
+    def update_genotype_counts(self):
+        """
+        Count the records of each genotype.
         :return:
         """
-        with open(self.file_path) as f:
-            self.all_bed_records = f.readlines()
+        genotype_counts = np.bincount(self.genotypes, minlength=3)
+        self.total_hom = int(genotype_counts[0])
+        self.total_het = int(genotype_counts[1])
+        self.total_hom_alt = int(genotype_counts[2])
 
-        for record in self.all_bed_records:
-            if record.rstrip() is None:
-                continue
-            self.add_record_to_dictionary(tuple(record.rstrip().split('\t')))
+    def get_record(self, index):
+        """
+        Get the fields of a record from the columns.
+        :param index: Index of the record
+        :return: Chromosome name, start position, end position, ref, alt, genotype
+        """
+        return self.contig_names[self.contig_ids[index]], int(self.start_positions[index]), \
+            int(self.end_positions[index]), self.allele_strings[self.ref_allele_ids[index]], \
+            self.allele_strings[self.alt_allele_ids[index]], int(self.genotypes[index])
+
+    @staticmethod
+    def get_nearby_record_groups(bed_records, max_group_span=DEFAULT_GROUP_SPAN):
+        """
+        Group consecutive bed records of the same chromosome that start within a span of the first record of the
+        group. Records of a sorted bed file end up in as few groups as possible.
+        :param bed_records: List of bed records
+        :param max_group_span: Maximum distance between the start of the first and the last record of a group
+        :return: List of groups, each group is a list of bed records
+        """
+        groups = list()
+        group_chromosome = None
+        group_start = None
+        for record in bed_records:
+            chromosome_name, start_position = record.rstrip().split('\t')[:2]
+            start_position = int(start_position)
+            if chromosome_name != group_chromosome or \
+                    not group_start <= start_position <= group_start + max_group_span:
+                groups.append(list())
+                group_chromosome = chromosome_name
+                group_start = start_position
+            groups[-1].append(record)
+
+        return groups
@@ -0,0 +1,107 @@
+import numpy as np
+
+"""
+Answers region queries over the records of a bed file with binary search on sorted intervals.
+"""
+
+
+class BedIntervalIndex:
+    """
+    Sorted interval index of the records of a BedHandler.
+    - Records of every contig are sorted by start position, the index keeps their starts, ends and record indices.
+    - The running maximum of the ends bounds how far left an overlapping record can start, so an overlap query is two
+    binary searches and a scan of the records in between.
+    - Record ends are inclusive, the same as the bed records. Query regions are half open [start, stop).
+    """
+    def __init__(self, bed_handler):
+        """
+        Build the index from the columns of a bed handler
+        :param bed_handler: BedHandler object
+        """
+        # [contig name] = sorted record indices, starts, ends, running maximum of ends and the record of that maximum
+        self.contig_intervals = {}
+
+        order = np.lexsort((bed_handler.start_positions, bed_handler.contig_ids))
+        sorted_contig_ids = bed_handler.contig_ids[order]
+        contig_bounds = np.searchsorted(sorted_contig_ids, np.arange(len(bed_handler.contig_names) + 1))
+        for contig_id, contig_name in enumerate(bed_handler.contig_names):
+            record_indices = order[contig_bounds[contig_id]:contig_bounds[contig_id + 1]]
+            starts = bed_handler.start_positions[record_indices]
+            ends = bed_handler.end_positions[record_indices]
+            max_ends = np.maximum.accumulate(ends)
+            # position in the sorted order of the record with the running maximum end
+            max_end_positions = np.maximum.accumulate(np.where(ends == max_ends, np.arange(len(ends)), 0))
+            self.contig_intervals[contig_name] = (record_indices, starts, ends, max_ends, max_end_positions)
+
+    def get_contigs(self):
+        """
+        Get the names of the contigs that have records
+        :return: List of contig names
+        """
+        return list(self.contig_intervals.keys())
+
+    def get_sorted_record_indices(self, contig):
+        """
+        Get the records of a contig sorted by start position
+        :param contig: Contig name
+        :return: Array of record indices
+        """
+        if contig not in self.contig_intervals:
+            return np.zeros(0, dtype=np.int64)
+        return self.contig_intervals[contig][0]
+
+    def query(self, contig, start, stop):
+        """
+        Find the records that overlap a region
+        :param contig: Contig name
+        :param start: Region start
+        :param stop: Region end, exclusive
+        :return: Array of record indices sorted by start position
+        """
+        if contig not in self.contig_intervals:
+            return np.zeros(0, dtype=np.int64)
+        record_indices, starts, ends, max_ends, max_end_positions = self.contig_intervals[contig]
+
+        # records after hi start after the region, records before lo end before the region
+        hi = np.searchsorted(starts, stop, side='left')
+        lo = np.searchsorted(max_ends[:hi], start, side='left')
+        overlapping = np.nonzero(ends[lo:hi] >= start)[0] + lo
+        return record_indices[overlapping]
+
+    def get_nearest_record(self, contig, position):
+        """
+        Find the record that is nearest to a position, a record that overlaps the position has distance 0
+        :param contig: Contig name
+        :param position: Genomic position
+        :return: Record index and distance, None and None if the contig has no records
+        """
+        if contig not in self.contig_intervals:
+            return None, None
+        record_indices, starts, ends, max_ends, max_end_positions = self.contig_intervals[contig]
+
+        nearest_record = None
+        nearest_distance = None
+        i = np.searchsorted(starts, position, side='right')
+        # of the records that start at or before the position, the one that ends last is the nearest
+        if i > 0:
+            nearest_record = record_indices[max_end_positions[i - 1]]
+            nearest_distance = max(0, position - int(max_ends[i - 1]))
+        # the first record that starts after the position
+        if i < len(starts) and (nearest_distance is None or starts[i] - position < nearest_distance):
+            nearest_record = record_indices[i]
+            nearest_distance = int(starts[i]) - position
+
+        return int(nearest_record), nearest_distance
+
+    def count_records(self, contig, region_starts, region_stops):
+        """
+        Count the records that start in each of a set of regions
+        :param contig: Contig name
+        :param region_starts: Array of region starts
+        :param region_stops: Array of region ends, exclusive
+        :return: Array of record counts of the regions
+        """
+        if contig not in self.contig_intervals:
+            return np.zeros(len(region_starts), dtype=np.int64)
+        starts = self.contig_intervals[contig][1]
+        return np.searchsorted(starts, region_stops, side='left') - np.searchsorted(starts, region_starts, side='left')
@@ -0,0 +1,124 @@
+import mmap
+import os
+import sys
+import numpy as np
+from modules.TextColor import TextColor
+
+"""
+Reads the records of a bed file by record index without keeping the lines of the file in memory.
+"""
+
+INDEX_FILE_EXTENSION = ".offsets.npy"
+READ_CHUNK_SIZE = 1 << 24
+
+
+class BedLineIndex:
+    """
+    Byte offsets of the lines of a bed file.
+    - The offsets are saved next to the bed file and memory mapped on later runs.
+    - A record is read from a memory map of the bed file, the maps are opened in every process that reads records.
+    """
+    def __init__(self, bed_file_path):
+        """
+        Load the offsets of the lines of a bed file, build and save them if the saved offsets are out of date
+        :param bed_file_path: Path to a bed file
+        """
+        if not os.path.isfile(bed_file_path):
+            sys.stderr.write("INVALID BED FILE PATH")
+            exit(1)
+        self.file_path = bed_file_path
+        self.index_file_path = bed_file_path + INDEX_FILE_EXTENSION
+
+        # offsets[i] is the start of line i, the last value is the size of the file
+        self.offsets = self.load_offsets()
+        if self.offsets is None:
+            self.offsets = self.build_offsets()
+            self.save_offsets()
+
+        # memory map of the bed file, opened on first access
+        self.bed_file_map = None
+        self.bed_file_map_pid = None
+
+    def load_offsets(self):
+        """
+        Load the saved offsets if they are newer than the bed file and cover the whole file
+        :return: Array of offsets, None if the saved offsets are missing or out of date
+        """
+        if not os.path.isfile(self.index_file_path):
+            return None
+        bed_file_stat = os.stat(self.file_path)
+        if os.stat(self.index_file_path).st_mtime_ns < bed_file_stat.st_mtime_ns:
+            return None
+        offsets = np.load(self.index_file_path, mmap_mode='r')
+        if len(offsets) == 0 or offsets[-1] != bed_file_stat.st_size:
+            return None
+        return offsets
+
+    def build_offsets(self):
+        """
+        Find the start of every line by reading the bed file in chunks
+        :return: Array of offsets
+        """
+        line_ends = list()
+        file_size = 0
+        with open(self.file_path, 'rb') as bed_file:
+            while True:
+                chunk = bed_file.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                line_ends.append(np.nonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))[0] + file_size + 1)
+                file_size += len(chunk)
+
+        offsets = np.concatenate([np.zeros(1, dtype=np.int64)] + line_ends).astype(np.int64)
+        # the last line doesn't end with a new line
+        if offsets[-1] != file_size:
+            offsets = np.append(offsets, file_size)
+        return offsets
+
+    def save_offsets(self):
+        """
+        Save the offsets next to the bed file, the file is written with a temporary name and renamed.
+        :return:
+        """
+        try:
+            with open(self.index_file_path + ".tmp", 'wb') as index_file:
+                np.save(index_file, self.offsets)
+            os.replace(self.index_file_path + ".tmp", self.index_file_path)
+        except OSError:
+            sys.stderr.write(TextColor.YELLOW + "WARN: COULD NOT WRITE BED INDEX FILE: " + self.index_file_path
+                             + "\n" + TextColor.END)
+
+    def __getstate__(self):
+        # memory maps are not copied to worker processes, every process maps the files again
+        state = self.__dict__.copy()
+        state['offsets'] = None if os.path.isfile(self.index_file_path) else np.array(self.offsets)
+        state['bed_file_map'] = None
+        state['bed_file_map_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.offsets is None:
+            self.offsets = np.load(self.index_file_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        # lines are split the same way as the offsets, only on new line characters
+        with open(self.file_path, 'rb') as bed_file:
+            for record in bed_file:
+                yield record.decode()
+
+    def get_record(self, index):
+        """
+        Get a record of the bed file
+        :param index: Index of the record
+        :return: Bed record line
+        """
+        if self.bed_file_map is None or self.bed_file_map_pid != os.getpid():
+            with open(self.file_path, 'rb') as bed_file:
+                self.bed_file_map = mmap.mmap(bed_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.bed_file_map_pid = os.getpid()
+
+        return self.bed_file_map[self.offsets[index]:self.offsets[index + 1]].decode()
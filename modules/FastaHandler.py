@@ -1,26 +1,249 @@
+import mmap
+import os
+from collections import OrderedDict
+import sys
+import numpy as np
 from pysam import FastaFile
+from modules.TextColor import TextColor
 """
 This class handles fasta reference files, ensuring that the sequence is not a terminal 'N' and that the end of the
 sequence has not been reached
 """
 
+# reference is fetched from the fasta file with pysam
+PYSAM_REFERENCE = 'pysam'
+# every contig is converted once to an uppercase file of one byte per base that is memory mapped
+MMAP_REFERENCE = 'mmap'
+# every contig is packed in memory at 2 bits per base, decoded windows are kept in a LRU cache
+PACKED_REFERENCE = 'packed'
+REFERENCE_MODES = [PYSAM_REFERENCE, MMAP_REFERENCE, PACKED_REFERENCE]
+CACHE_DIRECTORY_EXTENSION = ".bases/"
+CACHE_FILE_EXTENSION = ".bases"
+CACHE_CHUNK_SIZE = 1 << 24
+CACHE_WINDOW_SIZE = 1 << 12
+CACHE_WINDOW_COUNT = 4096
+
+# 2 bit code of every base character, bases that aren't A, C, G or T are kept as runs next to the packed bases
+OTHER_BASE_CODE = 4
+BASE_CODES = np.full(256, OTHER_BASE_CODE, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4)
+# [packed byte] = the 4 base characters of the byte
+UNPACK_TABLE = np.frombuffer(b'ACGT', dtype=np.uint8)[(np.arange(256)[:, None] >> np.arange(0, 8, 2)) & 3]
+
 
 class FastaHandler:
     """
     Handles fasta files using pyfaidx API
+    - In mmap mode a contig is written to the cache directory next to the reference the first time it's accessed. A
+    sequence is a slice of the memory map, the pages are shared by every process through the page cache.
+    - In packed mode a contig is read once and packed in memory at 2 bits per base, runs of other bases such as N are
+    kept separately. Sequences are sliced from decoded windows of the contig that are kept in a LRU cache.
     """
-    def __init__(self, reference_file_path):
+    # number of FastaFile objects opened by this process
+    open_count = 0
+
+    def __init__(self, reference_file_path, reference_mode=PYSAM_REFERENCE):
         """
         create fasta file object given file path to a fasta reference file
         :param fasta_file_path: full path to a fasta reference file
+        :param reference_mode: PYSAM_REFERENCE, MMAP_REFERENCE or PACKED_REFERENCE
         """
 
         self.fasta_file_path = reference_file_path
+        self.reference_mode = reference_mode
+        self.cache_dir = reference_file_path + CACHE_DIRECTORY_EXTENSION
 
         try:
             self.fasta = FastaFile(self.fasta_file_path)
         except:
             raise IOError("FASTA FILE READ ERROR")
+        FastaHandler.open_count += 1
+
+        # [contig name] = array of the bases of the contig, mapped on first access
+        self.contig_bases = {}
+        # [contig name] = contig length, packed bases, starts, ends and bases of the runs of other bases
+        self.packed_contigs = {}
+        # [(contig name, window index)] = decoded bases of the window, least recently used first
+        self.window_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def get_cache_file_path(self, contig):
+        """
+        Return the path of the cache file of a contig
+        :param contig: Contig name
+        :return: Path of the cache file
+        """
+        return self.cache_dir + contig + CACHE_FILE_EXTENSION
+
+    def is_cache_file_valid(self, contig):
+        """
+        Check if the cache file of a contig exists, is newer than the reference and has every base of the contig
+        :param contig: Contig name
+        :return: True if the cache file can be used
+        """
+        cache_file_path = self.get_cache_file_path(contig)
+        if not os.path.isfile(cache_file_path):
+            return False
+        cache_file_stat = os.stat(cache_file_path)
+        return cache_file_stat.st_mtime_ns >= os.stat(self.fasta_file_path).st_mtime_ns and \
+            cache_file_stat.st_size == self.fasta.get_reference_length(contig)
+
+    def write_cache_file(self, contig):
+        """
+        Write the uppercase bases of a contig to its cache file, the file is written with a temporary name and renamed.
+        :param contig: Contig name
+        :return: False if the file couldn't be written
+        """
+        cache_file_path = self.get_cache_file_path(contig)
+        temporary_file_path = cache_file_path + "." + str(os.getpid()) + ".tmp"
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            contig_length = self.fasta.get_reference_length(contig)
+            with open(temporary_file_path, 'wb') as cache_file:
+                for start in range(0, contig_length, CACHE_CHUNK_SIZE):
+                    cache_file.write(self.fasta.fetch(contig, start, start + CACHE_CHUNK_SIZE).upper().encode())
+            os.replace(temporary_file_path, cache_file_path)
+        except OSError:
+            sys.stderr.write(TextColor.YELLOW + "WARN: COULD NOT WRITE REFERENCE CACHE FILE: " + cache_file_path
+                             + "\n" + TextColor.END)
+            return False
+        return True
+
+    def get_contig_bases(self, contig):
+        """
+        Return the bases of a contig from the memory map of its cache file, write the cache file if it's out of date
+        :param contig: Contig name
+        :return: Array of uppercase bases, None if the cache file can't be used
+        """
+        if contig not in self.contig_bases:
+            if not self.is_cache_file_valid(contig) and not self.write_cache_file(contig):
+                return None
+            if self.fasta.get_reference_length(contig) == 0:
+                self.contig_bases[contig] = np.zeros(0, dtype=np.uint8)
+            else:
+                with open(self.get_cache_file_path(contig), 'rb') as cache_file:
+                    cache_file_map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.contig_bases[contig] = np.frombuffer(cache_file_map, dtype=np.uint8)
+        return self.contig_bases[contig]
+
+    def pack_contig(self, contig):
+        """
+        Read a contig in chunks and pack its bases at 2 bits per base, 4 bases per byte with the first in the low bits
+        :param contig: Contig name
+        :return: Contig length, packed bases, starts, ends and bases of the runs of other bases
+        """
+        contig_length = self.fasta.get_reference_length(contig)
+        packed_bases = np.zeros((contig_length + 3) // 4, dtype=np.uint8)
+        run_starts = list()
+        run_ends = list()
+        run_bases = list()
+        for start in range(0, contig_length, CACHE_CHUNK_SIZE):
+            bases = np.frombuffer(self.fasta.fetch(contig, start, start + CACHE_CHUNK_SIZE).upper().encode(),
+                                  dtype=np.uint8)
+            codes = BASE_CODES[bases]
+
+            other_positions = np.nonzero(codes == OTHER_BASE_CODE)[0]
+            if len(other_positions):
+                # a run ends where the next other base isn't adjacent or is a different base
+                run_breaks = np.nonzero((np.diff(other_positions) != 1) |
+                                        (bases[other_positions[1:]] != bases[other_positions[:-1]]))[0] + 1
+                first_positions = other_positions[np.concatenate(([0], run_breaks))]
+                last_positions = other_positions[np.concatenate((run_breaks - 1, [len(other_positions) - 1]))]
+                run_starts.append(first_positions + start)
+                run_ends.append(last_positions + 1 + start)
+                run_bases.append(bases[first_positions])
+                codes[other_positions] = 0
+
+            if len(codes) % 4:
+                codes = np.concatenate((codes, np.zeros(4 - len(codes) % 4, dtype=np.uint8)))
+            packed_bases[start // 4:start // 4 + len(codes) // 4] = \
+                codes[0::4] | (codes[1::4] << 2) | (codes[2::4] << 4) | (codes[3::4] << 6)
+
+        return contig_length, packed_bases, \
+            np.concatenate(run_starts) if run_starts else np.zeros(0, dtype=np.int64), \
+            np.concatenate(run_ends) if run_ends else np.zeros(0, dtype=np.int64), \
+            np.concatenate(run_bases) if run_bases else np.zeros(0, dtype=np.uint8)
+
+    def get_window(self, contig, window_index):
+        """
+        Return the decoded bases of a window of a contig from the LRU cache, decode the window if it's not cached
+        :param contig: Contig name
+        :param window_index: Index of the window, window i starts at i * CACHE_WINDOW_SIZE
+        :return: Read only array of uppercase bases
+        """
+        window_key = (contig, window_index)
+        window = self.window_cache.get(window_key)
+        if window is not None:
+            self.cache_hits += 1
+            self.window_cache.move_to_end(window_key)
+            return window
+        self.cache_misses += 1
+
+        contig_length, packed_bases, run_starts, run_ends, run_bases = self.packed_contigs[contig]
+        start = window_index * CACHE_WINDOW_SIZE
+        stop = min(contig_length, start + CACHE_WINDOW_SIZE)
+
+        window = UNPACK_TABLE[packed_bases[start // 4:(stop + 3) // 4]].ravel()[:stop - start]
+        for i in range(np.searchsorted(run_ends, start, side='right'), np.searchsorted(run_starts, stop, side='left')):
+            window[max(run_starts[i], start) - start:min(run_ends[i], stop) - start] = run_bases[i]
+        window.flags.writeable = False
+
+        self.window_cache[window_key] = window
+        if len(self.window_cache) > CACHE_WINDOW_COUNT:
+            self.window_cache.popitem(last=False)
+        return window
+
+    def get_packed_sequence_bases(self, contig, start, stop):
+        """
+        Return the bases of a query region from the decoded windows of the packed contig
+        :param contig: Contig name
+        :param start: Region start
+        :param stop: Region end
+        :return: Read only array of uppercase bases
+        """
+        if contig not in self.packed_contigs:
+            self.packed_contigs[contig] = self.pack_contig(contig)
+        start = max(0, start)
+        stop = min(stop, self.packed_contigs[contig][0])
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+
+        first_window = start // CACHE_WINDOW_SIZE
+        last_window = (stop - 1) // CACHE_WINDOW_SIZE
+        if first_window == last_window:
+            window_start = first_window * CACHE_WINDOW_SIZE
+            return self.get_window(contig, first_window)[start - window_start:stop - window_start]
+        return np.concatenate([self.get_window(contig, window_index) for window_index in
+                               range(first_window, last_window + 1)])[start - first_window * CACHE_WINDOW_SIZE:
+                                                                      stop - first_window * CACHE_WINDOW_SIZE]
+
+    def get_cache_statistics(self):
+        """
+        Get the statistics of the packed reference and its window cache
+        :return: Cache hits, cache misses, number of cached windows, bytes of the packed contigs
+        """
+        packed_bytes = sum(packed_bases.nbytes + run_starts.nbytes + run_ends.nbytes + run_bases.nbytes
+                           for contig_length, packed_bases, run_starts, run_ends, run_bases in
+                           self.packed_contigs.values())
+        return self.cache_hits, self.cache_misses, len(self.window_cache), packed_bytes
+
+    def get_sequence_bases(self, chromosome_name, start, stop):
+        """
+        Return the bases of a query region as an array of characters, in mmap mode the array is a view of the cache
+        :param chromosome_name: Chromosome name
+        :param start: Region start
+        :param stop: Region end
+        :return: Read only array of uppercase bases
+        """
+        if self.reference_mode == PACKED_REFERENCE:
+            return self.get_packed_sequence_bases(chromosome_name, start, stop)
+        if self.reference_mode == MMAP_REFERENCE:
+            contig_bases = self.get_contig_bases(chromosome_name)
+            if contig_bases is not None:
+                return contig_bases[max(0, start):max(0, stop)]
+        return np.frombuffer(self.fasta.fetch(region=chromosome_name, start=start, end=stop).upper().encode(),
+                             dtype=np.uint8)
 
     def get_sequence(self, chromosome_name, start, stop):
         """
@@ -30,6 +253,8 @@ class FastaHandler:
         :param stop: Region end
         :return: Sequence of the region
         """
+        if self.reference_mode != PYSAM_REFERENCE:
+            return self.get_sequence_bases(chromosome_name, start, stop).tobytes().decode()
         return self.fasta.fetch(region=chromosome_name, start=start, end=stop).upper()
 
     def get_chr_sequence_length(self, chromosome_name):
@@ -40,6 +265,23 @@ class FastaHandler:
         """
         return self.fasta.get_reference_length(chromosome_name)
 
+    def get_ref_of_positions(self, contig, start, stop):
+        """
+        Return a string containing reference of a region
+        :param contig: Contig [ex chr3]
+        :param start: Region start, 0 based
+        :param stop: Region end, exclusive
+        :return:
+        """
+        ret_val = ""
+        error_val = 0
+        try:
+            ret_val = self.get_sequence(contig, start, stop)
+        except:
+            print("ERROR IN REF FETCH: ", contig, start, stop)
+            error_val = 1
+        return ret_val, error_val
+
     def get_ref_of_region(self, contig, site):
         """
         Return a string containing reference of a site
@@ -54,4 +296,4 @@ class FastaHandler:
         except:
             print("ERROR IN REF FETCH: ", contig, site)
             error_val = 1
-        return ret_val, error_val
\ No newline at end of file
+        return ret_val, error_val
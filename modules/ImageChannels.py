@@ -1,3 +1,5 @@
+import numpy as np
+
 DEFAULT_MIN_MAP_QUALITY = 5
 IMAGE_HEIGHT = 300
 IMAGE_WIDTH = 300
@@ -100,6 +102,41 @@ class ImageChannels:
         """
         return [0, 0, 0, 0, 0, 0]
 
+    @staticmethod
+    def get_lookup_table(color_function, values):
+        """
+        Precompute the colors of a channel for all the values it can take.
+        :param color_function: Function that returns the color of a single value
+        :param values: Values of the channel, index i of the table holds the color of values[i]
+        :return: Float array of colors
+        """
+        return np.array([color_function(value) for value in values], dtype=np.float64)
+
+    @staticmethod
+    def get_segment_channels(bases, base_qualities, map_qualities, is_rev, is_match, is_supporting):
+        """
+        Get channels of a segment of bases at once. Same values as calling get_channels for each base.
+        :param bases: uint8 array of base bytes
+        :param base_qualities: Integer array of base qualities
+        :param map_qualities: Mapping quality, integer array or a single value
+        :param is_rev: Strand of the bases, boolean array or a single value
+        :param is_match: True if the base matches the reference, boolean array or a single value
+        :param is_supporting: True if the read supports the alt, boolean array or a single value
+        :return: Float array of shape (len(bases), 6)
+        """
+        base_qualities = np.minimum(base_qualities, int(BASE_QUALITY_CAP))
+        map_qualities = np.minimum(map_qualities, int(MAP_QUALITY_CAP))
+
+        channels = np.empty((len(bases), 6), dtype=np.float64)
+        channels[:, 0] = BASE_COLOR_TABLE[bases]
+        channels[:, 1] = BASE_QUALITY_COLOR_TABLE[base_qualities]
+        channels[:, 2] = MAP_QUALITY_COLOR_TABLE[map_qualities]
+        channels[:, 3] = STRAND_COLOR_TABLE[np.asarray(is_rev, dtype=np.int64)]
+        channels[:, 4] = MATCH_COLOR_TABLE[np.asarray(is_match, dtype=np.int64)]
+        channels[:, 5] = SUPPORT_COLOR_TABLE[np.asarray(is_supporting, dtype=np.int64)]
+
+        return channels
+
     @staticmethod
     def get_channels(attribute_tuple):
         """
@@ -153,6 +190,34 @@ class ImageChannels:
         else:
             return 255, 0, 255
 
+    @staticmethod
+    def get_rgb_lookup_table():
+        """
+        Get rgb colors of all base pairs, indexed by [reference base byte, read base byte].
+        Byte 0 is used as the reference of bases that have no reference, i.e. inserted bases.
+        Returns the same colors as get_color_for_base_rgb.
+        :return: uint8 array of shape (256, 256, 3)
+        """
+        lookup_table = np.empty((256, 256, 3), dtype=np.uint8)
+        lookup_table[:, :] = ImageChannels.get_color_for_base_rgb('', '*')
+        for base in ['A', 'C', 'G', 'T']:
+            lookup_table[:, ord(base)] = ImageChannels.get_color_for_base_rgb('', base)
+
+        all_bytes = np.arange(256)
+        lookup_table[all_bytes, all_bytes] = ImageChannels.get_color_for_base_rgb('A', 'A')
+        lookup_table[ord('*'), ord('*')] = ImageChannels.get_color_for_base_rgb('*', '*')
+
+        return lookup_table
+
+    @staticmethod
+    def get_support_channel_rgb(is_supporting):
+        """
+        Get the support channel value of a read in the rgb image.
+        :param is_supporting: True if the read supports the alt allele
+        :return: uint8 value of the support channel
+        """
+        return np.uint8(ImageChannels.get_alt_support_color(is_supporting))
+
     @staticmethod
     def get_channels_only_rgb(attribute_tuple, ref_base):
         base, base_q, map_q, is_rev, is_match, is_supporting = attribute_tuple
@@ -176,4 +241,17 @@ class ImageChannels:
         r, g, b = ImageChannels.get_color_for_base_rgb('', base)
         support_color = ImageChannels.get_alt_support_color(is_in_support=True)
 
-        return [r, g, b, support_color]
\ No newline at end of file
+        return [r, g, b, support_color]
+
+
+RGB_LOOKUP_TABLE = ImageChannels.get_rgb_lookup_table()
+
+# channel colors indexed by base byte, capped quality value or boolean flag
+BASE_COLOR_TABLE = ImageChannels.get_lookup_table(ImageChannels.get_base_color, [chr(i) for i in range(256)])
+BASE_QUALITY_COLOR_TABLE = ImageChannels.get_lookup_table(ImageChannels.get_base_quality_color,
+                                                          range(int(BASE_QUALITY_CAP) + 1))
+MAP_QUALITY_COLOR_TABLE = ImageChannels.get_lookup_table(ImageChannels.get_map_quality_color,
+                                                         range(int(MAP_QUALITY_CAP) + 1))
+STRAND_COLOR_TABLE = ImageChannels.get_lookup_table(ImageChannels.get_strand_color, [False, True])
+MATCH_COLOR_TABLE = ImageChannels.get_lookup_table(ImageChannels.get_match_ref_color, [False, True])
+SUPPORT_COLOR_TABLE = ImageChannels.get_lookup_table(ImageChannels.get_alt_support_color, [False, True])
@@ -1,6 +1,9 @@
+import os
 import numpy as np
 from PIL import Image
 from scipy import misc
+from modules.ImageChannels import ImageChannels
+from modules.ReadStore import ReadStore, EMPTY_BASE
 
 """
 This script creates pileup images given a vcf record, bam alignment file and reference fasta file.
@@ -16,6 +19,14 @@ MAP_QUALITY_FILTER = 10.0
 MATCH_CIGAR_CODE = 0
 INSERT_CIGAR_CODE = 1
 DELETE_CIGAR_CODE = 2
+IMAGE_CHANNELS = 7
+IMAGE_HEIGHT = 300
+# the image of a candidate starts at the leftmost base of the reads aligned to it, no column after this many positions
+# from there is shown
+IMAGE_WIDTH = 300
+REF_BAND = 5
+# number of reads in an image, the rows below the reference band
+MAX_READS_IN_IMAGE = IMAGE_HEIGHT - REF_BAND
 
 class imageChannels:
     """
@@ -150,6 +161,33 @@ class imageChannels:
         cigar_color = imageChannels.get_cigar_color(self.cigar_code)
         return [base_color, base_quality_color, map_quality_color, strand_color, match_color, support_color, cigar_color]
 
+    @staticmethod
+    def get_segment_channels(bases, base_qualities, map_qualities, is_rev, is_match, is_supporting, cigar_codes):
+        """
+        Get channels of a segment of bases at once. Same values as calling get_channels for each base.
+        :param bases: uint8 array of base bytes
+        :param base_qualities: Integer array of base qualities
+        :param map_qualities: Mapping quality, integer array or a single value
+        :param is_rev: Strand of the bases, boolean array or a single value
+        :param is_match: True if the base matches the reference, boolean array or a single value
+        :param is_supporting: True if the read supports the alt, boolean array or a single value
+        :param cigar_codes: Cigar operation of the bases, integer array or a single value
+        :return: Float array of shape (len(bases), IMAGE_CHANNELS)
+        """
+        base_qualities = np.minimum(base_qualities, int(BASE_QUALITY_CAP))
+        map_qualities = np.minimum(map_qualities, int(MAP_QUALITY_CAP))
+
+        channels = np.empty((len(bases), IMAGE_CHANNELS), dtype=np.float64)
+        channels[:, 0] = BASE_COLOR_TABLE[bases]
+        channels[:, 1] = BASE_QUALITY_COLOR_TABLE[base_qualities]
+        channels[:, 2] = MAP_QUALITY_COLOR_TABLE[map_qualities]
+        channels[:, 3] = STRAND_COLOR_TABLE[np.asarray(is_rev, dtype=np.int64)]
+        channels[:, 4] = MATCH_COLOR_TABLE[np.asarray(is_match, dtype=np.int64)]
+        channels[:, 5] = SUPPORT_COLOR_TABLE[np.asarray(is_supporting, dtype=np.int64)]
+        channels[:, 6] = CIGAR_COLOR_TABLE[cigar_codes]
+
+        return channels
+
     @staticmethod
     def get_channels_for_ref(base):
         """
@@ -211,11 +249,24 @@ class imageChannels:
         return [r, g, b, support_color]
 
 
+# channel colors indexed by base byte, capped quality value, boolean flag or cigar code
+BASE_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_base_color, [chr(i) for i in range(256)])
+BASE_QUALITY_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_base_quality_color,
+                                                          range(int(BASE_QUALITY_CAP) + 1))
+MAP_QUALITY_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_map_quality_color,
+                                                         range(int(MAP_QUALITY_CAP) + 1))
+STRAND_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_strand_color, [False, True])
+MATCH_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_match_ref_color, [False, True])
+SUPPORT_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_alt_support_color, [False, True])
+CIGAR_COLOR_TABLE = ImageChannels.get_lookup_table(imageChannels.get_cigar_color,
+                                                   [MATCH_CIGAR_CODE, INSERT_CIGAR_CODE, DELETE_CIGAR_CODE])
+
+
 class ImageCreator:
     """
     Processes a pileup around a positoin
     """
-    def __init__(self, ref_object, pileupcolumns, contig, pos, genotype, alt):
+    def __init__(self, ref_object, pileupcolumns, contig, pos, genotype, alt, alignment_keys=None):
         """
         Initialize PileupProcessor object with required dictionaries
         :param ref_object: pysam FastaFile object that contains the reference
@@ -224,6 +275,8 @@ class ImageCreator:
         :param pos: Position in contig
         :param genotype: Genotype
         :param alt: Alternate allele
+        :param alignment_keys: Keys of the alignments picked by a downsampler, the other reads of the pileup are
+        skipped before they are decoded. All the reads are used if None
         """
         self.ref_object = ref_object
         self.pileupcolumns = pileupcolumns
@@ -233,12 +286,22 @@ class ImageCreator:
         self.alt = alt
         # [genomic_position] = [max_insert_length]
         self.insert_length_dictionary = {} # used
-        # [read_id] = {{genomic_position}->base}
-        self.read_dictionary = {} # used
-        # [read_id] = {{genomic_position}->insert_bases}
-        self.read_insert_dictionary = {} #used
-        # List of Read ids in a genomic position
+        # bases and inserted bases of the reads, starts at the first pileup column
+        self.read_store = None
+        # [(read_name, flag, alignment_start)] = read index in the read store
+        self.read_index_of_alignment = {}
+        # [(read_name, flag, alignment_start)] = (read index in the read store, read name, sequence, qualities,
+        # mapping quality, is reverse), every alignment is decoded once and all the pileup columns index into it
+        self.decoded_alignments = {}
+        self.alignment_keys = alignment_keys
+        # read indices of the candidate that can be rows of its image, all the reads of the position if None
+        self.row_read_indices = None
+        # List of Read indices in a genomic position
         self.reads_aligned_to_pos = {}
+        # read indices of the candidate of a group pileup and [read_name] = (start, end) of all the alignments of the
+        # name in the pileup, built on the first candidate
+        self.candidate_read_indices = None
+        self.read_spans_of_name = None
         # genomic_position_1, genomic_position_2...
         self.position_list = [] # used
         self.leftmost_genomic_position = -1
@@ -246,6 +309,11 @@ class ImageCreator:
         self.genomic_position_projection = {}
         self.reference_base_projection = {}
         self.ref_sequence = ''
+        # reference bases from leftmost to rightmost genomic position without inserts
+        self.reference_bases = None
+        # reference sequence of the whole pileup, fetched once and sliced for every candidate of the pileup
+        self.region_ref_sequence = None
+        self.region_ref_start = None
         self.process_pileup()
         self.project_genomic_positions()
 
@@ -260,11 +328,17 @@ class ImageCreator:
             self.rightmost_genomic_position = 0
 
         # get the reference sequence
-        ref_seq, error_val = self.ref_object.get_ref_of_region(self.contig,
-                                                    ":"+str(self.leftmost_genomic_position+1)+ "-"
-                                                    + str(self.rightmost_genomic_position+1))
-        if error_val == 1:
-            print("ERROR IN FETCHING REFERENCE: ", self.contig, self.pos, self.alt, self.genotype)
+        if self.region_ref_sequence is None:
+            ref_seq, error_val = self.ref_object.get_ref_of_positions(self.contig,
+                                                                      self.leftmost_genomic_position,
+                                                                      self.rightmost_genomic_position + 1)
+            if error_val == 1:
+                print("ERROR IN FETCHING REFERENCE: ", self.contig, self.pos, self.alt, self.genotype)
+            self.region_ref_sequence = ref_seq
+            self.region_ref_start = self.leftmost_genomic_position
+        else:
+            ref_seq = self.region_ref_sequence[self.leftmost_genomic_position - self.region_ref_start:
+                                               self.rightmost_genomic_position + 1 - self.region_ref_start]
 
         ref_seq_with_insert = ''
         idx = 0
@@ -282,6 +356,7 @@ class ImageCreator:
                 idx += self.insert_length_dictionary[i]
         # set the reference sequence
         self.ref_sequence = ref_seq_with_insert
+        self.reference_bases = np.frombuffer(ref_seq.encode(), dtype=np.uint8)
 
         # return index
         return idx
@@ -298,11 +373,10 @@ class ImageCreator:
                 length += self.insert_length_dictionary[i]
         return length
 
-    def initialize_dictionaries(self, genomic_position, read_id, is_insert):
+    def initialize_dictionaries(self, genomic_position, is_insert):
         """
         Initialize all the dictionaries for a specific position
         :param genomic_position: Genomic position of interest
-        :param read_id: Read id for which dictionaries should be initialized
         :param is_insert: If the position is an insert
         :return:
         """
@@ -314,96 +388,213 @@ class ImageCreator:
         if genomic_position not in self.reads_aligned_to_pos:
             self.reads_aligned_to_pos[genomic_position] = []
 
-        if read_id not in self.read_dictionary:
-            self.read_dictionary[read_id] = {}
-            self.read_dictionary[read_id][genomic_position] =''
-
         if is_insert:
             if genomic_position not in self.insert_length_dictionary:
                 self.insert_length_dictionary[genomic_position] = 0
-            if read_id not in self.read_insert_dictionary:
-                self.read_insert_dictionary[read_id] = {}
-                self.read_insert_dictionary[read_id][genomic_position] =''
 
-    def save_info_of_a_position(self, genomic_position, read_id, base, base_qual, map_qual, is_rev, cigar_code, is_in):
+    def save_info_of_a_position(self, genomic_position, read_index, base, base_qual, cigar_code, is_in):
         """
         Given the attributes of a base at a position
         :param genomic_position: Genomic position
-        :param read_id: Read id of a read
+        :param read_index: Index of the read in the read store
         :param base: Base at the position
         :param base_qual: Base quality
-        :param map_qual: Map quality
-        :param is_rev: If read is reversed
+        :param cigar_code: Cigar operation of the base
         :param is_in:
         :return:
         """
-        self.initialize_dictionaries(genomic_position, read_id, is_in)
+        self.initialize_dictionaries(genomic_position, is_in)
 
         if is_in is False:
-            self.read_dictionary[read_id][genomic_position] = (base, base_qual, map_qual, cigar_code, is_rev)
+            self.read_store.set_base(read_index, genomic_position, ord(base), base_qual, cigar_code)
         else:
-            self.read_insert_dictionary[read_id][genomic_position] = (base, base_qual, map_qual, cigar_code, is_rev)
+            self.read_store.add_insert(read_index, genomic_position, base.encode(), base_qual)
             self.insert_length_dictionary[genomic_position] = max(self.insert_length_dictionary[genomic_position],
                                                                   len(base))
 
+    def get_decoded_alignment(self, alignment):
+        """
+        Return the decoded record of an alignment, decode the alignment the first time it's seen. The alignment is the
+        same record in every pileup column it spans.
+        - A pileup that corrects overlaps changes the base qualities of mates where they overlap when the second mate
+        enters it, after the first mate may have been decoded, so the base qualities of matched bases are taken from
+        the pileup column. The qualities of inserted bases are never changed.
+        :param alignment: pysam AlignedSegment object
+        :return: Read index, read name, sequence, qualities, mapping quality, is reverse
+        """
+        alignment_key = (alignment.query_name, alignment.flag, alignment.reference_start)
+        decoded_alignment = self.decoded_alignments.get(alignment_key)
+        if decoded_alignment is None:
+            decoded_alignment = (self.get_read_index(alignment), alignment.query_name, alignment.query_sequence,
+                                 alignment.query_qualities, alignment.mapping_quality, alignment.is_reverse)
+            self.decoded_alignments[alignment_key] = decoded_alignment
+        return decoded_alignment
+
+    def get_read_index(self, alignment):
+        """
+        Return the read index of an alignment in the read store, add the alignment if it's not in the store
+        :param alignment: pysam AlignedSegment object
+        :return: Read index
+        """
+        alignment_key = (alignment.query_name, alignment.flag, alignment.reference_start)
+        if alignment_key not in self.read_index_of_alignment:
+            self.read_index_of_alignment[alignment_key] = \
+                self.read_store.add_read(alignment.query_name, alignment.reference_start, alignment.reference_end,
+                                         alignment.mapping_quality, alignment.is_reverse)
+        return self.read_index_of_alignment[alignment_key]
+
     @staticmethod
-    def get_attributes_to_save_indel( pileupcolumn, pileupread):
+    def get_attributes_to_save_indel(pileupcolumn, pileupread, decoded_alignment):
+        read_index, read_name, query_sequence, query_qualities, map_qual, is_rev = decoded_alignment
         insert_start = pileupread.query_position + 1
         insert_end = insert_start + pileupread.indel
 
         return pileupcolumn.pos, \
-               pileupread.alignment.query_name, \
-               pileupread.alignment.query_sequence[insert_start:insert_end], \
-               pileupread.alignment.query_qualities[insert_start:insert_end], \
-               pileupread.alignment.mapping_quality, \
-               pileupread.alignment.is_reverse, \
+               read_name, \
+               query_sequence[insert_start:insert_end], \
+               query_qualities[insert_start:insert_end], \
+               map_qual, \
+               is_rev, \
                INSERT_CIGAR_CODE # CIGAR OPERATION IS INSERT
 
     @staticmethod
-    def get_attributes_to_save(pileupcolumn, pileupread):
+    def get_attributes_to_save(pileupcolumn, pileupread, decoded_alignment, base_qual):
+        read_index, read_name, query_sequence, query_qualities, map_qual, is_rev = decoded_alignment
         if pileupread.is_del:
             return pileupcolumn.pos, \
-                   pileupread.alignment.query_name,\
+                   read_name,\
                    '*', \
                    0,\
-                   pileupread.alignment.mapping_quality, \
-                   pileupread.alignment.is_reverse, \
+                   map_qual, \
+                   is_rev, \
                    DELETE_CIGAR_CODE # CIGAR OPERATION DELETE
         else:
             return pileupcolumn.pos, \
-                   pileupread.alignment.query_name, \
-                   pileupread.alignment.query_sequence[pileupread.query_position],  \
-                   pileupread.alignment.query_qualities[pileupread.query_position], \
-                   pileupread.alignment.mapping_quality, \
-                   pileupread.alignment.is_reverse, \
+                   read_name, \
+                   query_sequence[pileupread.query_position],  \
+                   base_qual, \
+                   map_qual, \
+                   is_rev, \
                    MATCH_CIGAR_CODE  # CIGAR OPERATION MATCH
 
     @staticmethod
     def save_image_as_png(pileup_array, save_dir, file_name):
         pileupArray2d = pileup_array.reshape((pileup_array.shape[0], -1))
-        misc.imsave(save_dir + file_name + ".png", pileupArray2d, format="PNG")
+        # the image is written with a temporary name so a partially written image is never found
+        misc.imsave(save_dir + file_name + ".png.tmp", pileupArray2d, format="PNG")
+        os.replace(save_dir + file_name + ".png.tmp", save_dir + file_name + ".png")
 
     def process_pileup(self):
         for pileupcolumn in self.pileupcolumns:
+            if self.read_store is None:
+                self.read_store = ReadStore(pileupcolumn.pos)
             self.position_list.append(pileupcolumn.pos)
             self.reads_aligned_to_pos[pileupcolumn.pos] = []
-            for pileupread in pileupcolumn.pileups:
-                self.reads_aligned_to_pos[pileupcolumn.pos].append(pileupread.alignment.query_name)
+            # base qualities of the reads in the column, in the order of the pileup reads
+            column_qualities = pileupcolumn.get_query_qualities()
+            for pileupread, column_quality in zip(pileupcolumn.pileups, column_qualities):
+                alignment = pileupread.alignment
+                if self.alignment_keys is not None and \
+                        (alignment.query_name, alignment.flag, alignment.reference_start) not in self.alignment_keys:
+                    continue
+                decoded_alignment = self.get_decoded_alignment(alignment)
+                read_index = decoded_alignment[0]
+                self.reads_aligned_to_pos[pileupcolumn.pos].append(read_index)
 
                 if pileupread.indel > 0:
                     gen_pos, read_id, base, base_qual, map_qual, is_rev, cigar_code = \
-                        self.get_attributes_to_save_indel(pileupcolumn, pileupread)
-                    self.save_info_of_a_position(gen_pos, read_id, base, base_qual, map_qual, is_rev, cigar_code, is_in=True)
+                        self.get_attributes_to_save_indel(pileupcolumn, pileupread, decoded_alignment)
+                    self.save_info_of_a_position(gen_pos, read_index, base, base_qual, cigar_code, is_in=True)
 
                 gen_pos, read_id, base, base_qual, map_qual, is_rev, cigar_code = \
-                    self.get_attributes_to_save(pileupcolumn, pileupread)
-                self.save_info_of_a_position(gen_pos, read_id, base, base_qual, map_qual, is_rev, cigar_code, is_in=False)
+                    self.get_attributes_to_save(pileupcolumn, pileupread, decoded_alignment, column_quality)
+                self.save_info_of_a_position(gen_pos, read_index, base, base_qual, cigar_code, is_in=False)
+
+    def set_candidate(self, pos, genotype, alt, alignment_keys=None):
+        """
+        Restrict the image to the reads aligned to a candidate position. Used when the pileup of a group of nearby
+        candidates is processed once, the image is the same as the one created from the pileup of the candidate.
+        :param pos: Position of the candidate
+        :param genotype: Genotype
+        :param alt: Alternate allele
+        :param alignment_keys: Keys of the alignments picked for the candidate by a downsampler, None if not downsampled
+        :return:
+        """
+        self.pos = pos
+        self.genotype = genotype
+        self.alt = alt
+
+        # the image spans the positions where the reads overlapping the candidate have a base
+        read_count = self.read_store.read_count
+        read_indices = np.nonzero((self.read_store.read_starts[:read_count] <= pos) &
+                                  (self.read_store.read_ends[:read_count] > pos))[0]
+        self.row_read_indices = None
+        if alignment_keys is not None:
+            picked_read_indices = [self.read_index_of_alignment[alignment_key] for alignment_key in alignment_keys
+                                   if alignment_key in self.read_index_of_alignment]
+            read_indices = read_indices[np.isin(read_indices, picked_read_indices)]
+            self.row_read_indices = set(read_indices.tolist())
+        self.candidate_read_indices = read_indices
+        if len(read_indices) == 0:
+            # the image of a candidate without reads is created from its own pileup
+            return
+        columns = np.nonzero((self.read_store.bases[read_indices] != EMPTY_BASE).any(axis=0))[0]
+        self.leftmost_genomic_position = self.read_store.window_start + int(columns[0])
+        self.rightmost_genomic_position = self.read_store.window_start + int(columns[-1])
+
+        self.insert_length_dictionary = {}
+        insert_read_indices, insert_positions, insert_offsets, insert_lengths, insert_bases, insert_qualities = \
+            self.read_store.get_inserts()
+        selected = np.nonzero(np.isin(insert_read_indices, read_indices))[0]
+        for insert_position, insert_length in zip(insert_positions[selected].tolist(),
+                                                  insert_lengths[selected].tolist()):
+            self.insert_length_dictionary[insert_position] = max(self.insert_length_dictionary.get(insert_position, 0),
+                                                                 insert_length)
+
+        self.genomic_position_projection = {}
+        self.reference_base_projection = {}
+        self.project_genomic_positions()
+
+    def has_mate_outside_candidate(self, read_spans_of_name=None):
+        """
+        Check if a read of the candidate overlaps a mate that is in the group pileup but doesn't overlap the candidate.
+        A pileup that corrects overlaps changes the base qualities of mates only if both of them are in it, so the
+        pileup of the candidate alone would give such a read other qualities.
+        :param read_spans_of_name: [read_name] = (start, end) of every alignment of the name in the group pileup. Taken
+        from the read store if None, the reads skipped by a downsampler are not in the store
+        :return: True if the image of the candidate can differ from the image of its own pileup
+        """
+        read_names = self.read_store.read_names
+        read_starts = self.read_store.read_starts
+        read_ends = self.read_store.read_ends
+        if read_spans_of_name is None:
+            if self.read_spans_of_name is None:
+                self.read_spans_of_name = {}
+                for read_index, read_name in enumerate(read_names[:self.read_store.read_count]):
+                    self.read_spans_of_name.setdefault(read_name, []).append((int(read_starts[read_index]),
+                                                                               int(read_ends[read_index])))
+            read_spans_of_name = self.read_spans_of_name
+
+        for read_index in self.candidate_read_indices.tolist():
+            for mate_start, mate_end in read_spans_of_name[read_names[read_index]]:
+                if not mate_start <= self.pos < mate_end and mate_start < read_ends[read_index] and \
+                        read_starts[read_index] < mate_end:
+                    return True
+        return False
+
+    def get_aligned_positions(self, read_index):
+        """
+        Return the genomic positions where a read has a base
+        :param read_index: Index of the read in the read store
+        :return: Sorted array of genomic positions
+        """
+        return np.nonzero(self.read_store.bases[read_index] != EMPTY_BASE)[0] + self.read_store.window_start
 
     def create_text_pileup(self, query_pos):
         left_most_pos = -1
-        for read_id in self.reads_aligned_to_pos[query_pos]:
+        for read_index in self.reads_aligned_to_pos[query_pos]:
             read_list = []
-            aligned_positions = sorted(self.read_dictionary[read_id].keys())
+            aligned_positions = self.get_aligned_positions(read_index)
             if left_most_pos < 0:
                 left_most_pos = aligned_positions[0]
             left_most_pos = min(left_most_pos, aligned_positions[0])
@@ -412,12 +603,12 @@ class ImageCreator:
             for pad in range(padding):
                 read_list.append(' ')
             for pos in aligned_positions:
-                read_list.append((self.read_dictionary[read_id][pos][0]))
+                read_list.append(chr(self.read_store.get_base(read_index, pos)))
                 if pos in self.insert_length_dictionary.keys() and self.insert_length_dictionary[pos] > 0:
-                    this_has_insert = read_id in self.read_insert_dictionary and pos in self.read_insert_dictionary[read_id]
+                    insert = self.read_store.get_insert(read_index, pos)
                     inserted_bases = 0
-                    if this_has_insert is True:
-                        for base in self.read_insert_dictionary[read_id][pos][0]:
+                    if insert is not None:
+                        for base in insert[0].decode():
                             read_list.append(base)
                             inserted_bases += 1
                     for i in range(inserted_bases, self.insert_length_dictionary[pos]):
@@ -425,41 +616,50 @@ class ImageCreator:
 
             print(''.join(read_list))
 
-    def check_for_support(self, read_id, ref, alt, poi):
+    def check_for_support(self, read_index, ref, alt, poi):
         genomic_start_position = poi
         genomic_end_position = poi + len(ref)
         allele = ''
         for pos in range(genomic_start_position, genomic_end_position):
-            if pos in self.read_dictionary[read_id]:
-                allele += self.read_dictionary[read_id][pos][0]
-            if len(alt) > 1 and read_id in self.read_insert_dictionary and pos in self.read_insert_dictionary[read_id]:
-                allele += self.read_insert_dictionary[read_id][pos][0]
+            base = self.read_store.get_base(read_index, pos)
+            if base != EMPTY_BASE:
+                allele += chr(base)
+            if len(alt) > 1:
+                insert = self.read_store.get_insert(read_index, pos)
+                if insert is not None:
+                    allele += insert[0].decode()
         allele = allele.replace('*', '')
         alt = alt.replace('*', '')
         if allele == alt:
             return True
         return False
 
-    def get_row(self, read_id, poi, ref, alt):
+    def get_row(self, read_index, poi, ref, alt):
         read_list = {}
         read_insert_list = {}
-        is_supporting = self.check_for_support(read_id, ref, alt, poi)
+        is_supporting = self.check_for_support(read_index, ref, alt, poi)
 
-        aligned_positions = sorted(self.read_dictionary[read_id].keys())
-        for pos in aligned_positions:
+        map_qual = self.read_store.map_qualities[read_index]
+        is_rev = bool(self.read_store.is_reverse[read_index])
+        for pos in self.get_aligned_positions(read_index):
+            column = pos - self.read_store.window_start
             read_list[pos] = []
-            read_list[pos].append(self.read_dictionary[read_id][pos])
+            read_list[pos].append((chr(self.read_store.bases[read_index, column]),
+                                   self.read_store.base_qualities[read_index, column],
+                                   map_qual,
+                                   self.read_store.cigar_codes[read_index, column],
+                                   is_rev))
 
             if pos in self.insert_length_dictionary.keys() and self.insert_length_dictionary[pos] > 0:
                 read_insert_list[pos] = []
                 inserted_bases = 0
-                if read_id in self.read_insert_dictionary and pos in self.read_insert_dictionary[read_id]:
-                    inserted_bases = len(self.read_insert_dictionary[read_id][pos][0])
-                    read_insert_list[pos].append(self.read_insert_dictionary[read_id][pos])
+                insert = self.read_store.get_insert(read_index, pos)
+                if insert is not None:
+                    inserted_bases = len(insert[0])
+                    read_insert_list[pos].append((insert[0].decode(), insert[1], map_qual, INSERT_CIGAR_CODE, is_rev))
 
                 for i in range(inserted_bases, self.insert_length_dictionary[pos]):
-                    read_attribute_tuple = ('*', [BASE_QUALITY_CAP], self.read_dictionary[read_id][pos][2],
-                                            INSERT_CIGAR_CODE, self.read_dictionary[read_id][pos][4])
+                    read_attribute_tuple = ('*', [BASE_QUALITY_CAP], map_qual, INSERT_CIGAR_CODE, is_rev)
                     read_insert_list[pos].append(read_attribute_tuple)
         return read_list, read_insert_list, is_supporting
 
@@ -476,8 +676,8 @@ class ImageCreator:
         for i in range(ref_band):
             whole_image.append(self.get_reference_row_rgb(image_width))
 
-        for read_id in self.reads_aligned_to_pos[query_pos]:
-            row_list, row_insert_list, is_supporting = self.get_row(read_id, query_pos, ref, alt)
+        for read_index in self.reads_aligned_to_pos[query_pos]:
+            row_list, row_insert_list, is_supporting = self.get_row(read_index, query_pos, ref, alt)
             in_support = in_support + 1 if is_supporting is True else in_support
             not_in_support = not_in_support + 1 if is_supporting is False else not_in_support
 
@@ -512,56 +712,86 @@ class ImageCreator:
 
     # TEST FIVE CHANNELS
     def get_reference_row(self, image_width):
-        image_row = [imageChannels.get_empty_channels() for i in range(image_width)]
-        for i in range(0, min(len(self.ref_sequence), image_width)):
-            image_row[i] = imageChannels.get_channels_for_ref(self.ref_sequence[i])
+        image_row = np.zeros((image_width, IMAGE_CHANNELS), dtype=np.uint8)
+        ref_bases = np.frombuffer(self.ref_sequence[:image_width].encode(), dtype=np.uint8)
+        image_row[0:len(ref_bases)] = imageChannels.get_segment_channels(ref_bases, 60, 60, False, True, True,
+                                                                         MATCH_CIGAR_CODE)
         return image_row
 
-    @staticmethod
-    def add_empty_rows(image, empty_rows_to_add, image_width):
-        for i in range(empty_rows_to_add):
-            image.append([imageChannels.get_empty_channels() for i in range(image_width)])
-        return image
-
-    def create_image(self, query_pos, ref, alt, image_height=300, image_width=300, ref_band=5):
-        whole_image = []
-        for i in range(ref_band):
-            whole_image.append(self.get_reference_row(image_width))
-
-        for read_id in self.reads_aligned_to_pos[query_pos]:
-            row_list, row_insert_list, is_supporting = self.get_row(read_id, query_pos, ref, alt)
-
-            image_row = [imageChannels.get_empty_channels() for i in range(image_width)]
-
-            filter_row = False
-            for position in sorted(row_list):
-                if row_list[position][0][2] < MAP_QUALITY_FILTER:
-                    filter_row = True
-                    break
-
-                imagechannels_object = imageChannels(row_list[position][0], self.reference_base_projection[position],
-                                                     is_supporting)
-
-                if self.genomic_position_projection[position] < image_width:
-                    image_row[self.genomic_position_projection[position]] = imagechannels_object.get_channels()
-
-                if position in row_insert_list.keys():
-                    insert_ref = 0
-                    for bases in row_insert_list[position]:
-                        for base_idx in range(len(bases[0])):
-                            insert_ref += 1
-                            attribute_tuple = (bases[0][base_idx], bases[1][base_idx], bases[2], bases[3], bases[4])
-                            imagechannels_object = imageChannels(attribute_tuple, '*', is_supporting)
-
-                            if self.genomic_position_projection[position] + insert_ref < image_width:
-                                image_row[self.genomic_position_projection[position] + insert_ref] = \
-                                    imagechannels_object.get_channels()
-
-            if filter_row is False and len(whole_image) < image_height:
-                whole_image.append(image_row)
-
-        whole_image = self.add_empty_rows(whole_image, image_height - len(whole_image), image_width)
+    def get_read_rows(self, image_rows, read_indices, is_supporting, image_width):
+        """
+        Fill image rows with the bases and inserted bases of reads
+        :param image_rows: Image rows to fill, uint8 array of shape (len(read_indices), image_width, IMAGE_CHANNELS)
+        :param read_indices: Array of read indices in the read store, one for each row
+        :param is_supporting: Boolean array, True if the read of the row supports the alt allele
+        :param image_width: Width of the image
+        :return:
+        """
+        left_pos = self.leftmost_genomic_position
+        right_pos = self.rightmost_genomic_position + 1
+        indices = np.array([self.genomic_position_projection[pos] for pos in range(left_pos, right_pos)],
+                           dtype=np.int64)
+        map_qualities = self.read_store.map_qualities[read_indices]
+        is_rev = self.read_store.is_reverse[read_indices]
+
+        # aligned bases
+        bases = self.read_store.get_window('bases', read_indices, left_pos, right_pos)
+        base_qualities = self.read_store.get_window('base_qualities', read_indices, left_pos, right_pos)
+        cigar_codes = self.read_store.get_window('cigar_codes', read_indices, left_pos, right_pos)
+        rows, columns = np.nonzero(bases != EMPTY_BASE)
+        row_bases = bases[rows, columns]
+        channels = imageChannels.get_segment_channels(row_bases, base_qualities[rows, columns], map_qualities[rows],
+                                                      is_rev[rows], row_bases == self.reference_bases[columns],
+                                                      is_supporting[rows], cigar_codes[rows, columns])
+        in_image = indices[columns] < image_width
+        image_rows[rows[in_image], indices[columns[in_image]]] = channels[in_image]
+
+        # reads with a base in an insert position are padded with '*' up to the longest insert of that position
+        insert_lengths = np.zeros(right_pos - left_pos, dtype=np.int64)
+        for pos, length in self.insert_length_dictionary.items():
+            insert_lengths[pos - left_pos] = length
+        padded = insert_lengths[columns] > 0
+        rows = rows[padded]
+        lengths = insert_lengths[columns[padded]]
+        base_offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = np.repeat(rows, lengths)
+        image_indices = np.repeat(indices[columns[padded]] + 1, lengths) + base_offsets
+        channels = imageChannels.get_segment_channels(np.full(len(rows), ord('*'), dtype=np.uint8),
+                                                      int(BASE_QUALITY_CAP), map_qualities[rows], is_rev[rows], True,
+                                                      is_supporting[rows], INSERT_CIGAR_CODE)
+        in_image = image_indices < image_width
+        image_rows[rows[in_image], image_indices[in_image]] = channels[in_image]
+
+        # inserted bases of the reads
+        insert_read_indices, insert_positions, insert_offsets, insert_lengths, insert_bases, insert_qualities = \
+            self.read_store.get_inserts()
+        row_of_read = np.full(self.read_store.read_count, -1, dtype=np.int64)
+        row_of_read[read_indices] = np.arange(len(read_indices))
+        selected = row_of_read[insert_read_indices] >= 0
+        lengths = insert_lengths[selected]
+        base_offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = np.repeat(row_of_read[insert_read_indices[selected]], lengths)
+        image_indices = np.repeat(indices[insert_positions[selected] - left_pos] + 1, lengths) + base_offsets
+        base_indices = np.repeat(insert_offsets[selected], lengths) + base_offsets
+        row_bases = insert_bases[base_indices]
+        channels = imageChannels.get_segment_channels(row_bases, insert_qualities[base_indices], map_qualities[rows],
+                                                      is_rev[rows], row_bases == ord('*'), is_supporting[rows],
+                                                      INSERT_CIGAR_CODE)
+        in_image = image_indices < image_width
+        image_rows[rows[in_image], image_indices[in_image]] = channels[in_image]
+
+    def create_image(self, query_pos, ref, alt, image_height=IMAGE_HEIGHT, image_width=IMAGE_WIDTH, ref_band=REF_BAND):
+        image_array = np.zeros((image_height, image_width, IMAGE_CHANNELS), dtype=np.uint8)
+        image_array[0:ref_band] = self.get_reference_row(image_width)
+
+        read_indices = [read_index for read_index in self.reads_aligned_to_pos[query_pos]
+                        if self.read_store.map_qualities[read_index] >= MAP_QUALITY_FILTER and
+                        (self.row_read_indices is None or read_index in self.row_read_indices)]
+        read_indices = np.array(read_indices[:image_height - ref_band], dtype=np.int64)
+        is_supporting = np.array([self.check_for_support(read_index, ref, alt, query_pos)
+                                  for read_index in read_indices], dtype=np.bool_)
+        self.get_read_rows(image_array[ref_band:ref_band + len(read_indices)], read_indices, is_supporting,
+                           image_width)
 
-        image_array = np.array(whole_image).astype(np.uint8)
         return image_array, image_array.shape
 
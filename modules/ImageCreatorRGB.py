@@ -1,5 +1,5 @@
-from collections import defaultdict
-from modules.ImageChannels import ImageChannels
+from modules.ImageChannels import ImageChannels, RGB_LOOKUP_TABLE
+from modules.ReadStore import ReadStore, EMPTY_BASE
 import numpy as np
 from scipy import misc
 
@@ -7,7 +7,6 @@ from scipy import misc
 This script creates an image from a given bed record. 
 """
 
-DEFAULT_MIN_MAP_QUALITY = 5
 IMAGE_HEIGHT = 300
 IMAGE_WIDTH = 300
 IMAGE_BUFFER = 0
@@ -19,37 +18,57 @@ BASE_QUALITY_CAP = 40.0
 MAP_QUALITY_CAP = 60.0
 MAP_QUALITY_FILTER = 10.0
 REF_BAND = 5
+IMAGE_CHANNELS = 4
+# number of reads in an image, the rows below the reference band
+MAX_READS_IN_IMAGE = IMAGE_HEIGHT - REF_BAND
 
 
 class ImageCreatorRGB:
     """
     Create image given a bed record.
     """
-    def __init__(self, fasta_handler, chromosome_name, allele_start_position, allele_end_position):
+    def __init__(self, fasta_handler, chromosome_name, allele_start_position, allele_end_position, read_store=None,
+                 read_downsampler=None):
         """
         Initialize image creator object
         :param fasta_handler: Reference file handler
         :param chromosome_name: Chromosome name
         :param allele_start_position: Start position of the allele in question
         :param allele_end_position: End position of the allele in question
+        :param read_store: Read store to decode the reads into, a store of the image window if None
+        :param read_downsampler: ReadDownsampler that picks the reads of the allele before they are decoded. If None
+        the first reads in fetch order are kept.
         """
         self.chromosome_name = chromosome_name
         self.fasta_handler = fasta_handler
-
-        # the base and the insert dictionary for finding alleles
-        self.base_dictionary = {}
-        self.insert_dictionary = {}
-        self.reference_dictionary = {}
-
-        # supplementary dictionaries and other values
+        self.allele_start_position = allele_start_position
+        self.read_downsampler = read_downsampler
+
+        # genomic window that can end up in the image, bases of the reads outside of it are not decoded
+        self.window_start = allele_start_position - IMAGE_WIDTH
+        self.window_end = allele_end_position + IMAGE_WIDTH + 1
+
+        # bases and inserts of the reads for finding alleles
+        self.read_store = read_store if read_store is not None else ReadStore(self.window_start, self.window_end)
+        # reference sequence of the image as base bytes, starting at reference_start
+        self.reference_bases = None
+        self.reference_start = None
+        # reference sequence of a region around the window, only set when images of several alleles are generated
+        self.window_reference_bases = None
+        self.window_reference_start = None
+
+        # supplementary arrays and other values
         self.read_id_in_allele_position = list()
-        self.longest_insert_in_position = {}
+        # longest insert anchored at each position of the window
+        self.longest_insert_in_position = None
         self.leftmost_alignment_position = allele_start_position
         self.rightmost_alignment_position = allele_end_position
-        self.read_rev_dict = {}
-        self.read_mq_dict = {}
-        # ref position to index projection to handle inserts
-        self.ref_to_index_projection = {}
+        # image column of each position from column_offsets_start, the last value is the total number of columns
+        self.column_offsets = None
+        self.column_offsets_start = None
+        # ref position to index projection to handle inserts, starts at the leftmost position of the image
+        self.ref_to_index_projection = None
+        self.projection_start = None
 
     @staticmethod
     def get_read_stop_position(read):
@@ -73,123 +92,49 @@ class ImageCreatorRGB:
 
         return ref_alignment_stop
 
-    def _update_base_dictionary(self, pos, read_id, base, map_quality, base_qualities, direction, cigar_op):
-        """
-        In base dictionary add attributes to create the image.
-        :param pos: Genomic position
-        :param read_id: Read id
-        :param base: Nucleotide base
-        :param map_quality: Mapping quality
-        :param base_qualities: Base quality
-        :param direction: True if the read  is reverse
-        :param cigar_op: CIGAR operation
-        :return:
-        """
-        if read_id not in self.base_dictionary:
-            self.base_dictionary[read_id] = {}
-        if pos not in self.base_dictionary[read_id]:
-            self.base_dictionary[read_id][pos] = []
-
-        self.base_dictionary[read_id][pos] = (base, map_quality, base_qualities, direction, cigar_op)
-
-    def _update_insert_dictionary(self, pos, read_id, base, map_quality, base_qualities, direction, cigar_op):
-        """
-        In insert dictionary add attributes to create the image.
-        :param pos: Genomic position
-        :param read_id: Read id
-        :param base: Nucleotide base
-        :param map_quality: Mapping quality
-        :param base_qualities: Array containing base qualities
-        :param direction: True if the read  is reverse
-        :param cigar_op: CIGAR operation
-        :return:
-        """
-        if read_id not in self.insert_dictionary:
-            self.insert_dictionary[read_id] = {}
-        if pos not in self.insert_dictionary[read_id]:
-            self.insert_dictionary[read_id][pos] = []
-        self.insert_dictionary[read_id][pos] = (base, map_quality, base_qualities, direction, cigar_op)
-
-    def _process_match(self, pos, length, read_sequence, read_name, mapping_quality, base_qualities, direction):
+    def _process_match(self, pos, length, read_sequence, read_index, base_qualities):
         """
         Process a cigar match operation in a read
         :param pos: Starting position of the cigar operation
         :param length: Length of the operation
         :param read_sequence: Read sequence where this operation happens
-        :param read_name: Read name
-        :param mapping_quality: Mapping quality
+        :param read_index: Index of the read in the read store
         :param base_qualities: Array containing base qualities
-        :param direction: True if the read  is reverse
         :return:
         """
-        start = pos
-        stop = start + length
-        for i in range(start, stop):
-            read_base = read_sequence[i-pos]
-            base_quality = base_qualities[i-pos]
-            self._update_base_dictionary(i, read_name, read_base, mapping_quality, base_quality, direction, CIGAR_MATCH)
+        self.read_store.set_bases(read_index, pos, length, read_sequence, base_qualities, CIGAR_MATCH)
 
-    def _process_delete(self, pos, length, read_name, mapping_quality, base_qualities, direction):
+    def _process_delete(self, pos, length, read_index):
         """
         Process a cigar delete operation in a read
         :param pos: Starting position of the cigar operation
         :param length: Length of the operation
-        :param read_name: Read name
-        :param mapping_quality: Mapping quality
-        :param base_qualities: Array containing base qualities
-        :param direction: True if the read  is reverse
+        :param read_index: Index of the read in the read store
         :return:
         """
-
         # actual delete position starts one after the anchor
-        start = pos
-        stop = start + length
+        self.read_store.set_bases(read_index, pos, length, ord('*'), 0, CIGAR_DEL)
 
-        for i in range(start, stop):
-            read_base = "*"
-            base_quality = 0
-            # update the base dictionary
-            self._update_base_dictionary(i, read_name, read_base, mapping_quality, base_quality, direction, CIGAR_DEL)
-
-    def _process_insert(self, pos, read_sequence, read_name, mapping_quality, base_qualities, direction):
+    def _process_insert(self, pos, read_sequence, read_index, base_qualities):
         """
-        Process a cigar delete operation in a read
-        :param pos: Starting position of the cigar operation
-        :param read_name: Read name
-        :param mapping_quality: Mapping quality
+        Process a cigar insert operation in a read
+        :param pos: Anchor position of the cigar operation
+        :param read_sequence: Inserted bases
+        :param read_index: Index of the read in the read store
         :param base_qualities: Array containing base qualities
-        :param direction: True if the read  is reverse
-        :return:
-        """
-        read_bases = read_sequence
-        self._update_insert_dictionary(pos, read_name, read_bases, mapping_quality, base_qualities, direction, CIGAR_IN)
-
-        if pos not in self.longest_insert_in_position:
-            self.longest_insert_in_position[pos] = 0
-
-        self.longest_insert_in_position[pos] = max(self.longest_insert_in_position[pos], len(read_bases))
-
-    def _update_reference_dictionary(self, position, ref_base):
-        """
-        Update the reference dictionary
-        :param position: Genomic position
-        :param ref_base: Reference base at that position
         :return:
         """
-        self.reference_dictionary[position] = ref_base
+        self.read_store.add_insert(read_index, pos, read_sequence, base_qualities)
 
-    def parse_cigar_tuple(self, cigar_code, length, alignment_position, read_sequence,
-                          read_name, base_qualities, mapping_quality, direction):
+    def parse_cigar_tuple(self, cigar_code, length, alignment_position, read_sequence, read_index, base_qualities):
         """
         Parse through a cigar operation to find possible candidate variant positions in the read
         :param cigar_code: Cigar operation code
         :param length: Length of the operation
         :param alignment_position: Alignment position corresponding to the reference
         :param read_sequence: Read sequence
-        :param read_name: Read ID
+        :param read_index: Index of the read in the read store
         :param base_qualities: Array containing base quality of the read
-        :param mapping_quality: Mapping quality of the read
-        :param direction: If true then the read is reversed
         :return:
 
         cigar key map based on operation.
@@ -212,10 +157,8 @@ class ImageCreatorRGB:
             self._process_match(pos=alignment_position,
                                 length=length,
                                 read_sequence=read_sequence,
-                                read_name=read_name,
-                                mapping_quality=mapping_quality,
-                                base_qualities=base_qualities,
-                                direction=direction
+                                read_index=read_index,
+                                base_qualities=base_qualities
                                 )
         elif cigar_code == 1:
             # insert
@@ -223,20 +166,15 @@ class ImageCreatorRGB:
             # position should be the anchor point hence we use a -1 to refer to the anchor point
             self._process_insert(pos=alignment_position - 1,
                                  read_sequence=read_sequence,
-                                 read_name=read_name,
-                                 mapping_quality=mapping_quality,
-                                 base_qualities=base_qualities,
-                                 direction=direction
+                                 read_index=read_index,
+                                 base_qualities=base_qualities
                                  )
             ref_index_increment = 0
         elif cigar_code == 2 or cigar_code == 3:
             # delete or ref_skip
             self._process_delete(pos=alignment_position,
                                  length=length,
-                                 read_name=read_name,
-                                 mapping_quality=mapping_quality,
-                                 base_qualities=base_qualities,
-                                 direction=direction
+                                 read_index=read_index
                                  )
             read_index_increment = 0
         elif cigar_code == 4:
@@ -272,213 +210,307 @@ class ImageCreatorRGB:
         """
         Process a read that aligns to the allele position
         :param read:
-        :return:
+        :return: Index of the read in the read store
         """
         ref_alignment_start = read.reference_start
         ref_alignment_stop = self.get_read_stop_position(read)
         self._update_image_bounderies(ref_alignment_start, ref_alignment_stop)
 
         cigar_tuples = read.cigartuples
-        read_sequence = read.query_sequence
-
+        read_sequence = read.query_sequence.encode()
         base_qualities = read.query_qualities
-        mapping_quality = read.mapping_quality
-        direction = read.is_reverse
-        self.read_mq_dict[read.query_name] = mapping_quality
-        self.read_rev_dict[read.query_name] = direction
 
-        read_index = 0
+        read_index = self.read_store.add_read(read.query_name, ref_alignment_start, ref_alignment_stop,
+                                              read.mapping_quality, read.is_reverse)
+
+        read_index_iterator = 0
         ref_index = 0
 
         for cigar in cigar_tuples:
             cigar_code = cigar[0]
             length = cigar[1]
+            alignment_position = ref_alignment_start + ref_index
+
+            # operations that fall completely outside of the window of the read store are skipped
+            if alignment_position + length <= self.read_store.window_start or \
+                    (self.read_store.window_end is not None and alignment_position > self.read_store.window_end):
+                if cigar_code == 0 or cigar_code == 1 or cigar_code == 4:
+                    read_index_iterator += length
+                if cigar_code == 0 or cigar_code == 2 or cigar_code == 3:
+                    ref_index += length
+                continue
+
             # get the sequence segments that are effected by this operation
-            read_sequence_segment = read_sequence[read_index:read_index+length]
-            base_quality_segment = base_qualities[read_index:read_index+length]
+            read_sequence_segment = read_sequence[read_index_iterator:read_index_iterator+length]
+            base_quality_segment = base_qualities[read_index_iterator:read_index_iterator+length]
 
             # send the cigar tuple to get attributes we got by this operation
             ref_index_increment, read_index_increment = \
                 self.parse_cigar_tuple(cigar_code=cigar_code,
                                        length=length,
-                                       alignment_position=ref_alignment_start+ref_index,
+                                       alignment_position=alignment_position,
                                        read_sequence=read_sequence_segment,
-                                       read_name=read.query_name,
-                                       base_qualities=base_quality_segment,
-                                       mapping_quality=mapping_quality,
-                                       direction=direction)
+                                       read_index=read_index,
+                                       base_qualities=base_quality_segment)
 
             # increase the read index iterator
-            read_index += read_index_increment
+            read_index_iterator += read_index_increment
             ref_index += ref_index_increment
 
+        return read_index
+
     def process_reads(self, reads):
         """
-        Parse reads to aligned to a site to find variants
+        Parse reads to aligned to a site to find variants, reads are filtered by the BamHandler
         :param reads: Set of reads aligned
         :return:
         """
+        if self.read_downsampler is not None:
+            reads = self.read_downsampler.downsample_reads(reads, self.chromosome_name, self.allele_start_position)
         i = 0
         for read in reads:
             if i > IMAGE_HEIGHT-REF_BAND:
                 break
-            # check if the mapping quality of the read is above threshold
-            if read.mapping_quality > DEFAULT_MIN_MAP_QUALITY:
-                self.read_id_in_allele_position.append(read.query_name)
-                self._process_read(read=read)
-                i += 1
+            read_index = self._process_read(read=read)
+            self.read_id_in_allele_position.append(read_index)
+            i += 1
+
+    def decode_reads(self, reads):
+        """
+        Decode all the reads of a group of nearby alleles at once. The image window has to cover all the alleles of
+        the group, the reads of each allele are then selected with select_reads before generating its image.
+        :param reads: Set of reads aligned to the group, reads are filtered by the BamHandler
+        :return:
+        """
+        for read in reads:
+            self._process_read(read=read)
+
+    def set_window_reference(self, start_position, end_position):
+        """
+        Fetch the reference sequence of a region once, the reference of every image inside the region is sliced from
+        it instead of being fetched again.
+        :param start_position: Start position of the region
+        :param end_position: End position of the region
+        :return:
+        """
+        self.window_reference_start = max(0, start_position)
+        self.window_reference_bases = self.fasta_handler.get_sequence_bases(chromosome_name=self.chromosome_name,
+                                                                            start=self.window_reference_start,
+                                                                            stop=end_position)
+
+    def select_reads(self, allele_start_position, allele_end_position, read_indices=None):
+        """
+        Select the decoded reads that align to an allele of the group and move the image window to that allele. The
+        reads are selected the same way process_reads would select them from a fetch of the allele.
+        :param allele_start_position: Start position of the allele in question
+        :param allele_end_position: End position of the allele in question
+        :param read_indices: Indices of the reads picked for the allele by a downsampler, the first aligned reads if None
+        :return:
+        """
+        read_count = self.read_store.read_count
+        read_starts = self.read_store.read_starts[:read_count]
+        read_ends = self.read_store.read_ends[:read_count]
+        if read_indices is None:
+            read_indices = np.nonzero((read_starts < allele_end_position + 1) & (read_ends > allele_start_position))[0]
+            # process_reads decodes one read more than the image has rows
+            read_indices = read_indices[:MAX_READS_IN_IMAGE + 1]
+        read_indices = np.asarray(read_indices, dtype=np.int64)
+
+        self.read_id_in_allele_position = read_indices.tolist()
+        self.window_start = allele_start_position - IMAGE_WIDTH
+        self.window_end = allele_end_position + IMAGE_WIDTH + 1
+        self.leftmost_alignment_position = min([allele_start_position] + read_starts[read_indices].tolist())
+        self.rightmost_alignment_position = max([allele_end_position] + read_ends[read_indices].tolist())
+
+    def get_longest_inserts(self, read_indices):
+        """
+        Find the longest insert anchored at each position of the window among a set of reads.
+        :param read_indices: Array of read indices in the read store
+        :return: Array of insert lengths, indexed by genomic position - window start
+        """
+        longest_inserts = np.zeros(self.window_end - self.window_start, dtype=np.int64)
+        insert_read_indices, insert_positions, insert_offsets, insert_lengths, insert_bases, insert_qualities = \
+            self.read_store.get_inserts()
+        selected = np.isin(insert_read_indices, read_indices) & \
+            (insert_positions >= self.window_start) & (insert_positions < self.window_end)
+        np.maximum.at(longest_inserts, insert_positions[selected] - self.window_start, insert_lengths[selected])
+
+        return longest_inserts
 
     def get_start_and_end_positions(self, position):
         """
         If leftmost and rightmost positions are out of window then find the left and right boundaries.
+        Every position takes one column plus the length of the longest insert anchored to it, the column offsets of
+        the positions are calculated once with a cumulative sum and the boundaries are found with binary search.
         :param position: Position where the allele resides
         :return:
         """
-        distance_array = defaultdict(int)
-        distance_array[self.leftmost_alignment_position] = 0
-
-        for pos in range(self.leftmost_alignment_position, self.rightmost_alignment_position):
-            if pos in self.longest_insert_in_position.keys():
-                distance_array[pos + 1] += self.longest_insert_in_position[pos]
+        start = max(self.leftmost_alignment_position, self.window_start)
+        end = min(self.rightmost_alignment_position, self.window_end)
+        column_widths = 1 + self.longest_insert_in_position[start - self.window_start:end - self.window_start]
+        self.column_offsets = np.zeros(end - start + 1, dtype=np.int64)
+        np.cumsum(column_widths, out=self.column_offsets[1:])
+        self.column_offsets_start = start
 
-            distance_array[pos] = distance_array[pos-1] + 1
-
-        if self.rightmost_alignment_position - self.leftmost_alignment_position + 1 <= IMAGE_WIDTH:
+        if start == self.leftmost_alignment_position and end == self.rightmost_alignment_position and \
+                self.column_offsets[-1] <= IMAGE_WIDTH:
             return self.leftmost_alignment_position, self.rightmost_alignment_position
 
-        left_side = right_side = int((IMAGE_WIDTH-IMAGE_BUFFER) / 2)
-
-        left_val = max(0, distance_array[position] - left_side)
-        right_val = min(len(distance_array.keys()), distance_array[position] + right_side)
-        left_pos, right_pos = position, position
+        left_side = int((IMAGE_WIDTH-IMAGE_BUFFER) / 2)
 
-        for pos in sorted(distance_array.keys()):
-            if distance_array[pos] < left_val:
-                left_pos = pos
-            if distance_array[pos] < right_val:
-                right_pos = pos
+        # the allele is placed in the middle of the image and the image covers IMAGE_WIDTH columns from the left
+        allele_column = self.column_offsets[position - start]
+        left_index = np.searchsorted(self.column_offsets[:-1], allele_column - left_side, side='left')
+        right_index = np.searchsorted(self.column_offsets[:-1], self.column_offsets[left_index] + IMAGE_WIDTH,
+                                      side='left')
 
-        return left_pos, right_pos
+        return start + int(left_index), start + int(right_index)
 
     def get_reference_row(self, start_pos, end_pos):
         """
         Get the reference row.
         :param start_pos: Start position of the reference.
         :param end_pos: End position of the reference
-        :return:
+        :return: uint8 array of shape (IMAGE_WIDTH, IMAGE_CHANNELS)
         """
-        ref_row = [ImageChannels.get_empty_rgb_channels() for i in range(IMAGE_WIDTH)]
-        for i in range(start_pos, end_pos):
-            base = self.reference_dictionary[i]
-            if self.ref_to_index_projection[i] < IMAGE_WIDTH:
-                ref_row[self.ref_to_index_projection[i]] = ImageChannels.get_ref_channels_rgb(base)
+        ref_row = np.empty((IMAGE_WIDTH, IMAGE_CHANNELS), dtype=np.uint8)
+        ref_row[:] = ImageChannels.get_empty_rgb_channels()
+
+        indices = self.get_projected_indices(start_pos, end_pos)
+        ref_bases = self.get_reference_bases(start_pos, end_pos)
+        in_image = indices < IMAGE_WIDTH
+        ref_row[indices[in_image], 0:3] = RGB_LOOKUP_TABLE[0, ref_bases[in_image]]
+        ref_row[indices[in_image], 3] = ImageChannels.get_support_channel_rgb(True)
 
-            if i in self.longest_insert_in_position:
-                for j in range(self.longest_insert_in_position[i]):
-                    if self.ref_to_index_projection[i] + j + 1 < IMAGE_WIDTH:
-                        ref_row[self.ref_to_index_projection[i]+j+1] = ImageChannels.get_ref_channels_rgb('*')
+        insert_indices = self.get_insert_indices(start_pos, end_pos)
+        ref_row[insert_indices, 0:3] = RGB_LOOKUP_TABLE[0, ord('*')]
+        ref_row[insert_indices, 3] = ImageChannels.get_support_channel_rgb(True)
 
         return ref_row
 
-    def _if_read_supports_alt(self, read_id, position, alt):
+    def get_insert_indices(self, start_pos, end_pos):
+        """
+        Get the image indices reserved for inserted bases between two genomic positions.
+        :param start_pos: Leftmost genomic position in the image
+        :param end_pos: Rightmost genomic position in the image
+        :return: Array of image indices that are inside the image
+        """
+        insert_lengths = self.longest_insert_in_position[start_pos - self.window_start:end_pos - self.window_start]
+        has_insert = insert_lengths > 0
+        insert_lengths = insert_lengths[has_insert]
+        base_offsets = np.arange(insert_lengths.sum()) - np.repeat(np.cumsum(insert_lengths) - insert_lengths,
+                                                                   insert_lengths)
+        insert_indices = np.repeat(self.get_projected_indices(start_pos, end_pos)[has_insert] + 1, insert_lengths) \
+            + base_offsets
+
+        return insert_indices[insert_indices < IMAGE_WIDTH]
+
+    def get_projected_indices(self, start_pos, end_pos):
+        """
+        Get the image indices of genomic positions.
+        :param start_pos: Leftmost genomic position in the image
+        :param end_pos: Rightmost genomic position in the image
+        :return: Array of image indices of positions start_pos to end_pos
+        """
+        return self.ref_to_index_projection[start_pos - self.projection_start:end_pos - self.projection_start]
+
+    def get_reference_bases(self, start_pos, end_pos):
+        """
+        Get the reference bases between two genomic positions.
+        :param start_pos: Start position
+        :param end_pos: End position
+        :return: uint8 array of base bytes
+        """
+        return self.reference_bases[start_pos - self.reference_start:end_pos - self.reference_start]
+
+    def _if_read_supports_alt(self, read_index, position, alt):
         """
         Check if read supports the alt allele in question
-        :param read_id: Read id
+        :param read_index: Index of the read in the read store
         :param position: Position of the alt allele
         :param alt: The alt allele
         :return:
         """
         read_base = ''
-        if read_id in self.base_dictionary and position in self.base_dictionary[read_id]:
-            read_base += self.base_dictionary[read_id][position][0]
-        if len(alt) > 1 and read_id in self.insert_dictionary and position in self.insert_dictionary[read_id]:
-            read_base += self.insert_dictionary[read_id][position][0]
+        base = self.read_store.get_base(read_index, position)
+        if base != EMPTY_BASE:
+            read_base += chr(base)
+        if len(alt) > 1:
+            insert = self.read_store.get_insert(read_index, position)
+            if insert is not None:
+                read_base += insert[0].decode()
 
         if read_base == alt:
             return True
 
         return False
 
-    def get_read_row(self, read_id, left_pos, right_pos, alts, alt_position):
+    def get_read_rows(self, image_rows, read_indices, left_pos, right_pos, alts, alt_position):
         """
-        Convert a read to an image row
-        :param read_id: Read id
+        Convert reads to image rows
+        :param image_rows: Image rows to fill, uint8 array of shape (len(read_indices), IMAGE_WIDTH, IMAGE_CHANNELS)
+        :param read_indices: Array of read indices in the read store, one for each row
         :param left_pos: Leftmost position of the image
         :param right_pos: Rightmost position of the image
         :param alts: Alternate alleles
         :param alt_position: Alternate allele position
         :return:
         """
-        image_row = [ImageChannels.get_empty_rgb_channels() for i in range(IMAGE_WIDTH)]
-        is_supporting = False
-        is_match = False
-
-        for alt in alts:
-            is_supporting = is_supporting or self._if_read_supports_alt(read_id, alt_position, alt)
-
-        for pos in range(left_pos, right_pos):
-            if read_id in self.base_dictionary and pos in self.base_dictionary[read_id]:
-                base, map_q, base_q, is_rev, cigar_op = self.base_dictionary[read_id][pos]
-                if base == self.reference_dictionary[pos]:
-                    is_match = True
-
-                attribute_tuple = (base, base_q, map_q, is_rev, is_match, is_supporting)
-                # create channels for the base in that position
-                channels = ImageChannels.get_channels_only_rgb(attribute_tuple, self.reference_dictionary[pos])
-                if self.ref_to_index_projection[pos] < IMAGE_WIDTH:
-                    image_row[self.ref_to_index_projection[pos]] = channels
-
-            is_match = False
-            if read_id in self.insert_dictionary and pos in self.insert_dictionary[read_id]:
-                # if there is an insert
-                bases, map_q, base_qs, is_rev, cigar_op = self.insert_dictionary[read_id][pos]
-                row_index = self.ref_to_index_projection[pos] + 1
-
-                # for each base of the insert
-                for i, base in enumerate(bases):
-                    attribute_tuple = (base, base_qs[i], map_q, is_rev, is_match, is_supporting)
-                    channels = ImageChannels.get_channels_only_rgb(attribute_tuple, self.reference_dictionary[pos])
-                    if row_index < IMAGE_WIDTH:
-                        image_row[row_index] = channels
-                    row_index += 1
-
-                # if the insert is not the longest insert of that position
-                if len(bases) < self.longest_insert_in_position[pos]:
-                    for i in range(self.longest_insert_in_position[pos]-len(bases)):
-                        attribute_tuple = ('*', 0, map_q, is_rev, is_match, is_supporting)
-                        channels = ImageChannels.get_channels_only_rgb(attribute_tuple, '')
-                        if row_index < IMAGE_WIDTH:
-                            image_row[row_index] = channels
-                        row_index += 1
-            # if there is an insert at this position but not in the read
-            elif pos in self.longest_insert_in_position:
-                row_index = self.ref_to_index_projection[pos] + 1
-                for i in range(self.longest_insert_in_position[pos]):
-                    attribute_tuple = ('*', 0, self.read_mq_dict[read_id], self.read_rev_dict[read_id], False, is_supporting)
-                    channels = ImageChannels.get_channels_only_rgb(attribute_tuple, '')
-                    if row_index < IMAGE_WIDTH:
-                        image_row[row_index] = channels
-                    row_index += 1
-
-        return image_row
-
-    def generate_read_pileups(self, left_pos, right_pos, position, alts):
+        support_channels = np.empty(len(read_indices), dtype=np.uint8)
+        for i, read_index in enumerate(read_indices):
+            is_supporting = False
+            for alt in alts:
+                is_supporting = is_supporting or self._if_read_supports_alt(read_index, alt_position, alt)
+            support_channels[i] = ImageChannels.get_support_channel_rgb(is_supporting)
+
+        # reads that do not have an insert in a position are padded with '*' in the insert indices
+        insert_indices = self.get_insert_indices(left_pos, right_pos)
+        image_rows[:, insert_indices, 0:3] = RGB_LOOKUP_TABLE[0, ord('*')]
+        image_rows[:, insert_indices, 3] = support_channels[:, np.newaxis]
+
+        # aligned bases
+        indices = self.get_projected_indices(left_pos, right_pos)
+        ref_bases = self.get_reference_bases(left_pos, right_pos)
+        read_bases = self.read_store.get_window('bases', read_indices, left_pos, right_pos)
+        rows, columns = np.nonzero((read_bases != EMPTY_BASE) & (indices < IMAGE_WIDTH))
+        image_rows[rows, indices[columns], 0:3] = RGB_LOOKUP_TABLE[ref_bases[columns], read_bases[rows, columns]]
+        image_rows[rows, indices[columns], 3] = support_channels[rows]
+
+        # inserted bases, colored against the reference base of their anchor
+        insert_read_indices, insert_positions, insert_offsets, insert_lengths, insert_bases, insert_qualities = \
+            self.read_store.get_inserts()
+        row_of_read = np.full(self.read_store.read_count, -1, dtype=np.int64)
+        row_of_read[read_indices] = np.arange(len(read_indices))
+        selected = (row_of_read[insert_read_indices] >= 0) & \
+                   (insert_positions >= left_pos) & (insert_positions < right_pos)
+
+        insert_lengths = insert_lengths[selected]
+        base_offsets = np.arange(insert_lengths.sum()) - np.repeat(np.cumsum(insert_lengths) - insert_lengths,
+                                                                   insert_lengths)
+        anchor_columns = np.repeat(insert_positions[selected] - left_pos, insert_lengths)
+        rows = np.repeat(row_of_read[insert_read_indices[selected]], insert_lengths)
+        image_indices = indices[anchor_columns] + 1 + base_offsets
+        bases = insert_bases[np.repeat(insert_offsets[selected], insert_lengths) + base_offsets]
+
+        in_image = image_indices < IMAGE_WIDTH
+        rows = rows[in_image]
+        image_rows[rows, image_indices[in_image], 0:3] = RGB_LOOKUP_TABLE[ref_bases[anchor_columns[in_image]],
+                                                                          bases[in_image]]
+        image_rows[rows, image_indices[in_image], 3] = support_channels[rows]
+
+    def generate_read_pileups(self, image_array, left_pos, right_pos, position, alts):
         """
         Generate rows for the reads that align to an allele position.
+        :param image_array: Image to fill, read rows start after the reference band
         :param left_pos: Leftmost position in the image
         :param right_pos: Rightmost position in the image
         :param position: Alternate allele position
         :param alts: Alternate alleles in question
         :return:
         """
-        all_read_ids = self.read_id_in_allele_position
-        image_rows = list()
-        for read_id in all_read_ids:
-            image_rows.append(self.get_read_row(read_id, left_pos, right_pos, alts, position))
-            if len(image_rows) == IMAGE_HEIGHT - REF_BAND:
-                break
-
-        return image_rows
+        read_indices = np.array(self.read_id_in_allele_position[:IMAGE_HEIGHT - REF_BAND], dtype=np.int64)
+        self.get_read_rows(image_array[REF_BAND:REF_BAND + len(read_indices)], read_indices, left_pos, right_pos,
+                           alts, position)
 
     def project_ref_positions(self, left_pos, right_pos):
         """
@@ -487,12 +519,10 @@ class ImageCreatorRGB:
         :param right_pos: Rightmost genomic position in the image
         :return:
         """
-        index = 0
-        for pos in range(left_pos, right_pos):
-            self.ref_to_index_projection[pos] = index
-            if pos in self.longest_insert_in_position.keys():
-                index += self.longest_insert_in_position[pos]
-            index += 1
+        left_index = left_pos - self.column_offsets_start
+        right_index = right_pos - self.column_offsets_start
+        self.ref_to_index_projection = self.column_offsets[left_index:right_index] - self.column_offsets[left_index]
+        self.projection_start = left_pos
 
     def _update_ref_sequence(self, start_position, end_position):
         """
@@ -501,12 +531,15 @@ class ImageCreatorRGB:
         :param end_position: End position
         :return:
         """
-        ref_sequence = self.fasta_handler.get_sequence(chromosome_name=self.chromosome_name,
-                                                       start=start_position,
-                                                       stop=end_position)
-
-        for i, ref_base in enumerate(ref_sequence):
-            self._update_reference_dictionary(start_position + i, ref_base)
+        if self.window_reference_bases is not None:
+            self.reference_bases = \
+                self.window_reference_bases[start_position - self.window_reference_start:
+                                            end_position - self.window_reference_start]
+        else:
+            self.reference_bases = self.fasta_handler.get_sequence_bases(chromosome_name=self.chromosome_name,
+                                                                         start=start_position,
+                                                                         stop=end_position)
+        self.reference_start = start_position
 
     def generate_image(self, position, alts):
         """
@@ -515,19 +548,14 @@ class ImageCreatorRGB:
         :param alts: Alternate alleles
         :return:
         """
+        self.longest_insert_in_position = self.get_longest_inserts(np.array(self.read_id_in_allele_position,
+                                                                            dtype=np.int64))
         left_pos, right_pos = self.get_start_and_end_positions(position)
         self._update_ref_sequence(left_pos, right_pos)
         self.project_ref_positions(left_pos, right_pos)
-        img_data = list()
-        for i in range(REF_BAND):
-            img_data.append(self.get_reference_row(left_pos, right_pos))
-
-        img_data = img_data + self.generate_read_pileups(left_pos, right_pos, position, [alts])
-
-        while len(img_data) < IMAGE_HEIGHT:
-            image_row = [ImageChannels.get_empty_rgb_channels() for i in range(IMAGE_WIDTH)]
-            img_data.append(image_row)
-
-        image_array = np.array(img_data).astype(np.uint8)
+        image_array = np.empty((IMAGE_HEIGHT, IMAGE_WIDTH, IMAGE_CHANNELS), dtype=np.uint8)
+        image_array[:] = ImageChannels.get_empty_rgb_channels()
+        image_array[0:REF_BAND] = self.get_reference_row(left_pos, right_pos)
+        self.generate_read_pileups(image_array, left_pos, right_pos, position, [alts])
 
         return image_array
@@ -0,0 +1,72 @@
+import os
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+"""
+Keeps the location and status of the image of every bed record so images can be found without file system calls.
+"""
+
+NOT_GENERATED = 0
+IN_TENSOR_STORE = 1
+PNG_FILE = 2
+
+
+class ImageManifest:
+    """
+    Status of the image of every record, indexed by record index.
+    - Built once from the index of the tensor store and a single listing of the image directory.
+    - Status is kept in shared memory, every worker process maps the same pages. A record marked as generated by a
+    worker is seen by the parent and by the workers of later epochs without a file system call.
+    """
+    def __init__(self, image_dir, file_names, tensor_store):
+        """
+        Build the manifest of a set of records
+        :param image_dir: Directory of the images
+        :param file_names: Image file name of each record without the extension, any iterable in record order
+        :param tensor_store: Tensor store of the image directory
+        """
+        png_files = set(os.listdir(image_dir)) if os.path.isdir(image_dir) else set()
+
+        status = np.fromiter((IN_TENSOR_STORE if file_name in tensor_store else
+                              PNG_FILE if file_name + ".png" in png_files else
+                              NOT_GENERATED for file_name in file_names), dtype=np.int8)
+
+        self.shared_status = RawArray(ctypes.c_int8, len(status))
+        self.status = np.frombuffer(self.shared_status, dtype=np.int8)
+        self.status[:] = status
+
+    def __getstate__(self):
+        # the shared memory is passed to a spawned worker, the numpy view is created again so it isn't copied
+        state = self.__dict__.copy()
+        state['status'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.status = np.frombuffer(self.shared_status, dtype=np.int8)
+
+    def get_status(self, index):
+        """
+        Get the status of the image of a record
+        :param index: Index of the record
+        :return: NOT_GENERATED, IN_TENSOR_STORE or PNG_FILE
+        """
+        return self.status[index]
+
+    def mark_generated(self, index):
+        """
+        Mark the image of a record as generated in every process, the image should be saved as a PNG file before it's
+        marked.
+        :param index: Index of the record
+        :return:
+        """
+        self.status[index] = PNG_FILE
+
+    def get_counts(self):
+        """
+        Get the number of records of each status
+        :return: Not generated, in tensor store and PNG file counts
+        """
+        counts = np.bincount(self.status, minlength=3)
+        return int(counts[NOT_GENERATED]), int(counts[IN_TENSOR_STORE]), int(counts[PNG_FILE])
@@ -0,0 +1,269 @@
+import os
+import numpy as np
+from modules.ReadStore import ReadStore
+
+"""
+Stores the decoded reads of candidate regions in columnar shard files so images can be rendered again without the bam.
+"""
+
+DATA_FILE_EXTENSION = ".reads"
+INDEX_FILE_EXTENSION = ".reads.index.npz"
+# entries start at multiples of this many bytes so their int64 columns are aligned
+ENTRY_ALIGNMENT = 8
+
+# counts of an entry that give the lengths of its columns
+READ_COUNT = 0
+SPAN_BASE_COUNT = 1
+INSERT_COUNT = 2
+INSERT_BASE_COUNT = 3
+CANDIDATE_COUNT = 4
+CANDIDATE_READ_COUNT = 5
+ENTRY_COUNTS = 6
+
+# columns of an entry in the order they are written, with their dtype and the count that gives their length. int64
+# columns come first so they stay aligned.
+ENTRY_COLUMNS = [('read_starts', np.int64, READ_COUNT),
+                 ('read_ends', np.int64, READ_COUNT),
+                 ('span_starts', np.int64, READ_COUNT),
+                 ('span_lengths', np.int64, READ_COUNT),
+                 ('insert_read_indices', np.int64, INSERT_COUNT),
+                 ('insert_positions', np.int64, INSERT_COUNT),
+                 ('insert_lengths', np.int64, INSERT_COUNT),
+                 ('candidate_read_counts', np.int64, CANDIDATE_COUNT),
+                 ('candidate_read_indices', np.int64, CANDIDATE_READ_COUNT),
+                 ('map_qualities', np.uint8, READ_COUNT),
+                 ('is_reverse', np.uint8, READ_COUNT),
+                 ('bases', np.uint8, SPAN_BASE_COUNT),
+                 ('base_qualities', np.uint8, SPAN_BASE_COUNT),
+                 ('cigar_codes', np.uint8, SPAN_BASE_COUNT),
+                 ('insert_bases', np.uint8, INSERT_BASE_COUNT),
+                 ('insert_qualities', np.uint8, INSERT_BASE_COUNT)]
+
+
+class ReadCacheWriter:
+    """
+    Writes the decoded reads of candidate regions to a shard.
+    - An entry is the read store of a region: the strand, mapping quality and alignment span of every read, its bases,
+    base qualities and cigar codes from its first to its last base in the window and its inserts. Every attribute is
+    written as one column of the entry.
+    - The reads picked for every candidate of the region can be kept with the entry, otherwise the renderer selects
+    them.
+    - Files are written with a temporary name and renamed when the shard is closed, a shard is either complete or
+    not visible at all.
+    """
+    def __init__(self, cache_dir, shard_name):
+        """
+        Initialize a shard writer
+        :param cache_dir: Directory of the read cache
+        :param shard_name: Name of the shard
+        """
+        self.data_file_path = os.path.abspath(cache_dir + shard_name) + DATA_FILE_EXTENSION
+        self.index_file_path = os.path.abspath(cache_dir + shard_name) + INDEX_FILE_EXTENSION
+
+        self.data_file = open(self.data_file_path + ".tmp", 'wb')
+        self.data_size = 0
+        self.keys = list()
+        self.offsets = list()
+        # [entry] = (window start, window end)
+        self.windows = list()
+        self.counts = list()
+
+    @staticmethod
+    def get_entry_columns(read_store, candidate_read_indices=None):
+        """
+        Get the columns of an entry from a read store
+        :param read_store: Read store of the region
+        :param candidate_read_indices: Read indices picked for every candidate of the region, None if not picked
+        :return: Dictionary of the columns
+        """
+        read_count = read_store.read_count
+        span_starts, span_lengths = read_store.get_read_spans()
+        rows = np.repeat(np.arange(read_count), span_lengths)
+        columns = np.repeat(span_starts - (np.cumsum(span_lengths) - span_lengths), span_lengths) + np.arange(len(rows))
+
+        # a replaced insert leaves its old bases in the store, only the current bases of the inserts are written
+        insert_read_indices, insert_positions, insert_offsets, insert_lengths, insert_bases, insert_qualities = \
+            read_store.get_inserts()
+        base_indices = np.repeat(insert_offsets - (np.cumsum(insert_lengths) - insert_lengths), insert_lengths) + \
+            np.arange(insert_lengths.sum())
+
+        if candidate_read_indices is None:
+            candidate_read_indices = list()
+        return {'read_starts': read_store.read_starts[:read_count],
+                'read_ends': read_store.read_ends[:read_count],
+                'span_starts': span_starts,
+                'span_lengths': span_lengths,
+                'insert_read_indices': insert_read_indices,
+                'insert_positions': insert_positions,
+                'insert_lengths': insert_lengths,
+                'candidate_read_counts': np.array([len(read_indices) for read_indices in candidate_read_indices],
+                                                  dtype=np.int64),
+                'candidate_read_indices': np.concatenate([np.asarray(read_indices, dtype=np.int64)
+                                                          for read_indices in candidate_read_indices])
+                if candidate_read_indices else np.zeros(0, dtype=np.int64),
+                'map_qualities': read_store.map_qualities[:read_count],
+                'is_reverse': read_store.is_reverse[:read_count],
+                'bases': read_store.bases[rows, columns],
+                'base_qualities': read_store.base_qualities[rows, columns],
+                'cigar_codes': read_store.cigar_codes[rows, columns],
+                'insert_bases': insert_bases[base_indices],
+                'insert_qualities': insert_qualities[base_indices]}
+
+    def add(self, key, read_store, candidate_read_indices=None):
+        """
+        Append the reads of a region to the shard
+        :param key: Key of the region
+        :param read_store: Read store of the region
+        :param candidate_read_indices: Read indices picked for every candidate of the region, None if the renderer
+        selects the reads
+        :return:
+        """
+        entry_columns = self.get_entry_columns(read_store, candidate_read_indices)
+        counts = [0] * ENTRY_COUNTS
+        for column_name, dtype, count_index in ENTRY_COLUMNS:
+            counts[count_index] = len(entry_columns[column_name])
+
+        self.keys.append(key)
+        self.offsets.append(self.data_size)
+        window_end = read_store.window_end if read_store.window_end is not None else \
+            read_store.window_start + read_store.bases.shape[1]
+        self.windows.append((read_store.window_start, window_end))
+        self.counts.append(counts)
+
+        for column_name, dtype, count_index in ENTRY_COLUMNS:
+            column_bytes = np.ascontiguousarray(entry_columns[column_name], dtype=dtype).tobytes()
+            self.data_file.write(column_bytes)
+            self.data_size += len(column_bytes)
+        padding = -self.data_size % ENTRY_ALIGNMENT
+        self.data_file.write(b'\0' * padding)
+        self.data_size += padding
+
+    def close(self):
+        """
+        Finish writing the shard, the data file is renamed before the index so a visible index always has its data.
+        A shard without entries is not written.
+        :return:
+        """
+        self.data_file.close()
+        if not self.keys:
+            os.remove(self.data_file_path + ".tmp")
+            return
+        os.replace(self.data_file_path + ".tmp", self.data_file_path)
+
+        with open(self.index_file_path + ".tmp", 'wb') as index_file:
+            np.savez(index_file,
+                     keys=np.array(self.keys, dtype=np.str_),
+                     offsets=np.array(self.offsets, dtype=np.int64),
+                     windows=np.array(self.windows, dtype=np.int64).reshape(-1, 2),
+                     counts=np.array(self.counts, dtype=np.int64).reshape(-1, ENTRY_COUNTS))
+        os.replace(self.index_file_path + ".tmp", self.index_file_path)
+
+
+class ReadCache:
+    """
+    Reads the decoded reads of all the shards in a directory.
+    - Indexes of the shards are loaded once, entries are found by key.
+    - Data files are memory mapped when first accessed. The columns of an entry are views of the map and are copied
+    once into a read store, no read is parsed again.
+    - An entry only covers the window it was decoded with, has_window tells if that window covers the window of a
+    renderer.
+    """
+    def __init__(self, cache_dir):
+        """
+        Load the indexes of the shards in a directory
+        :param cache_dir: Directory of the read cache
+        """
+        self.cache_dir = cache_dir
+        self.data_file_paths = list()
+        # memory maps of the data files, opened on first access
+        self.data_maps = list()
+        # [key] = (shard index, offset, window start, window end, counts)
+        self.entries = {}
+
+        if os.path.isdir(cache_dir):
+            for file_name in sorted(os.listdir(cache_dir)):
+                if file_name.endswith(INDEX_FILE_EXTENSION):
+                    self.load_shard_index(file_name[:-len(INDEX_FILE_EXTENSION)])
+
+    def load_shard_index(self, shard_name):
+        """
+        Load the index of a shard
+        :param shard_name: Name of the shard
+        :return:
+        """
+        shard_index = len(self.data_file_paths)
+        with np.load(os.path.abspath(self.cache_dir + shard_name) + INDEX_FILE_EXTENSION) as index:
+            keys = index['keys'].tolist()
+            offsets = index['offsets'].tolist()
+            windows = index['windows'].tolist()
+            counts = index['counts'].tolist()
+
+        self.data_file_paths.append(os.path.abspath(self.cache_dir + shard_name) + DATA_FILE_EXTENSION)
+        self.data_maps.append(None)
+        for key, offset, (window_start, window_end), entry_counts in zip(keys, offsets, windows, counts):
+            self.entries[key] = (shard_index, offset, window_start, window_end, entry_counts)
+
+    def __getstate__(self):
+        # memory maps are not copied to worker processes, every process maps the data files again
+        state = self.__dict__.copy()
+        state['data_maps'] = [None] * len(self.data_maps)
+        return state
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def has_window(self, key, window_start, window_end):
+        """
+        Check if there is an entry of a region whose reads are decoded over a window
+        :param key: Key of the region
+        :param window_start: Start of the window
+        :param window_end: End of the window
+        :return: True if the entry exists and its window covers the window
+        """
+        if key not in self.entries:
+            return False
+        shard_index, offset, entry_window_start, entry_window_end, entry_counts = self.entries[key]
+        return entry_window_start <= window_start and entry_window_end >= window_end
+
+    def get_entry_columns(self, key):
+        """
+        Get the columns of an entry
+        :param key: Key of the region
+        :return: Window start, window end, dictionary of read only column arrays that are views of the memory map
+        """
+        shard_index, offset, window_start, window_end, entry_counts = self.entries[key]
+        if self.data_maps[shard_index] is None:
+            self.data_maps[shard_index] = np.memmap(self.data_file_paths[shard_index], dtype=np.uint8, mode='r')
+
+        data_map = self.data_maps[shard_index]
+        entry_columns = {}
+        for column_name, dtype, count_index in ENTRY_COLUMNS:
+            size = entry_counts[count_index] * np.dtype(dtype).itemsize
+            entry_columns[column_name] = data_map[offset:offset + size].view(dtype)
+            offset += size
+        return window_start, window_end, entry_columns
+
+    def get(self, key):
+        """
+        Get the reads of a region
+        :param key: Key of the region
+        :return: Read store of the region, read indices picked for every candidate of the region or None
+        """
+        window_start, window_end, entry_columns = self.get_entry_columns(key)
+        read_store = ReadStore(window_start, window_end)
+        read_store.set_reads(entry_columns['read_starts'], entry_columns['read_ends'], entry_columns['map_qualities'],
+                             entry_columns['is_reverse'], entry_columns['span_starts'], entry_columns['span_lengths'],
+                             entry_columns['bases'], entry_columns['base_qualities'], entry_columns['cigar_codes'])
+        read_store.set_inserts(entry_columns['insert_read_indices'], entry_columns['insert_positions'],
+                               entry_columns['insert_lengths'], entry_columns['insert_bases'],
+                               entry_columns['insert_qualities'])
+
+        candidate_read_counts = entry_columns['candidate_read_counts']
+        if not len(candidate_read_counts):
+            return read_store, None
+        candidate_read_ends = np.cumsum(candidate_read_counts)
+        candidate_read_indices = np.split(np.array(entry_columns['candidate_read_indices']), candidate_read_ends[:-1])
+        return read_store, candidate_read_indices
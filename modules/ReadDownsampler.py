@@ -0,0 +1,75 @@
+import heapq
+import zlib
+import numpy as np
+
+"""
+Chooses the reads of deep sites before they are decoded so the cost of a site is bounded by the image height.
+"""
+
+
+class ReadDownsampler:
+    """
+    Picks a fixed size random subset of the reads that overlap a candidate.
+    - Every read gets a random key and the reads with the smallest keys are kept, the reads are streamed and at most
+    max_reads reads of each strand are held at once.
+    - The random state is seeded with the seed, the chromosome and the position of the candidate, so the same reads are
+    picked for a candidate no matter which other candidates are processed with it.
+    - If strand balanced, half of the reads come from each strand and the other strand fills in when a strand is short.
+    - Picked reads are returned in the order they are given.
+    """
+    def __init__(self, max_reads, seed=0, strand_balanced=False):
+        """
+        Initialize a read downsampler
+        :param max_reads: Maximum number of reads of a candidate
+        :param seed: Seed of the random choice
+        :param strand_balanced: If true half of the reads are picked from each strand
+        """
+        self.max_reads = max_reads
+        self.seed = seed
+        self.strand_balanced = strand_balanced
+
+    def get_settings_key(self):
+        """
+        Return a key of the settings that decide which reads are picked
+        :return: String key
+        """
+        return "downsample:" + str(self.max_reads) + ":" + str(self.seed) + ":" + str(self.strand_balanced)
+
+    def get_random_state(self, chromosome_name, position):
+        """
+        Return the random state of a candidate
+        :param chromosome_name: Chromosome name
+        :param position: Position of the candidate
+        :return: numpy RandomState
+        """
+        return np.random.RandomState([self.seed, zlib.crc32(chromosome_name.encode()), position])
+
+    def downsample_reads(self, reads, chromosome_name, position):
+        """
+        Pick the reads of a candidate
+        :param reads: Iterator of the reads that overlap the candidate
+        :param chromosome_name: Chromosome name
+        :param position: Position of the candidate
+        :return: List of picked reads in the order they are given
+        """
+        random_state = self.get_random_state(chromosome_name, position)
+        # [strand] = heap of (-key, read order, read), the read with the largest key is on top
+        strand_heaps = [list(), list()]
+        for read_order, read in enumerate(reads):
+            key = random_state.random_sample()
+            strand_heap = strand_heaps[read.is_reverse if self.strand_balanced else 0]
+            if len(strand_heap) < self.max_reads:
+                heapq.heappush(strand_heap, (-key, read_order, read))
+            elif -strand_heap[0][0] > key:
+                heapq.heapreplace(strand_heap, (-key, read_order, read))
+
+        if self.strand_balanced:
+            forward_heap, reverse_heap = strand_heaps
+            forward_count = min(len(forward_heap), max(self.max_reads // 2, self.max_reads - len(reverse_heap)))
+            reverse_count = min(len(reverse_heap), self.max_reads - forward_count)
+            # the reads of a strand with the smallest keys
+            picked = heapq.nlargest(forward_count, forward_heap) + heapq.nlargest(reverse_count, reverse_heap)
+        else:
+            picked = strand_heaps[0]
+
+        return [read for key, read_order, read in sorted(picked, key=lambda item: item[1])]
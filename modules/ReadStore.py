@@ -0,0 +1,388 @@
+import numpy as np
+
+"""
+Stores the reads aligned to a genomic window in dense arrays so images can be created by slicing.
+"""
+
+EMPTY_BASE = 0
+INITIAL_READ_CAPACITY = 64
+INITIAL_WINDOW_WIDTH = 512
+
+
+class ReadStore:
+    """
+    Dense storage of reads in a genomic window.
+    - Reads are referred by integer indices given in the order they are added.
+    - Bases, base qualities and cigar codes are kept in (reads x window columns) uint8 arrays.
+    - Inserted bases are kept in a ragged array, one entry per read and anchor position.
+    """
+    def __init__(self, window_start, window_end=None):
+        """
+        Initialize an empty read store.
+        :param window_start: First genomic position of the window
+        :param window_end: Genomic position after the last position of the window. If None the window grows to the
+        right as bases are added.
+        """
+        self.window_start = window_start
+        self.window_end = window_end
+        window_width = window_end - window_start if window_end is not None else INITIAL_WINDOW_WIDTH
+
+        # attributes of the reads
+        self.read_count = 0
+        self.read_names = list()
+        self.read_starts = np.zeros(INITIAL_READ_CAPACITY, dtype=np.int64)
+        self.read_ends = np.zeros(INITIAL_READ_CAPACITY, dtype=np.int64)
+        self.map_qualities = np.zeros(INITIAL_READ_CAPACITY, dtype=np.uint8)
+        self.is_reverse = np.zeros(INITIAL_READ_CAPACITY, dtype=np.bool_)
+
+        # [read_index, genomic_position - window_start]
+        self.bases = np.zeros((INITIAL_READ_CAPACITY, window_width), dtype=np.uint8)
+        self.base_qualities = np.zeros((INITIAL_READ_CAPACITY, window_width), dtype=np.uint8)
+        self.cigar_codes = np.zeros((INITIAL_READ_CAPACITY, window_width), dtype=np.uint8)
+
+        # inserted bases, insert i of read insert_read_indices[i] is anchored at insert_positions[i] and its bases are
+        # insert_bases[insert_offsets[i]:insert_offsets[i] + insert_lengths[i]]
+        self.insert_read_indices = list()
+        self.insert_positions = list()
+        self.insert_offsets = list()
+        self.insert_lengths = list()
+        self.insert_bases = bytearray()
+        self.insert_qualities = bytearray()
+        # [(read_index, genomic_position)] = index of the insert
+        self.insert_lookup = {}
+
+    def _grow_reads(self):
+        """
+        Double the number of reads the arrays can hold.
+        :return:
+        """
+        capacity = 2 * len(self.read_starts)
+        for attribute in ['read_starts', 'read_ends', 'map_qualities', 'is_reverse',
+                          'bases', 'base_qualities', 'cigar_codes']:
+            array = getattr(self, attribute)
+            grown_array = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown_array[:len(array)] = array
+            setattr(self, attribute, grown_array)
+
+    def _grow_window(self, end_position):
+        """
+        Grow the columns of a store without a fixed window end so it covers a genomic position.
+        :param end_position: Genomic position after the last position that needs to be stored
+        :return:
+        """
+        width = max(2 * self.bases.shape[1], end_position - self.window_start)
+        for attribute in ['bases', 'base_qualities', 'cigar_codes']:
+            array = getattr(self, attribute)
+            grown_array = np.zeros((array.shape[0], width), dtype=array.dtype)
+            grown_array[:, :array.shape[1]] = array
+            setattr(self, attribute, grown_array)
+
+    def add_read(self, read_name, read_start, read_end, map_quality, is_reverse):
+        """
+        Add a read to the store.
+        :param read_name: Name of the read
+        :param read_start: Genomic position where the read alignment starts
+        :param read_end: Genomic position where the read alignment ends
+        :param map_quality: Mapping quality of the read
+        :param is_reverse: True if the read is reversed
+        :return: Index of the read
+        """
+        if self.read_count == len(self.read_starts):
+            self._grow_reads()
+
+        read_index = self.read_count
+        self.read_names.append(read_name)
+        self.read_starts[read_index] = read_start
+        self.read_ends[read_index] = read_end
+        self.map_qualities[read_index] = min(map_quality, 255)
+        self.is_reverse[read_index] = is_reverse
+        self.read_count += 1
+
+        return read_index
+
+    def _clip_to_window(self, position, length):
+        """
+        Clip a genomic interval to the window, growing the window if it has no fixed end.
+        :param position: Start of the interval
+        :param length: Length of the interval
+        :return: Offset of the clipped start in the interval, clipped start and end columns of the window
+        """
+        start = max(position, self.window_start)
+        end = position + length
+        if self.window_end is not None:
+            end = min(end, self.window_end)
+        elif end - self.window_start > self.bases.shape[1]:
+            self._grow_window(end)
+
+        return start - position, start - self.window_start, end - self.window_start
+
+    def set_bases(self, read_index, position, length, bases, base_qualities, cigar_code):
+        """
+        Set consecutive bases of a read. Bases outside of the window are ignored.
+        :param read_index: Index of the read
+        :param position: Genomic position of the first base
+        :param length: Number of bases
+        :param bases: Base bytes, a bytes like object of the given length or a single value
+        :param base_qualities: Base qualities, a bytes like object of the given length or a single value
+        :param cigar_code: Cigar operation of the bases
+        :return:
+        """
+        offset, start, end = self._clip_to_window(position, length)
+        if start >= end:
+            return
+
+        if not isinstance(bases, (int, np.integer)):
+            bases = np.frombuffer(bases, dtype=np.uint8)[offset:offset + end - start]
+        if not isinstance(base_qualities, (int, np.integer)):
+            base_qualities = np.frombuffer(base_qualities, dtype=np.uint8)[offset:offset + end - start]
+
+        self.bases[read_index, start:end] = bases
+        self.base_qualities[read_index, start:end] = base_qualities
+        self.cigar_codes[read_index, start:end] = cigar_code
+
+    def set_base(self, read_index, position, base, base_quality, cigar_code):
+        """
+        Set a single base of a read. A base outside of the window is ignored.
+        :param read_index: Index of the read
+        :param position: Genomic position of the base
+        :param base: Base byte
+        :param base_quality: Base quality
+        :param cigar_code: Cigar operation of the base
+        :return:
+        """
+        column = position - self.window_start
+        if column < 0 or (self.window_end is not None and position >= self.window_end):
+            return
+        if column >= self.bases.shape[1]:
+            self._grow_window(position + 1)
+
+        self.bases[read_index, column] = base
+        self.base_qualities[read_index, column] = base_quality
+        self.cigar_codes[read_index, column] = cigar_code
+
+    def is_in_window(self, position):
+        """
+        Check if a genomic position is in the window.
+        :param position: Genomic position
+        :return: True if the position is in the window
+        """
+        return position >= self.window_start and (self.window_end is None or position < self.window_end)
+
+    def add_insert(self, read_index, position, bases, base_qualities):
+        """
+        Add inserted bases of a read anchored to a genomic position. Replaces the previous insert of the read in that
+        position. Inserts anchored outside of the window are ignored.
+        :param read_index: Index of the read
+        :param position: Genomic position of the anchor base
+        :param bases: Inserted bases, bytes like object
+        :param base_qualities: Base qualities of the inserted bases, bytes like object
+        :return:
+        """
+        if not self.is_in_window(position):
+            return
+
+        key = (read_index, position)
+        if key in self.insert_lookup:
+            insert_index = self.insert_lookup[key]
+            self.insert_offsets[insert_index] = len(self.insert_bases)
+            self.insert_lengths[insert_index] = len(bases)
+        else:
+            self.insert_lookup[key] = len(self.insert_positions)
+            self.insert_read_indices.append(read_index)
+            self.insert_positions.append(position)
+            self.insert_offsets.append(len(self.insert_bases))
+            self.insert_lengths.append(len(bases))
+
+        self.insert_bases += bases
+        self.insert_qualities += bytes(base_qualities)
+
+    def get_base(self, read_index, position):
+        """
+        Get a base of a read.
+        :param read_index: Index of the read
+        :param position: Genomic position
+        :return: Base byte, EMPTY_BASE if the read has no base in that position
+        """
+        column = position - self.window_start
+        if column < 0 or column >= self.bases.shape[1]:
+            return EMPTY_BASE
+        return self.bases[read_index, column]
+
+    def get_insert(self, read_index, position):
+        """
+        Get the inserted bases of a read anchored to a genomic position.
+        :param read_index: Index of the read
+        :param position: Genomic position of the anchor base
+        :return: Inserted bases and their qualities as bytes, None if the read has no insert in that position
+        """
+        key = (read_index, position)
+        if key not in self.insert_lookup:
+            return None
+        insert_index = self.insert_lookup[key]
+        offset = self.insert_offsets[insert_index]
+        length = self.insert_lengths[insert_index]
+        return bytes(self.insert_bases[offset:offset + length]), bytes(self.insert_qualities[offset:offset + length])
+
+    def get_window(self, attribute, read_indices, start_position, end_position):
+        """
+        Slice a dense attribute for a set of reads and genomic positions. Positions outside of the window are empty.
+        :param attribute: One of 'bases', 'base_qualities' or 'cigar_codes'
+        :param read_indices: Array of read indices
+        :param start_position: First genomic position
+        :param end_position: Genomic position after the last position
+        :return: Array of shape (len(read_indices), end_position - start_position)
+        """
+        array = getattr(self, attribute)
+        window = np.zeros((len(read_indices), end_position - start_position), dtype=array.dtype)
+        start = max(start_position, self.window_start)
+        end = min(end_position, self.window_start + array.shape[1])
+        if start < end:
+            window[:, start - start_position:end - start_position] = \
+                array[read_indices, start - self.window_start:end - self.window_start]
+        return window
+
+    def get_inserts(self):
+        """
+        Get all the inserts as arrays.
+        :return: Read indices, anchor positions, offsets and lengths of the inserts, inserted bases and their qualities
+        """
+        return np.array(self.insert_read_indices, dtype=np.int64), \
+            np.array(self.insert_positions, dtype=np.int64), \
+            np.array(self.insert_offsets, dtype=np.int64), \
+            np.array(self.insert_lengths, dtype=np.int64), \
+            np.frombuffer(bytes(self.insert_bases), dtype=np.uint8), \
+            np.frombuffer(bytes(self.insert_qualities), dtype=np.uint8)
+
+    def rebase(self, window_start, read_indices):
+        """
+        Move the start of the window to the right and keep only a set of reads, the rest of the reads are evicted.
+        Bases and inserts left of the new window start are dropped and the kept reads get new indices in the order
+        of read_indices.
+        :param window_start: New start of the window, can not be less than the current start
+        :param read_indices: Sorted array of indices of the reads to keep
+        :return: Array that maps old read indices to new ones, -1 for evicted reads
+        """
+        shift = window_start - self.window_start
+        new_read_index = np.full(self.read_count, -1, dtype=np.int64)
+        new_read_index[read_indices] = np.arange(len(read_indices))
+
+        capacity = max(INITIAL_READ_CAPACITY, len(read_indices))
+        for attribute in ['read_starts', 'read_ends', 'map_qualities', 'is_reverse']:
+            array = getattr(self, attribute)
+            kept_array = np.zeros(capacity, dtype=array.dtype)
+            kept_array[:len(read_indices)] = array[read_indices]
+            setattr(self, attribute, kept_array)
+        for attribute in ['bases', 'base_qualities', 'cigar_codes']:
+            array = getattr(self, attribute)
+            width = array.shape[1] - shift if self.window_end is not None else \
+                max(INITIAL_WINDOW_WIDTH, array.shape[1] - shift)
+            kept_array = np.zeros((capacity, width), dtype=array.dtype)
+            kept_width = max(0, min(width, array.shape[1] - shift))
+            kept_array[:len(read_indices), :kept_width] = array[read_indices, shift:shift + kept_width]
+            setattr(self, attribute, kept_array)
+        self.read_names = [self.read_names[read_index] for read_index in read_indices]
+        self.read_count = len(read_indices)
+        self.window_start = window_start
+
+        # inserts of the kept reads that are still in the window are packed again
+        insert_bases = self.insert_bases
+        insert_qualities = self.insert_qualities
+        inserts = zip(self.insert_read_indices, self.insert_positions, self.insert_offsets, self.insert_lengths)
+        self.insert_read_indices = list()
+        self.insert_positions = list()
+        self.insert_offsets = list()
+        self.insert_lengths = list()
+        self.insert_bases = bytearray()
+        self.insert_qualities = bytearray()
+        self.insert_lookup = {}
+        for read_index, position, offset, length in inserts:
+            if new_read_index[read_index] < 0 or position < window_start:
+                continue
+            self.insert_lookup[(int(new_read_index[read_index]), position)] = len(self.insert_positions)
+            self.insert_read_indices.append(int(new_read_index[read_index]))
+            self.insert_positions.append(position)
+            self.insert_offsets.append(len(self.insert_bases))
+            self.insert_lengths.append(length)
+            self.insert_bases += insert_bases[offset:offset + length]
+            self.insert_qualities += insert_qualities[offset:offset + length]
+
+        return new_read_index
+
+    def get_read_spans(self):
+        """
+        Get the window columns of the bases of every read, from its first to its last base.
+        :return: First column and number of columns of every read, 0 columns for a read without bases in the window
+        """
+        has_base = self.bases[:self.read_count] != EMPTY_BASE
+        has_any_base = has_base.any(axis=1)
+        width = has_base.shape[1]
+        span_starts = np.where(has_any_base, np.argmax(has_base, axis=1), 0)
+        span_ends = np.where(has_any_base, width - np.argmax(has_base[:, ::-1], axis=1), 0)
+        return span_starts.astype(np.int64), (span_ends - span_starts).astype(np.int64)
+
+    def set_reads(self, read_starts, read_ends, map_qualities, is_reverse, span_starts, span_lengths, bases,
+                  base_qualities, cigar_codes):
+        """
+        Fill an empty store with reads given as arrays, the bases of the reads are given as the spans returned by
+        get_read_spans concatenated in read order. Read names are not kept.
+        :param read_starts: Alignment start of every read
+        :param read_ends: Alignment end of every read
+        :param map_qualities: Mapping quality of every read
+        :param is_reverse: Strand of every read
+        :param span_starts: First window column of the bases of every read
+        :param span_lengths: Number of columns of the bases of every read
+        :param bases: Bases of all the spans
+        :param base_qualities: Base qualities of all the spans
+        :param cigar_codes: Cigar codes of all the spans
+        :return:
+        """
+        read_count = len(read_starts)
+        capacity = max(INITIAL_READ_CAPACITY, read_count)
+        for attribute, values in [('read_starts', read_starts), ('read_ends', read_ends),
+                                  ('map_qualities', map_qualities), ('is_reverse', is_reverse)]:
+            array = np.zeros(capacity, dtype=getattr(self, attribute).dtype)
+            array[:read_count] = values
+            setattr(self, attribute, array)
+
+        width = self.bases.shape[1]
+        if len(span_lengths):
+            width = max(width, int((span_starts + span_lengths).max()))
+        rows = np.repeat(np.arange(read_count), span_lengths)
+        columns = np.repeat(span_starts - (np.cumsum(span_lengths) - span_lengths), span_lengths) + \
+            np.arange(len(rows))
+        for attribute, values in [('bases', bases), ('base_qualities', base_qualities),
+                                  ('cigar_codes', cigar_codes)]:
+            array = np.zeros((capacity, width), dtype=np.uint8)
+            array[rows, columns] = values
+            setattr(self, attribute, array)
+
+        self.read_names = [None] * read_count
+        self.read_count = read_count
+
+    def set_inserts(self, insert_read_indices, insert_positions, insert_lengths, insert_bases, insert_qualities):
+        """
+        Fill the inserts of a store without inserts from arrays, the inserted bases are concatenated in insert order.
+        :param insert_read_indices: Read index of every insert
+        :param insert_positions: Anchor position of every insert
+        :param insert_lengths: Length of every insert
+        :param insert_bases: Inserted bases
+        :param insert_qualities: Base qualities of the inserted bases
+        :return:
+        """
+        self.insert_read_indices = np.asarray(insert_read_indices).tolist()
+        self.insert_positions = np.asarray(insert_positions).tolist()
+        self.insert_lengths = np.asarray(insert_lengths).tolist()
+        self.insert_offsets = (np.cumsum(insert_lengths) - insert_lengths).tolist()
+        self.insert_bases = bytearray(insert_bases)
+        self.insert_qualities = bytearray(insert_qualities)
+        self.insert_lookup = dict(((read_index, position), insert_index) for insert_index, (read_index, position) in
+                                  enumerate(zip(self.insert_read_indices, self.insert_positions)))
+
+    def get_memory_usage(self):
+        """
+        Get the number of bytes used by the arrays of the store.
+        :return: Number of bytes
+        """
+        return self.read_starts.nbytes + self.read_ends.nbytes + self.map_qualities.nbytes + \
+            self.is_reverse.nbytes + self.bases.nbytes + self.base_qualities.nbytes + self.cigar_codes.nbytes + \
+            len(self.insert_bases) + len(self.insert_qualities)
@@ -0,0 +1,155 @@
+from modules.ImageCreatorRGB import ImageCreatorRGB, IMAGE_WIDTH
+from modules.ReadStore import ReadStore
+import numpy as np
+
+"""
+This script creates images of coordinate sorted bed records with a window that slides along the chromosome.
+"""
+
+REBASE_DISTANCE = 1000
+REFERENCE_CHUNK_SIZE = 10000
+
+
+class StreamingImageCreatorRGB:
+    """
+    Create images of coordinate sorted bed records without rebuilding the read state for every record.
+    - Reads of a chromosome are fetched with a single iterator and decoded once, when the window reaches them.
+    - Reads that end before the image window of the current record are skipped without being decoded, reads that end
+    before the current record are evicted at every record and the window is rebased as it moves right.
+    - Reference sequence is fetched in chunks ahead of the window.
+    Records that are not sorted restart the window at the record.
+    Only the RGB images stream. The pileup images of image_generator are created per group of nearby records, reads of
+    a group are decoded again by the next group and records that fall back to their own pileup decode their reads
+    again, so the cost of whole-genome generation still grows with the number of groups and fallbacks times depth.
+    """
+    def __init__(self, bam_handler, fasta_handler):
+        """
+        Initialize the streaming image creator
+        :param bam_handler: Handles bam file
+        :param fasta_handler: Handles fasta file
+        """
+        self.bam_handler = bam_handler
+        self.fasta_handler = fasta_handler
+
+        self.chromosome_name = None
+        self.last_position = None
+        self.image_creator = None
+        # iterator over the reads of the chromosome and the next read that is not decoded yet
+        self.reads = None
+        self.next_read = None
+        # end of the reference sequence fetched so far
+        self.reference_end = None
+
+        # counts for reporting
+        self.decoded_read_count = 0
+        self.skipped_read_count = 0
+        self.evicted_read_count = 0
+
+    def _start_window(self, chromosome_name, start_position):
+        """
+        Start a new window at a position, all previously decoded reads are dropped.
+        :param chromosome_name: Chromosome name
+        :param start_position: Start position of the first record
+        :return:
+        """
+        window_start = start_position - IMAGE_WIDTH
+        self.chromosome_name = chromosome_name
+        self.image_creator = ImageCreatorRGB(self.fasta_handler, chromosome_name, start_position, start_position,
+                                             read_store=ReadStore(window_start))
+        if self.reads is not None:
+            self.reads.close()
+        self.reads = self.bam_handler.get_region_reads(chromosome_name=chromosome_name, start=start_position,
+                                                       stop=None)
+        self.next_read = None
+        self.reference_end = window_start
+
+    def _evict_reads(self, start_position):
+        """
+        Evict the reads that end before a record and rebase the window once it moved far enough.
+        :param start_position: Start position of the record
+        :return:
+        """
+        read_store = self.image_creator.read_store
+        window_start = start_position - IMAGE_WIDTH
+        read_indices = np.nonzero(read_store.read_ends[:read_store.read_count] > start_position)[0]
+        if window_start - read_store.window_start < REBASE_DISTANCE:
+            if len(read_indices) == read_store.read_count:
+                return
+            # the window stays where it is, only the rows of the evicted reads are dropped
+            window_start = read_store.window_start
+
+        self.evicted_read_count += read_store.read_count - len(read_indices)
+        read_store.rebase(window_start, read_indices)
+
+    def _get_reads_until(self, start_position, end_position):
+        """
+        Yield the reads that start before or at a position and are not decoded yet. Reads that end before the image
+        window of the record are skipped, no later record can use them.
+        :param start_position: Start position of the record
+        :param end_position: End position of the record
+        :return:
+        """
+        while True:
+            if self.next_read is None:
+                self.next_read = next(self.reads, None)
+                if self.next_read is None:
+                    return
+            if self.next_read.reference_start > end_position:
+                return
+            read = self.next_read
+            self.next_read = None
+            if read.reference_end <= start_position - IMAGE_WIDTH:
+                self.skipped_read_count += 1
+                continue
+            self.decoded_read_count += 1
+            yield read
+
+    def _update_reference(self, end_position):
+        """
+        Fetch the next chunk of reference sequence if the image window of a record goes beyond the fetched sequence.
+        :param end_position: End position of the record
+        :return:
+        """
+        window_end = end_position + IMAGE_WIDTH + 1
+        if window_end <= self.reference_end:
+            return
+
+        self.reference_end = window_end + REFERENCE_CHUNK_SIZE
+        self.image_creator.set_window_reference(self.image_creator.read_store.window_start, self.reference_end)
+
+    def generate_image(self, chromosome_name, start_position, end_position, alts):
+        """
+        Generate the image of a bed record, records should be given sorted by chromosome and position.
+        :param chromosome_name: Chromosome name
+        :param start_position: Start position of the allele
+        :param end_position: End position of the allele
+        :param alts: Alternate alleles
+        :return: Image array
+        """
+        if chromosome_name != self.chromosome_name or start_position < self.last_position:
+            self._start_window(chromosome_name, start_position)
+        self.last_position = start_position
+
+        self._evict_reads(start_position)
+        self.image_creator.decode_reads(self._get_reads_until(start_position, end_position))
+        self._update_reference(end_position)
+
+        self.image_creator.select_reads(start_position, end_position)
+        return self.image_creator.generate_image(start_position, alts)
+
+    def close(self):
+        """
+        Close the read iterator of the current chromosome so the statistics of its region are recorded.
+        :return:
+        """
+        if self.reads is not None:
+            self.reads.close()
+            self.reads = None
+
+    def get_statistics(self):
+        """
+        Get the number of decoded, skipped and evicted reads and the memory used by the read store.
+        :return: Decoded read count, skipped read count, evicted read count, bytes used by the read store
+        """
+        memory_usage = self.image_creator.read_store.get_memory_usage() if self.image_creator is not None else 0
+        return self.decoded_read_count, self.skipped_read_count, self.evicted_read_count, memory_usage
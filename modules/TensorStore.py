@@ -0,0 +1,138 @@
+import os
+import numpy as np
+
+"""
+Stores images in large shard files of fixed shape uint8 records instead of one PNG file per image.
+"""
+
+DATA_FILE_EXTENSION = ".tensors"
+INDEX_FILE_EXTENSION = ".index.npz"
+
+
+class TensorStoreWriter:
+    """
+    Writes the images of a shard.
+    - Images are appended to the data file of the shard as raw uint8 records of the same shape.
+    - The index of the shard keeps the key, offset and label of every record.
+    - Files are written with a temporary name and renamed when the shard is closed, a shard is either complete or
+    not visible at all.
+    """
+    def __init__(self, store_dir, shard_name, record_shape):
+        """
+        Initialize a shard writer
+        :param store_dir: Directory of the tensor store
+        :param shard_name: Name of the shard
+        :param record_shape: Shape of the images
+        """
+        self.data_file_path = os.path.abspath(store_dir + shard_name) + DATA_FILE_EXTENSION
+        self.index_file_path = os.path.abspath(store_dir + shard_name) + INDEX_FILE_EXTENSION
+        self.record_shape = tuple(record_shape)
+        self.record_size = int(np.prod(self.record_shape))
+
+        self.data_file = open(self.data_file_path + ".tmp", 'wb')
+        self.keys = list()
+        self.offsets = list()
+        self.labels = list()
+
+    def add(self, key, image_array, label):
+        """
+        Append an image to the shard
+        :param key: Key of the image
+        :param image_array: Image array of the record shape
+        :param label: Label of the image
+        :return:
+        """
+        if image_array.shape != self.record_shape:
+            raise ValueError("INVALID IMAGE SHAPE: " + str(image_array.shape) + " EXPECTED: "
+                             + str(self.record_shape))
+        self.keys.append(key)
+        self.offsets.append(len(self.offsets) * self.record_size)
+        self.labels.append(label)
+        self.data_file.write(np.ascontiguousarray(image_array, dtype=np.uint8).tobytes())
+
+    def close(self):
+        """
+        Finish writing the shard, the data file is renamed before the index so a visible index always has its data.
+        :return:
+        """
+        self.data_file.close()
+        os.replace(self.data_file_path + ".tmp", self.data_file_path)
+
+        with open(self.index_file_path + ".tmp", 'wb') as index_file:
+            np.savez(index_file,
+                     keys=np.array(self.keys, dtype=np.str_),
+                     offsets=np.array(self.offsets, dtype=np.int64),
+                     labels=np.array(self.labels, dtype=np.int64),
+                     record_shape=np.array(self.record_shape, dtype=np.int64))
+        os.replace(self.index_file_path + ".tmp", self.index_file_path)
+
+
+class TensorStore:
+    """
+    Reads the images of all the shards in a directory.
+    - Indexes of the shards are loaded once, images are found by key.
+    - Data files are memory mapped when first accessed and images are returned as read only views of the map.
+    """
+    def __init__(self, store_dir):
+        """
+        Load the indexes of the shards in a directory
+        :param store_dir: Directory of the tensor store
+        """
+        self.store_dir = store_dir
+        self.data_file_paths = list()
+        self.record_shapes = list()
+        # memory maps of the data files, opened on first access
+        self.data_maps = list()
+        # [key] = (shard index, offset, label)
+        self.records = {}
+
+        if os.path.isdir(store_dir):
+            for file_name in sorted(os.listdir(store_dir)):
+                if file_name.endswith(INDEX_FILE_EXTENSION):
+                    self.load_shard_index(file_name[:-len(INDEX_FILE_EXTENSION)])
+
+    def load_shard_index(self, shard_name):
+        """
+        Load the index of a shard
+        :param shard_name: Name of the shard
+        :return:
+        """
+        shard_index = len(self.data_file_paths)
+        with np.load(os.path.abspath(self.store_dir + shard_name) + INDEX_FILE_EXTENSION) as index:
+            keys = index['keys'].tolist()
+            offsets = index['offsets'].tolist()
+            labels = index['labels'].tolist()
+            record_shape = tuple(index['record_shape'].tolist())
+
+        self.data_file_paths.append(os.path.abspath(self.store_dir + shard_name) + DATA_FILE_EXTENSION)
+        self.record_shapes.append(record_shape)
+        self.data_maps.append(None)
+        for key, offset, label in zip(keys, offsets, labels):
+            self.records[key] = (shard_index, offset, label)
+
+    def __getstate__(self):
+        # memory maps are not copied to worker processes, every process maps the data files again
+        state = self.__dict__.copy()
+        state['data_maps'] = [None] * len(self.data_maps)
+        return state
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        """
+        Get an image and its label
+        :param key: Key of the image
+        :return: Read only image array that is a view of the memory mapped shard, label
+        """
+        shard_index, offset, label = self.records[key]
+        if self.data_maps[shard_index] is None:
+            self.data_maps[shard_index] = np.memmap(self.data_file_paths[shard_index], dtype=np.uint8, mode='r')
+
+        record_shape = self.record_shapes[shard_index]
+        record_size = int(np.prod(record_shape))
+        image_array = self.data_maps[shard_index][offset:offset + record_size].reshape(record_shape)
+        return image_array, label
@@ -1,32 +1,103 @@
 import torch
-from modules.BedHandler import BedHandler
+from modules.BedLineIndex import BedLineIndex
 from modules.Bed2Image_API import Bed2ImageAPI
+from modules.BamHandler import BamHandler
+from modules.FastaHandler import FastaHandler, PYSAM_REFERENCE
+from modules.TensorStore import TensorStore
+from modules.ImageManifest import ImageManifest, IN_TENSOR_STORE, PNG_FILE
+from modules.TextColor import TextColor
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 import os
+import sys
 from PIL import Image, ImageOps
 import numpy as np
 
 
 class DataSetLoader(Dataset):
-    def __init__(self, bam_file_path, fasta_file_path, bed_file_path, img_output_dir, transform, img_w=300, img_h=300, img_c=7):
+    def __init__(self, bam_file_path, fasta_file_path, bed_file_path, img_output_dir, transform, img_w=300, img_h=300, img_c=7,
+                 reference_mode=PYSAM_REFERENCE, read_downsampler=None):
         self.bam_file_path = bam_file_path
         self.fasta_file_path = fasta_file_path
-        self.bed_handler = BedHandler(bed_file_path)
-
-        self.all_bed_records = self.bed_handler.all_bed_records
+        self.reference_mode = reference_mode
+        # picks the reads of the images rendered here, should match the one the images were generated with
+        self.read_downsampler = read_downsampler
+        # records are read from the bed file by index instead of keeping the lines in memory
+        self.bed_records = BedLineIndex(bed_file_path)
         self.img_output_dir = img_output_dir
         self.transform = transform
         self.shape = (img_w, img_h, img_c)
 
         self.generated_files = {}
+        # images generated before training are read from the tensor store of the image directory
+        self.tensor_store = TensorStore(img_output_dir)
+        # status of the image of every record, so accessing an item does not check the file system
+        self.manifest = ImageManifest(img_output_dir,
+                                      (self.get_file_name(bed_record) for bed_record in self.bed_records),
+                                      self.tensor_store)
+        not_generated, in_tensor_store, png_files = self.manifest.get_counts()
+        sys.stderr.write(TextColor.CYAN + "IMAGES IN TENSOR STORE: " + str(in_tensor_store) + " PNG FILES: "
+                         + str(png_files) + " NOT GENERATED: " + str(not_generated) + "\n" + TextColor.END)
+
+        # bam and fasta handlers are opened once per process and reused for the lifetime of that process.
+        # the pid is kept with the handlers so a forked worker never reuses the handles of its parent.
+        self.api_object = None
+        self.api_object_pid = None
+
+    @staticmethod
+    def get_file_name(bed_record):
+        """
+        Return the image file name of a bed record
+        :param bed_record: Bed record
+        :return: File name without the extension
+        """
+        contig, pos_s, pos_e, ref, alt, genotype = bed_record.rstrip().split('\t')[:6]
+        return contig + "_" + pos_s + "_" + alt + "_" + genotype
+
+    def get_api_object(self):
+        """
+        Return the Bed2ImageAPI object of this process, open the bam and fasta handlers if not opened yet
+        :return: Bed2ImageAPI object
+        """
+        if self.api_object is None or self.api_object_pid != os.getpid():
+            self.api_object = Bed2ImageAPI(self.bam_file_path, self.fasta_file_path, self.reference_mode,
+                                           read_downsampler=self.read_downsampler)
+            self.api_object_pid = os.getpid()
+        return self.api_object
+
+    @staticmethod
+    def get_handle_open_counts():
+        """
+        Return how many times bam and fasta files were opened in this process
+        :return: Process id, bam open count, fasta open count
+        """
+        return os.getpid(), BamHandler.open_count, FastaHandler.open_count
+
+    @staticmethod
+    def worker_init_fn(worker_id):
+        """
+        Open the bam and fasta handlers of a DataLoader worker as soon as the worker starts.
+        :param worker_id: Id of the worker
+        :return:
+        """
+        worker_info = get_worker_info()
+        if worker_info is None:
+            return
+        worker_info.dataset.get_api_object()
+        pid, bam_open_count, fasta_open_count = DataSetLoader.get_handle_open_counts()
+        sys.stderr.write(TextColor.CYAN + "WORKER " + str(worker_id) + " PID " + str(pid) + " BAM OPENED: "
+                         + str(bam_open_count) + " FASTA OPENED: " + str(fasta_open_count) + "\n" + TextColor.END)
 
     def __getitem__(self, index):
-        bed_record = self.all_bed_records[index]
+        bed_record = self.bed_records.get_record(index)
         contig, pos_s, pos_e, ref, alt, genotype, qual, gen_filter, in_confident = bed_record.rstrip().split('\t')
-        file_name = contig + "_" + pos_s + "_" + alt + "_" + genotype
+        file_name = self.get_file_name(bed_record)
+        image_status = self.manifest.get_status(index)
         summary_string = ''
-        if os.path.isfile(os.path.abspath(self.img_output_dir + file_name) + ".png"):
+        if image_status == IN_TENSOR_STORE:
+            img, label = self.tensor_store.get(file_name)
+            label = torch.LongTensor([label])
+        elif image_status == PNG_FILE:
             # read the file
             file = os.path.abspath(self.img_output_dir + file_name) + ".png"
             label = int(genotype)
@@ -40,10 +111,12 @@ class DataSetLoader(Dataset):
             label = torch.LongTensor([label])
         else:
             # save the file
-            api_object = Bed2ImageAPI(self.bam_file_path, self.fasta_file_path)
+            api_object = self.get_api_object()
             img, label, img_shape = api_object.create_image(api_object.bam_handler, api_object.fasta_handler,
-                                                 bed_record, self.img_output_dir, file_name)
+                                                 bed_record, self.img_output_dir, file_name,
+                                                 api_object.read_downsampler)
             label = torch.LongTensor([label])
+            self.manifest.mark_generated(index)
             summary_string += os.path.abspath(self.img_output_dir + file_name) + ".png," + str(genotype) + ',' \
                               + ','.join(map(str, img_shape)) + "," + str(qual) + "," + str(gen_filter) + "," \
                               + str(in_confident) + '\n'
@@ -53,4 +126,4 @@ class DataSetLoader(Dataset):
         return img, label, bed_record, summary_string
 
     def __len__(self):
-        return len(self.all_bed_records)
+        return len(self.bed_records)
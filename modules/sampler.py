@@ -0,0 +1,224 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+"""
+Samplers that choose the order of the records a DataLoader reads from a DataSetLoader.
+"""
+
+HOM = 0
+HET = 1
+HOM_ALT = 2
+GENOTYPES = [HOM, HET, HOM_ALT]
+DEFAULT_BLOCK_SIZE = 64
+# records within this distance of the previous record of a worker share its bam and reference reads
+LOCALITY_DISTANCE = 1000
+
+
+class ClassBalancedSampler(Sampler):
+    """
+    Draws an index stream with a fixed ratio of hom, het and hom-alt records every epoch instead of downsampling the
+    bed file.
+    - Records of every genotype are walked in a shuffled order that continues from one epoch to the next, so a
+    downsampled genotype shows different records every epoch and all of them over enough epochs.
+    - A genotype with fewer records than its share of an epoch is repeated.
+    - The indices of an epoch are shuffled together so a batch mixes genotypes.
+    """
+    def __init__(self, genotypes, class_ratios, num_samples=None, seed=None):
+        """
+        Initialize a class balanced sampler
+        :param genotypes: Array of the genotype of every record, in the order of the dataset
+        :param class_ratios: Ratios of hom, het and hom-alt records in an epoch
+        :param num_samples: Number of records in an epoch. If None the genotype with the fewest records for its ratio
+        is seen once and sets the number of records of the others.
+        :param seed: Seed of the random order
+        """
+        self.random_state = np.random.RandomState(seed)
+        genotypes = np.asarray(genotypes)
+        # [genotype] = indices of the records of the genotype
+        self.class_indices = [np.nonzero(genotypes == genotype)[0] for genotype in GENOTYPES]
+        class_counts = [len(indices) for indices in self.class_indices]
+
+        present_genotypes = [genotype for genotype in GENOTYPES
+                             if class_ratios[genotype] > 0 and class_counts[genotype] > 0]
+        total_ratio = sum(class_ratios[genotype] for genotype in present_genotypes)
+        if num_samples is None:
+            scale = min(class_counts[genotype] / class_ratios[genotype] for genotype in present_genotypes) \
+                if present_genotypes else 0
+            num_samples = int(scale * total_ratio)
+        self.samples_per_class = [int(num_samples * class_ratios[genotype] / total_ratio)
+                                  if genotype in present_genotypes else 0 for genotype in GENOTYPES]
+
+        # shuffled order of the records of every genotype and how far it has been walked
+        self.class_orders = [self.random_state.permutation(indices) for indices in self.class_indices]
+        self.class_cursors = [0, 0, 0]
+
+    def get_samples_per_class(self):
+        """
+        Get the number of records of each genotype in an epoch
+        :return: List of counts indexed by genotype
+        """
+        return list(self.samples_per_class)
+
+    def get_class_indices(self, genotype, sample_count):
+        """
+        Take the next records of a genotype from its shuffled order, reshuffle the order when it runs out
+        :param genotype: Genotype
+        :param sample_count: Number of records
+        :return: Array of record indices
+        """
+        indices = list()
+        while sample_count > 0:
+            order = self.class_orders[genotype]
+            if self.class_cursors[genotype] == len(order):
+                self.class_orders[genotype] = order = self.random_state.permutation(self.class_indices[genotype])
+                self.class_cursors[genotype] = 0
+            start = self.class_cursors[genotype]
+            end = min(len(order), start + sample_count)
+            indices.append(order[start:end])
+            self.class_cursors[genotype] = end
+            sample_count -= end - start
+
+        return np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+
+    def __iter__(self):
+        epoch_indices = np.concatenate([self.get_class_indices(genotype, self.samples_per_class[genotype])
+                                        for genotype in GENOTYPES])
+        self.random_state.shuffle(epoch_indices)
+        return iter(epoch_indices.tolist())
+
+    def __len__(self):
+        return sum(self.samples_per_class)
+
+
+class LocalityBlockSampler(Sampler):
+    """
+    Batch sampler that keeps the records a worker reads genomically close so its bam and reference reads hit warm
+    caches.
+    - Records are sorted by contig and start position and cut into blocks of consecutive records. Every epoch the
+    blocks are cut at a random offset and shuffled. Records of a block stay in genomic order, a batch is the same set of
+    records in any order.
+    - A DataLoader hands batch i to worker i % num_workers, so blocks are assigned to workers and the batches of the
+    workers are interleaved in that order. A worker reads its blocks one after the other.
+    - A read is a cache hit when the previous record of the same worker is on the same contig and within
+    LOCALITY_DISTANCE bases. The hit rate of every epoch is kept next to the hit rate a full shuffle would have.
+    """
+    def __init__(self, contig_ids, start_positions, batch_size, block_size=DEFAULT_BLOCK_SIZE, num_workers=0,
+                 seed=None, sampler=None):
+        """
+        Initialize a locality block sampler
+        :param contig_ids: Array of the contig id of every record, in the order of the dataset
+        :param start_positions: Array of the start position of every record, in the order of the dataset
+        :param batch_size: Number of records in a batch
+        :param block_size: Number of genomically adjacent records in a block
+        :param num_workers: Number of DataLoader workers, 0 if records are loaded in the main process
+        :param seed: Seed of the random order
+        :param sampler: Sampler that chooses the records of an epoch, every record is read once per epoch if None
+        """
+        self.contig_ids = np.asarray(contig_ids)
+        self.start_positions = np.asarray(start_positions)
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.num_workers = max(1, num_workers)
+        self.random_state = np.random.RandomState(seed)
+        self.sampler = sampler
+
+        # rank of every record in genomic order
+        genomic_order = np.lexsort((self.start_positions, self.contig_ids))
+        self.genomic_ranks = np.empty(len(genomic_order), dtype=np.int64)
+        self.genomic_ranks[genomic_order] = np.arange(len(genomic_order))
+
+        # hit rates of the last epoch
+        self.locality_hit_rate = None
+        self.shuffle_hit_rate = None
+
+    def get_epoch_indices(self):
+        """
+        Get the records of an epoch sorted in genomic order
+        :return: Array of record indices
+        """
+        if self.sampler is None:
+            epoch_indices = np.arange(len(self.genomic_ranks))
+        else:
+            epoch_indices = np.array(list(self.sampler), dtype=np.int64)
+        return epoch_indices[np.argsort(self.genomic_ranks[epoch_indices], kind='mergesort')]
+
+    def get_batches(self, epoch_indices):
+        """
+        Cut genomically sorted records into shuffled blocks, assign the blocks to workers and interleave the batches
+        of the workers in the order the DataLoader hands them out
+        :param epoch_indices: Array of record indices in genomic order
+        :return: List of batches, each batch is a list of record indices
+        """
+        # rotate the records so the blocks of every epoch start at different records
+        if len(epoch_indices):
+            epoch_indices = np.roll(epoch_indices, -self.random_state.randint(self.block_size))
+        blocks = [epoch_indices[i:i + self.block_size] for i in range(0, len(epoch_indices), self.block_size)]
+        # a short last block is assigned after the shuffled full blocks so the number of batches doesn't change
+        full_block_count = len(epoch_indices) // self.block_size
+        block_order = np.concatenate((self.random_state.permutation(full_block_count),
+                                      np.arange(full_block_count, len(blocks)))).astype(np.int64)
+
+        # [worker] = records of the blocks of the worker in the order they are read
+        worker_records = [list() for worker in range(self.num_workers)]
+        for i, block_index in enumerate(block_order):
+            worker_records[i % self.num_workers].append(blocks[block_index])
+        worker_batches = list()
+        for records in worker_records:
+            records = np.concatenate(records).tolist() if records else list()
+            worker_batches.append([records[i:i + self.batch_size] for i in range(0, len(records), self.batch_size)])
+
+        batches = list()
+        for batch_round in range(max(len(batches_of_worker) for batches_of_worker in worker_batches)):
+            for batches_of_worker in worker_batches:
+                if batch_round < len(batches_of_worker):
+                    batches.append(batches_of_worker[batch_round])
+        return batches
+
+    def get_hit_rate(self, batches):
+        """
+        Get the fraction of records whose previous record in the same worker is within LOCALITY_DISTANCE bases
+        :param batches: List of batches in the order the DataLoader hands them out
+        :return: Hit rate
+        """
+        hits = 0
+        reads = 0
+        for worker in range(self.num_workers):
+            worker_batches = batches[worker::self.num_workers]
+            if not worker_batches:
+                continue
+            records = np.concatenate(worker_batches).astype(np.int64)
+            same_contig = self.contig_ids[records[1:]] == self.contig_ids[records[:-1]]
+            distances = np.abs(self.start_positions[records[1:]] - self.start_positions[records[:-1]])
+            hits += int(np.count_nonzero(same_contig & (distances <= LOCALITY_DISTANCE)))
+            reads += len(records)
+        return hits / reads if reads else 0.0
+
+    def get_statistics(self):
+        """
+        Get the cache hit rates of the last epoch
+        :return: Hit rate of the block order, hit rate of a full shuffle of the same records
+        """
+        return self.locality_hit_rate, self.shuffle_hit_rate
+
+    def __iter__(self):
+        epoch_indices = self.get_epoch_indices()
+        batches = self.get_batches(epoch_indices)
+
+        shuffled_indices = self.random_state.permutation(epoch_indices).tolist()
+        shuffled_batches = [shuffled_indices[i:i + self.batch_size]
+                            for i in range(0, len(shuffled_indices), self.batch_size)]
+        self.locality_hit_rate = self.get_hit_rate(batches)
+        self.shuffle_hit_rate = self.get_hit_rate(shuffled_batches)
+
+        return iter(batches)
+
+    def __len__(self):
+        record_count = len(self.sampler) if self.sampler is not None else len(self.genomic_ranks)
+        block_counts = [len(range(worker * self.block_size, record_count, self.block_size * self.num_workers))
+                        for worker in range(self.num_workers)]
+        # the last block of the records can be shorter than the others
+        worker_record_counts = [block_count * self.block_size for block_count in block_counts]
+        if record_count % self.block_size:
+            worker_record_counts[(record_count // self.block_size) % self.num_workers] -= \
+                self.block_size - record_count % self.block_size
+        return sum((count + self.batch_size - 1) // self.batch_size for count in worker_record_counts)
@@ -8,6 +8,11 @@ from torch.autograd import Variable
 import torchnet.meter as meter
 
 from modules.dataloader import DataSetLoader
+from modules.BedHandler import BedHandler
+from modules.sampler import ClassBalancedSampler, LocalityBlockSampler
+from modules.FastaHandler import PYSAM_REFERENCE, REFERENCE_MODES
+from modules.ImageCreator import MAX_READS_IN_IMAGE
+from modules.ReadDownsampler import ReadDownsampler
 from modules.TextColor import TextColor
 from modules.model import Model
 from modules.inception import Inception3
@@ -33,15 +38,18 @@ def handle_directory(directory_path):
     return directory_path
 
 
-def holdout_test(bam_file, ref_file, holdout_test_file, batch_size, gpu_mode, trained_model, max_threads, img_op_dir):
+def holdout_test(bam_file, ref_file, holdout_test_file, batch_size, gpu_mode, trained_model, max_threads, img_op_dir,
+                 reference_mode=PYSAM_REFERENCE, read_downsampler=None):
     transformations = transforms.Compose([transforms.ToTensor()])
 
-    validation_data = DataSetLoader(bam_file, ref_file, holdout_test_file, img_op_dir, transformations)
+    validation_data = DataSetLoader(bam_file, ref_file, holdout_test_file, img_op_dir, transformations,
+                                    reference_mode=reference_mode, read_downsampler=read_downsampler)
     validation_loader = DataLoader(validation_data,
                                    batch_size=batch_size,
                                    shuffle=False,
                                    num_workers=max_threads,
-                                   pin_memory=gpu_mode
+                                   pin_memory=gpu_mode,
+                                   worker_init_fn=DataSetLoader.worker_init_fn
                                    )
     sys.stderr.write(TextColor.PURPLE + 'Data loading finished\n' + TextColor.END)
 
@@ -107,18 +115,41 @@ def save_model_checkpoint(model, output_dir, epoch, optimizer, batch):
     }, output_dir + 'checkpoint_' + str(epoch + 1) + "." + str(batch + 1) + "_params.pkl")
 
 
-def train(bam_file, ref_file, train_bed, val_bed, batch_size, epoch_limit, output_dir, gpu_mode, img_op_dir, max_threads):
+def train(bam_file, ref_file, train_bed, val_bed, batch_size, epoch_limit, output_dir, gpu_mode, img_op_dir, max_threads,
+          class_ratios=None, seed=None, block_size=None, reference_mode=PYSAM_REFERENCE, read_downsampler=None):
     img_op_dir_train = handle_directory(img_op_dir+"train/")
     img_op_dir_test = handle_directory(img_op_dir + "test/")
     transformations = transforms.Compose([transforms.ToTensor()])
     sys.stderr.write(TextColor.PURPLE + 'Loading data\n' + TextColor.END)
-    train_data_set = DataSetLoader(bam_file, ref_file, train_bed, img_op_dir_train, transformations)
-    train_loader = DataLoader(train_data_set,
-                              batch_size=batch_size,
-                              shuffle=True,
-                              num_workers=max_threads,
-                              pin_memory=gpu_mode
-                              )
+    train_data_set = DataSetLoader(bam_file, ref_file, train_bed, img_op_dir_train, transformations,
+                                   reference_mode=reference_mode, read_downsampler=read_downsampler)
+    bed_handler = BedHandler(train_bed, use_cache=True) if class_ratios is not None or block_size is not None else None
+    # with class ratios every epoch draws a balanced stream of records instead of reading a downsampled bed file
+    train_sampler = None
+    if class_ratios is not None:
+        train_sampler = ClassBalancedSampler(bed_handler.genotypes, class_ratios, seed=seed)
+        sys.stderr.write(TextColor.CYAN + "RECORDS PER EPOCH (HOM, HET, HOM-ALT): "
+                         + str(train_sampler.get_samples_per_class()) + "\n" + TextColor.END)
+    # with a block size every worker reads blocks of genomically adjacent records
+    train_batch_sampler = None
+    if block_size is not None:
+        train_batch_sampler = LocalityBlockSampler(bed_handler.contig_ids, bed_handler.start_positions, batch_size,
+                                                   block_size, max_threads, seed, train_sampler)
+        train_loader = DataLoader(train_data_set,
+                                  batch_sampler=train_batch_sampler,
+                                  num_workers=max_threads,
+                                  pin_memory=gpu_mode,
+                                  worker_init_fn=DataSetLoader.worker_init_fn
+                                  )
+    else:
+        train_loader = DataLoader(train_data_set,
+                                  batch_size=batch_size,
+                                  shuffle=train_sampler is None,
+                                  sampler=train_sampler,
+                                  num_workers=max_threads,
+                                  pin_memory=gpu_mode,
+                                  worker_init_fn=DataSetLoader.worker_init_fn
+                                  )
     sys.stderr.write(TextColor.PURPLE + 'Data loading finished\n' + TextColor.END)
 
     model = Inception3()
@@ -194,6 +225,10 @@ def train(bam_file, ref_file, train_bed, val_bed, batch_size, epoch_limit, outpu
         sys.stderr.write(TextColor.YELLOW + " Loss: " + str(avg_loss) + "\n" + TextColor.END)
         sys.stderr.write(TextColor.DARKCYAN + "Time Elapsed: " + str((time.time() - absolute_start)) +
                          " Secs \n" + TextColor.END)
+        if train_batch_sampler is not None:
+            locality_hit_rate, shuffle_hit_rate = train_batch_sampler.get_statistics()
+            sys.stderr.write(TextColor.DARKCYAN + "CACHE HIT RATE: " + str(round(locality_hit_rate, 4))
+                             + " FULL SHUFFLE: " + str(round(shuffle_hit_rate, 4)) + "\n" + TextColor.END)
         print(str(epoch+1) + "\t" + str(i + 1) + "\t" + str(avg_loss))
 
         if (i+1) % 1000 == 0:
@@ -207,7 +242,8 @@ def train(bam_file, ref_file, train_bed, val_bed, batch_size, epoch_limit, outpu
         save_model_checkpoint(model, output_dir, epoch, optimizer, i + 1)
 
         # After each epoch do validation
-        holdout_test(bam_file, ref_file, val_bed, batch_size, gpu_mode, model, max_threads, img_op_dir_test)
+        holdout_test(bam_file, ref_file, val_bed, batch_size, gpu_mode, model, max_threads, img_op_dir_test,
+                     reference_mode, read_downsampler)
 
     sys.stderr.write(TextColor.PURPLE + 'Finished training\n' + TextColor.END)
 
@@ -303,9 +339,60 @@ if __name__ == '__main__':
         default=80,
         help="Maximum number of threads to use when loading data."
     )
+    parser.add_argument(
+        "--class_ratios",
+        type=str,
+        default=None,
+        help="Ratios of hom, het and hom-alt records in an epoch. Ex: 2,1,1. If not set all records are shuffled."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed of the class balanced and block samplers."
+    )
+    parser.add_argument(
+        "--block_size",
+        type=int,
+        default=None,
+        help="If set every worker reads blocks of this many genomically adjacent records."
+    )
+    parser.add_argument(
+        "--reference_mode",
+        type=str,
+        default=PYSAM_REFERENCE,
+        choices=REFERENCE_MODES,
+        help="How the reference is read, mmap converts every contig once to a memory mapped file, "
+             "packed keeps every contig in memory at 2 bits per base."
+    )
+    parser.add_argument(
+        "--downsample",
+        type='bool',
+        default=False,
+        help="If true the reads of an image rendered during training are a seeded random subset instead of the first "
+             "reads. Use the same downsampling as the image generator."
+    )
+    parser.add_argument(
+        "--strand_balanced",
+        type='bool',
+        default=False,
+        help="If true half of the downsampled reads come from each strand."
+    )
+    parser.add_argument(
+        "--downsample_seed",
+        type=int,
+        default=0,
+        help="Seed of the read downsampling."
+    )
     FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.class_ratios = [float(ratio) for ratio in FLAGS.class_ratios.split(',')] \
+        if FLAGS.class_ratios is not None else None
     FLAGS.img_output_dir = handle_directory(FLAGS.img_output_dir)
 
+    read_downsampler = ReadDownsampler(MAX_READS_IN_IMAGE, FLAGS.downsample_seed, FLAGS.strand_balanced) \
+        if FLAGS.downsample is True else None
+
     FLAGS.model_out = directory_control(FLAGS.model_out)
     train(FLAGS.bam, FLAGS.ref, FLAGS.train_bed, FLAGS.holdout_bed, FLAGS.batch_size,
-          FLAGS.epoch_size, FLAGS.model_out, FLAGS.gpu_mode, FLAGS.img_output_dir, FLAGS.max_threads)
+          FLAGS.epoch_size, FLAGS.model_out, FLAGS.gpu_mode, FLAGS.img_output_dir, FLAGS.max_threads,
+          FLAGS.class_ratios, FLAGS.seed, FLAGS.block_size, FLAGS.reference_mode, read_downsampler)